@@ -3,6 +3,7 @@ import logging
 import asyncio
 from dotenv import load_dotenv
 from telegram import Update
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
     ContextTypes,
@@ -13,7 +14,10 @@ from telegram.ext import (
     filters
 )
 
-from database import init_db, upsert_user
+import database
+import metrics
+import querybudget
+from database import ensure_db, upsert_user, get_pool_stats, env_flag
 from pay import (
     start_pay, select_payer, enter_comment, enter_amount, select_currency, select_payee,
     select_consumer_for_split, enter_consumer_amount, cancel, undo_pay,
@@ -21,14 +25,20 @@ from pay import (
     SELECT_CONSUMER_FOR_SPLIT, ENTER_CONSUMER_AMOUNT
 )
 from settle import (
-    start_settle, select_settle_currency, store_rate,
-    SELECT_SETTLE_CURRENCY, ENTER_RATE
+    start_settle, select_settle_currency, store_rate, confirm_settlement_callback,
+    SELECT_SETTLE_CURRENCY, ENTER_RATE, CONFIRM_SETTLEMENT
 )
 from list import (
-    list_settlements, list_pagination_callback, close_list,
-    LIST_PAGE
+    list_settlements, list_pagination_callback, close_list, rebuild_balances_command,
+    LIST_PAGE, ledger_cache
 )
+from callbacks import keyboard_cache
 from users import register
+from ledgerfile import export_command, import_command
+from webhook import run_webhook
+from processor import ChatOrderedUpdateProcessor
+from persistence import DatabasePersistence
+from outbound import OutboundDispatcher
 
 load_dotenv()
 TOKEN = os.getenv('BOT_TOKEN')
@@ -41,6 +51,9 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("telegram").setLevel(logging.WARNING)
 
+# Keeps references to fire-and-forget tasks so they aren't garbage collected
+background_tasks = set()
+
 
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_first_name = update.effective_user.first_name
@@ -52,6 +65,9 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_lines.append("/settle - Show the most efficient way to pay everyone back")
     reply_lines.append("/undo - Remove the last transaction recorded in this chat")
     reply_lines.append("/cancel - Cancel an ongoing transaction")
+    reply_lines.append("/rebuildbalances - Verify net balances against the full history")
+    reply_lines.append("/export [csv|jsonl] - Download this chat's ledger")
+    reply_lines.append("/import - Caption a file from /export with this to load it into this chat")
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -59,16 +75,96 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text='\n'.join(reply_lines)
     )
 
+def cache_stats():
+    """
+    {cache name: LRUCache.stats()} for the in-process caches.
+    """
+    return {
+        'ledger': ledger_cache.stats(),
+        'roster': database.roster_cache.stats(),
+        'keyboard': keyboard_cache.stats(),
+    }
+
+async def log_pool_stats(application, interval):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(f"DB pool: {get_pool_stats()}")
+        logging.info(f"Caches: {cache_stats()}")
+        if isinstance(application.update_processor, ChatOrderedUpdateProcessor):
+            logging.info(f"Updates: {application.update_processor.stats()}")
+
 async def post_init(application):
     print("Initializing database...")
-    await init_db(DB_URL)
+    await ensure_db(DB_URL)
 
-if __name__ == '__main__':
-    if not TOKEN:
-        print("Error: BOT_TOKEN missing.")
-        exit(1)
+    if metrics.METRICS_PORT:
+        await start_metrics(application)
+    if querybudget.QUERY_BUDGET != querybudget.OFF:
+        for engine in database.get_engines():
+            querybudget.install(engine)
+
+    pool_stats_interval = float(os.getenv('DB_POOL_STATS_INTERVAL', '0'))
+    if pool_stats_interval > 0:
+        background_tasks.add(asyncio.create_task(log_pool_stats(application, pool_stats_interval)))
+
+async def start_metrics(application):
+    for engine in database.get_engines():
+        metrics.instrument_engine(engine)
+    metrics.register_gauge(
+        'bot_db_pool', 'Connection pool statistics.', ('stat',),
+        lambda: {(name,): value for name, value in get_pool_stats().items() if not isinstance(value, str)}
+    )
+    metrics.register_gauge(
+        'bot_cache', 'In-process cache size, hits, misses and evictions.', ('cache', 'stat'),
+        lambda: {(cache, name): value for cache, stats in cache_stats().items() for name, value in stats.items()}
+    )
+    processor = application.update_processor
+    if isinstance(processor, ChatOrderedUpdateProcessor):
+        metrics.register_gauge(
+            'bot_updates', 'Update processing state.', ('stat',),
+            lambda: {(name,): value for name, value in processor.stats().items()}
+        )
+        metrics.register_gauge(
+            'bot_chat_queue_depth', 'Updates waiting or running per chat, for chats with a backlog.',
+            ('chat_id', 'thread_id'),
+            lambda: {key: depth for key, depth in processor.chat_depths().items()}
+        )
+    dispatcher = application.bot.rate_limiter
+    if isinstance(dispatcher, OutboundDispatcher):
+        metrics.register_gauge(
+            'bot_outbound', 'Outbound Bot API calls sent, retried or dropped as no-ops.', ('stat',),
+            lambda: {(name,): value for name, value in dispatcher.stats.items()}
+        )
+    await metrics.start_metrics_server()
 
-    application = ApplicationBuilder().token(TOKEN).post_init(post_init).build()
+def build_application(token, update_queue_size=0, base_url=None, max_concurrent_updates=1, persistence=None,
+                      request=None, instrument=False, rate_limiter=None):
+    """
+    Builds the Application with all handlers registered.
+    update_queue_size > 0 bounds the update queue so producers wait when handlers fall behind.
+    max_concurrent_updates > 1 runs different chats in parallel, keeping each chat in order.
+    With a persistence, conversation states and user/chat data survive restarts.
+    request replaces the HTTP client used for Bot API calls, e.g. with a local fake.
+    instrument wraps handlers and Bot API calls with metrics; leave it off when metrics are disabled.
+    rate_limiter paces outbound calls, e.g. an OutboundDispatcher.
+    """
+    builder = ApplicationBuilder().token(token).post_init(post_init)
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    if max_concurrent_updates > 1:
+        processor = ChatOrderedUpdateProcessor(max_concurrent_updates)
+        builder = builder.concurrent_updates(processor).update_queue(processor.create_queue(update_queue_size))
+    elif update_queue_size > 0:
+        builder = builder.update_queue(asyncio.Queue(maxsize=update_queue_size))
+    if base_url:
+        builder = builder.base_url(base_url)
+    if instrument:
+        request = metrics.InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256))
+    if request is not None:
+        builder = builder.request(request)
+    if rate_limiter is not None:
+        builder = builder.rate_limiter(rate_limiter)
+    application = builder.build()
 
     pay_handler = ConversationHandler(
         entry_points=[CommandHandler('pay', start_pay)],
@@ -87,7 +183,9 @@ if __name__ == '__main__':
             ENTER_CONSUMER_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, enter_consumer_amount)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='pay',
+        persistent=persistence is not None
     )
     application.add_handler(pay_handler)
 
@@ -96,9 +194,12 @@ if __name__ == '__main__':
         states={
             SELECT_SETTLE_CURRENCY: [CallbackQueryHandler(select_settle_currency)],
             ENTER_RATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, store_rate)],
+            CONFIRM_SETTLEMENT: [CallbackQueryHandler(confirm_settlement_callback)],
         },
         fallbacks =[CommandHandler('cancel', cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='settle',
+        persistent=persistence is not None
     )
     application.add_handler(settle_handler)
 
@@ -110,12 +211,60 @@ if __name__ == '__main__':
             LIST_PAGE: [CallbackQueryHandler(list_pagination_callback)]
         },
         fallbacks =[CommandHandler('close', close_list)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='list',
+        persistent=persistence is not None
     )
     application.add_handler(list_handler)
 
+    application.add_handler(CommandHandler('rebuildbalances', rebuild_balances_command))
     application.add_handler(CommandHandler('register', register))
+    application.add_handler(CommandHandler('export', export_command))
+    application.add_handler(CommandHandler('import', import_command))
+    # Commands in a document's caption aren't seen by CommandHandler
+    application.add_handler(MessageHandler(
+        filters.Document.ALL & filters.CaptionRegex(r'^/import(@\w+)?(\s|$)'), import_command
+    ))
     application.add_handler(CommandHandler('help', help))
 
+    if instrument:
+        metrics.instrument_handlers(application)
+    return application
+
+if __name__ == '__main__':
+    if not TOKEN:
+        print("Error: BOT_TOKEN missing.")
+        exit(1)
+    webhook_mode = os.getenv('BOT_MODE', 'polling') == 'webhook'
+    if webhook_mode and not os.getenv('WEBHOOK_SECRET'):
+        # Without it anyone who finds the URL can post fake updates
+        print("Error: WEBHOOK_SECRET missing; webhook mode requires a secret token.")
+        exit(1)
+
+    persistence = None
+    if env_flag('BOT_PERSISTENCE', True):
+        persistence = DatabasePersistence(DB_URL, update_interval=float(os.getenv('PERSISTENCE_FLUSH_INTERVAL', '10')))
+
+    application = build_application(
+        TOKEN,
+        update_queue_size=int(os.getenv('UPDATE_QUEUE_SIZE', '256')),
+        base_url=os.getenv('BOT_API_BASE_URL'),
+        max_concurrent_updates=int(os.getenv('MAX_CONCURRENT_UPDATES', '16')),
+        persistence=persistence,
+        instrument=bool(metrics.METRICS_PORT),
+        rate_limiter=OutboundDispatcher() if env_flag('OUTBOUND_DISPATCHER', True) else None
+    )
+
     print("Bot is starting...")
-    application.run_polling()
\ No newline at end of file
+    if webhook_mode:
+        asyncio.run(run_webhook(
+            application,
+            listen=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.getenv('WEBHOOK_PORT', '8443')),
+            path=os.getenv('WEBHOOK_PATH', '/telegram'),
+            secret_token=os.getenv('WEBHOOK_SECRET'),
+            webhook_url=os.getenv('WEBHOOK_URL'),
+            put_timeout=float(os.getenv('WEBHOOK_PUT_TIMEOUT', '5'))
+        ))
+    else:
+        application.run_polling()
@@ -0,0 +1,100 @@
+"""
+Compares the per-object ORM write path of create_full_transaction with the bulk path.
+
+    python benchmarks/bench_insert.py --db-url postgresql+asyncpg://... --sizes 2 20 200
+
+Defaults to a throwaway SQLite file. Prints one JSON object per (size, path).
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import database
+from database import (
+    init_db, get_session, get_chat_users, upsert_user, create_full_transaction,
+    build_transaction_records, apply_balance_deltas, record_deltas,
+    PayRecord, PaymentGroup, PaymentGroupLink
+)
+
+async def legacy_create_full_transaction(chat_id, thread_id, payer_id, payee_id_or_split, currency, total_amount, description):
+    """
+    The previous write path: add the group, flush, add each record, flush, add each link.
+    """
+    async with get_session() as session:
+        group = PaymentGroup(chat_id=chat_id, thread_id=thread_id, name=description)
+        session.add(group)
+        await session.flush()
+
+        chat_users = await get_chat_users(session, chat_id, thread_id)
+        created_records = []
+        for payee_id, value in build_transaction_records(payer_id, payee_id_or_split, currency, total_amount, chat_users):
+            record = PayRecord(
+                chat_id=chat_id, thread_id=thread_id, from_user_id=payer_id,
+                to_user_id=payee_id, currency=currency, value=value
+            )
+            session.add(record)
+            created_records.append(record)
+        await session.flush()
+
+        for rec in created_records:
+            session.add(PaymentGroupLink(group_id=group.group_id, pay_record_id=rec.pay_record_id))
+
+        await apply_balance_deltas(session, chat_id, thread_id, record_deltas(
+            (rec.from_user_id, rec.to_user_id, rec.currency, rec.value) for rec in created_records
+        ))
+        await session.commit()
+        return len(created_records)
+
+PATHS = {
+    'orm_per_object': legacy_create_full_transaction,
+    'bulk': create_full_transaction,
+}
+
+async def run(args):
+    await init_db(args.db_url)
+
+    for size in args.sizes:
+        chat_id = -1000 - size
+        for user_id in range(1, size + 1):
+            await upsert_user(user_id, chat_id, None, f"user{user_id}")
+
+        for name, create in PATHS.items():
+            # Warm up connections and statement caches
+            await create(chat_id, None, 1, {'type': 'SPLIT_ALL'}, 'SGD', 100, 'warmup')
+
+            timings = []
+            for i in range(args.repeat):
+                start = time.perf_counter()
+                await create(chat_id, None, 1 + i % size, {'type': 'SPLIT_ALL'}, 'SGD', 123.45, f'bench {i}')
+                timings.append(time.perf_counter() - start)
+            print(json.dumps({
+                'dialect': database.engine.dialect.name,
+                'group_size': size,
+                'path': name,
+                'median_ms': round(statistics.median(timings) * 1000, 3),
+                'p95_ms': round(sorted(timings)[int(len(timings) * 0.95) - 1] * 1000, 3),
+            }))
+
+    await database.engine.dispose()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-url')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2, 20, 200])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.db_url is None:
+        path = os.path.join(tempfile.mkdtemp(), 'bench_insert.db')
+        args.db_url = f"sqlite+aiosqlite:///{path}"
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+Times the /list, /settle and /pay hot paths against a synthetic ledger.
+
+    python benchmarks/bench_ledger.py --users 8 --records 5000 --currencies SGD USD EUR JPY
+
+Defaults to a throwaway aiosqlite file; --db-url must point at an empty database.
+Prints one JSON object per measurement, so runs can be diffed against each other.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import database
+from database import (
+    init_db, get_session, upsert_user, create_full_transaction, delete_last_transaction,
+    apply_balance_deltas, record_deltas, PayRecord, PaymentGroup, PaymentGroupLink
+)
+from sqlalchemy import insert
+from list import generate_ledger_view, decode_page_callback, ITEMS_PER_PAGE
+from money import from_minor
+from settle import load_settle_balances
+from settlement import plan_settlement
+
+CHUNK = 500
+
+async def insert_returning_ids(session, model, id_column, rows):
+    ids = []
+    for i in range(0, len(rows), CHUNK):
+        stmt = insert(model).returning(id_column, sort_by_parameter_order=True)
+        result = await session.execute(stmt, rows[i:i + CHUNK])
+        ids.extend(result.scalars().all())
+    return ids
+
+async def generate_chat(chat_id, args, rng):
+    """
+    Fills one chat with users, then payment groups until it holds args.records pay records.
+    Timestamps increase by a minute per group, like a long-running trip ledger.
+    """
+    user_ids = list(range(1, args.users + 1))
+    for user_id in user_ids:
+        await upsert_user(user_id, chat_id, None, f"user{user_id}")
+
+    start = datetime.utcnow() - timedelta(minutes=args.records)
+    groups = []
+    group_records = []
+    remaining = args.records
+    while remaining > 0:
+        size = min(remaining, rng.randint(args.min_group_size, min(args.max_group_size, args.users)))
+        currency = rng.choice(args.currencies)
+        payer = rng.choice(user_ids)
+        when = start + timedelta(minutes=len(groups))
+        groups.append(dict(chat_id=chat_id, thread_id=0, name=f"expense {len(groups)}",
+                           gmt_created=when, gmt_modified=when))
+        group_records.append([
+            dict(chat_id=chat_id, thread_id=0, from_user_id=payer, to_user_id=payee,
+                 currency=currency, value=from_minor(rng.randint(100, 20000), currency),
+                 gmt_created=when, gmt_modified=when)
+            for payee in rng.sample(user_ids, size)
+        ])
+        remaining -= size
+
+    async with get_session() as session:
+        group_ids = await insert_returning_ids(session, PaymentGroup, PaymentGroup.group_id, groups)
+        records = [record for chunk in group_records for record in chunk]
+        record_ids = await insert_returning_ids(session, PayRecord, PayRecord.pay_record_id, records)
+
+        links = []
+        ids = iter(record_ids)
+        for group_id, chunk in zip(group_ids, group_records):
+            links.extend(dict(group_id=group_id, pay_record_id=next(ids)) for _ in chunk)
+        for i in range(0, len(links), CHUNK):
+            await session.execute(insert(PaymentGroupLink), links[i:i + CHUNK])
+
+        await apply_balance_deltas(session, chat_id, None, record_deltas(
+            (r['from_user_id'], r['to_user_id'], r['currency'], r['value']) for r in records
+        ))
+        await session.commit()
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        'median_ms': round(statistics.median(timings) * 1000, 3),
+        'p95_ms': round(timings[max(0, int(len(timings) * 0.95) - 1)] * 1000, 3),
+        'min_ms': round(timings[0] * 1000, 3),
+    }
+
+async def measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+def next_page_callback(markup):
+    for button in markup.inline_keyboard[0]:
+        if button.callback_data.startswith('list_n_'):
+            return button.callback_data
+    return None
+
+async def run(args):
+    rng = random.Random(args.seed)
+    await init_db(args.db_url)
+
+    setup_start = time.perf_counter()
+    chat_ids = [-1000 - i for i in range(args.chats)]
+    for chat_id in chat_ids:
+        await generate_chat(chat_id, args, rng)
+    chat_id = chat_ids[0]
+
+    common = {
+        'dialect': database.engine.dialect.name,
+        'chats': args.chats,
+        'users': args.users,
+        'records': args.records,
+        'currencies': len(args.currencies),
+        'group_size': [args.min_group_size, args.max_group_size],
+    }
+
+    def emit(bench, case, result):
+        print(json.dumps({'bench': bench, 'case': case, **common, **result}), flush=True)
+
+    emit('setup', 'generate', {'seconds': round(time.perf_counter() - setup_start, 3)})
+
+    # /list renders straight from generate_ledger_view so the render cache is bypassed
+    total_pages = -(-args.records // ITEMS_PER_PAGE)
+    middle = max(1, total_pages // 2)
+    for case, page in (('first_page', 1), ('middle_page', middle), ('last_page', total_pages)):
+        emit('ledger_view', case, await measure(
+            lambda page=page: generate_ledger_view(chat_id, None, page), args.repeat
+        ))
+
+    _, markup = await generate_ledger_view(chat_id, None, middle)
+    callback = next_page_callback(markup)
+    if callback:
+        page, cursor = decode_page_callback(callback)
+        emit('ledger_view', 'middle_next_cursor', await measure(
+            lambda: generate_ledger_view(chat_id, None, page, cursor), args.repeat
+        ))
+
+    # /settle: balance loading and conversion, then the transfer plan
+    target = args.currencies[0]
+    rates = {f"{currency}_{target}": Decimal(1) + Decimal(i) / 10 for i, currency in enumerate(args.currencies)}
+
+    async def balance_stage():
+        async with get_session() as session:
+            return await load_settle_balances(session, chat_id, None, target, rates)
+
+    emit('settle', 'balance_stage', await measure(balance_stage, args.repeat))
+    balances = await balance_stage()
+
+    async def plan_stage():
+        plan_settlement(balances)
+
+    emit('settle', 'plan_stage', await measure(plan_stage, args.repeat))
+
+    # /pay and /undo: create a split-all group, then remove it again so the ledger stays the same size
+    create_timings = []
+    delete_timings = []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        await create_full_transaction(chat_id, None, 1 + i % args.users, {'type': 'SPLIT_ALL'}, target, 123.45, f'bench {i}')
+        create_timings.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await delete_last_transaction(1, chat_id, None)
+        delete_timings.append(time.perf_counter() - start)
+
+    emit('pay', 'create_full_transaction', summarize(create_timings))
+    emit('pay', 'delete_last_transaction', summarize(delete_timings))
+
+    await database.engine.dispose()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-url')
+    parser.add_argument('--chats', type=int, default=1)
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--currencies', nargs='+', default=['SGD', 'USD', 'EUR', 'JPY'])
+    parser.add_argument('--records', type=int, default=5000, help='pay records per chat')
+    parser.add_argument('--min-group-size', type=int, default=1)
+    parser.add_argument('--max-group-size', type=int, default=6)
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.db_url is None:
+        path = os.path.join(tempfile.mkdtemp(), 'bench_ledger.db')
+        args.db_url = f"sqlite+aiosqlite:///{path}"
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
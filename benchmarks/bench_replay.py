@@ -0,0 +1,272 @@
+"""
+End-to-end load test: replays scripted conversations across many chats against the real
+Application from app.py, with the Bot API replaced by an in-process fake.
+
+    python benchmarks/bench_replay.py --chats 2000 --users 4 --pays 3 --latency 0.02
+
+Each chat registers its users, records payments through the full /pay conversation, pages
+through /list, runs /settle (answering any rate prompt) and finally /undo. Prints JSON with
+p50/p95/p99 latency per handler step, updates per second and DB queries per update.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import contextvars
+from collections import defaultdict
+from sqlalchemy import event
+from telegram import Update
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app
+import database
+import metrics
+import querybudget
+from outbound import OutboundDispatcher
+from fake_bot_api import FakeBotAPI, BOT_USER
+
+# [count] for the update currently being processed in this task
+query_counter = contextvars.ContextVar('query_counter', default=None)
+
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    counter = query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+class ChatAborted(Exception):
+    pass
+
+class Replay:
+    def __init__(self, application, fake, args):
+        self.application = application
+        self.fake = fake
+        self.args = args
+        self.update_id = 0
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(int)
+        self.aborted = 0
+
+    def _next_update_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    async def send(self, step, data):
+        update = Update.de_json(data, self.application.bot)
+        counter = [0]
+        token = query_counter.set(counter)
+        start = time.perf_counter()
+        try:
+            # Same path the update fetcher uses, so per-chat ordering and limits apply
+            await self.application.update_processor.process_update(
+                update, self.application.process_update(update)
+            )
+        finally:
+            self.latencies[step].append(time.perf_counter() - start)
+            self.queries[step] += counter[0]
+            query_counter.reset(token)
+
+    async def text(self, step, chat_id, user, text):
+        message = {
+            'message_id': self._next_update_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup'},
+            'from': user,
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        await self.send(step, {'update_id': self._next_update_id(), 'message': message})
+
+    async def click(self, step, chat_id, user, label, required=True):
+        found = self.fake.find_button(chat_id, label)
+        if found is None:
+            if required:
+                raise ChatAborted(f"{step}: no '{label}' button in chat {chat_id}")
+            return False
+        message_id, callback_data = found
+        await self.send(step, {
+            'update_id': self._next_update_id(),
+            'callback_query': {
+                'id': str(self._next_update_id()),
+                'from': user,
+                'chat_instance': str(chat_id),
+                'data': callback_data,
+                'message': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'supergroup'},
+                    'from': BOT_USER,
+                    'text': '',
+                },
+            },
+        })
+        return True
+
+    async def run_chat(self, index):
+        args = self.args
+        chat_id = -1000000 - index
+        users = [
+            {'id': index * 100 + i + 1, 'is_bot': False, 'first_name': f"U{i}"}
+            for i in range(args.users)
+        ]
+        names = [f"user{i}" for i in range(args.users)]
+        first = users[0]
+
+        for user, name in zip(users, names):
+            await self.text('register', chat_id, user, f"/register {name}")
+
+        for k in range(args.pays):
+            currency = args.currencies[k % len(args.currencies)]
+            await self.text('pay', chat_id, first, '/pay')
+            await self.click('select_payer', chat_id, first, names[k % len(names)])
+            await self.text('enter_comment', chat_id, first, f"expense {k}")
+            await self.text('enter_amount', chat_id, first, f"{10 + k}.50")
+            await self.click('select_currency', chat_id, first, currency)
+            if k % 2:
+                await self.click('select_payee', chat_id, first, '👨‍👩‍👧‍👦 Split Equally')
+            else:
+                payee = names[(k + 1) % len(names)]
+                await self.click('select_payee', chat_id, first, payee)
+
+        await self.text('list', chat_id, first, '/list')
+        for _ in range(args.list_pages):
+            if not await self.click('list_page', chat_id, first, '⬅️ Prev', required=False):
+                break
+
+        await self.text('settle', chat_id, first, '/settle')
+        await self.click('select_settle_currency', chat_id, first, args.currencies[0])
+        for _ in range(len(args.currencies)):
+            _, text, _ = self.fake.last_message(chat_id)
+            if not text or 'exchange rate' not in text:
+                break
+            await self.text('store_rate', chat_id, first, '1.25')
+
+        await self.text('undo', chat_id, first, '/undo')
+
+    async def run_chat_guarded(self, index, slots):
+        async with slots:
+            try:
+                await self.run_chat(index)
+            except ChatAborted as e:
+                self.aborted += 1
+                if self.aborted <= 5:
+                    print(f"Aborted: {e}", file=sys.stderr)
+
+    def report(self, elapsed):
+        steps = {}
+        total_updates = 0
+        total_queries = 0
+        for step, values in self.latencies.items():
+            values.sort()
+            total_updates += len(values)
+            total_queries += self.queries[step]
+            steps[step] = {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+                'queries_per_update': round(self.queries[step] / len(values), 2),
+            }
+        return {
+            'dialect': database.engine.dialect.name,
+            'chats': self.args.chats,
+            'aborted_chats': self.aborted,
+            'updates': total_updates,
+            'seconds': round(elapsed, 3),
+            'updates_per_second': round(total_updates / elapsed, 1) if elapsed else None,
+            'queries_per_update': round(total_queries / total_updates, 2) if total_updates else None,
+            'steps': steps,
+            'bot_api': self.fake.stats(),
+            'outbound': self.application.bot.rate_limiter.stats if self.application.bot.rate_limiter else None,
+            'db_pools': database.get_pool_stats(),
+            'query_budget_violations': [
+                {'handler': name, 'statements': statements, 'rows': rows, 'budget': list(limits)}
+                for name, statements, rows, limits in querybudget.violations[:20]
+            ],
+        }
+
+async def run(args):
+    fake = FakeBotAPI(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        retry_after_rate=args.retry_after_rate, seed=args.seed
+    )
+    app.DB_URL = args.db_url
+    database.READ_DATABASE_URL = args.read_db_url
+    querybudget.QUERY_BUDGET = args.query_budget
+    dispatcher = None
+    if args.outbound:
+        dispatcher = OutboundDispatcher(
+            global_rate=args.outbound_rate, global_burst=int(args.outbound_rate),
+            chat_rate=args.outbound_chat_rate, chat_burst=max(1, int(args.outbound_chat_rate))
+        )
+    application = app.build_application(
+        '123456:REPLAY', max_concurrent_updates=args.concurrency, request=fake, instrument=args.instrument,
+        rate_limiter=dispatcher
+    )
+
+    await application.initialize()
+    await app.post_init(application)
+    if args.instrument:
+        for engine in database.get_engines():
+            metrics.instrument_engine(engine)
+    await application.start()
+    for engine in database.get_engines():
+        event.listen(engine.sync_engine, 'before_cursor_execute', count_queries)
+
+    replay = Replay(application, fake, args)
+    slots = asyncio.Semaphore(args.active_chats)
+    start = time.perf_counter()
+    await asyncio.gather(*(replay.run_chat_guarded(i, slots) for i in range(args.chats)))
+    elapsed = time.perf_counter() - start
+
+    await application.stop()
+    await application.shutdown()
+    report = replay.report(elapsed)
+    print(json.dumps(report, indent=2))
+    if args.instrument:
+        print(metrics.render().decode())
+    await database.dispose_db()
+    return not (args.query_budget == querybudget.RAISE and querybudget.violations)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-url')
+    parser.add_argument('--read-db-url', help='separate engine for read-only paths, e.g. a replica of --db-url')
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--pays', type=int, default=3, help='/pay conversations per chat')
+    parser.add_argument('--currencies', nargs='+', default=['SGD', 'USD'])
+    parser.add_argument('--list-pages', type=int, default=2)
+    parser.add_argument('--active-chats', type=int, default=200, help='chats replaying at the same time')
+    parser.add_argument('--concurrency', type=int, default=16, help='MAX_CONCURRENT_UPDATES for the Application')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake Bot API latency per call (s)')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--query-budget', choices=[querybudget.OFF, querybudget.LOG, querybudget.RAISE],
+                        default=querybudget.OFF, help="'raise' exits non-zero on any budget breach")
+    parser.add_argument('--outbound', action='store_true', help='route Bot API calls through the OutboundDispatcher')
+    parser.add_argument('--outbound-rate', type=float, default=1000.0, help='global outbound calls per second')
+    parser.add_argument('--outbound-chat-rate', type=float, default=100.0, help='outbound calls per second per chat')
+    parser.add_argument('--instrument', action='store_true', help='enable metrics and print them at the end')
+    args = parser.parse_args()
+
+    if args.db_url is None:
+        path = os.path.join(tempfile.mkdtemp(), 'bench_replay.db')
+        args.db_url = f"sqlite+aiosqlite:///{path}"
+    if not asyncio.run(run(args)):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Microbenchmarks for the settlement solvers in settlement.py.
+
+    python benchmarks/bench_settlement.py --sizes 4 8 12 16 20 30 100 --repeat 5
+
+Prints one JSON object per (size, solver) with the median latency and plan size.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from settlement import greedy_transfers, exact_transfers, heuristic_transfers, plan_settlement
+
+def trip_balances(n_users, rng, expenses_per_user=5):
+    """
+    Balances produced by a synthetic trip: random payers, expenses split equally among
+    random subsets, in cents. Mimics the round amounts real groups produce.
+    """
+    balances = {uid: 0 for uid in range(n_users)}
+    for _ in range(n_users * expenses_per_user):
+        payer = rng.randrange(n_users)
+        consumers = rng.sample(range(n_users), rng.randint(1, n_users))
+        share = rng.choice([500, 1000, 1250, 2000, 3000]) * rng.randint(1, 4)
+        for consumer in consumers:
+            balances[payer] += share
+            balances[consumer] -= share
+    return balances
+
+def random_balances(n_users, rng):
+    """
+    Arbitrary cent balances; zero-sum subgroups are rare, the solver's easy case.
+    """
+    values = [rng.randint(-50000, 50000) for _ in range(n_users - 1)]
+    values.append(-sum(values))
+    return dict(enumerate(values))
+
+def dense_balances(n_users, rng):
+    """
+    Balances of 1, 2 and -3 units with no opposite pairs: zero-sum subgroups are everywhere,
+    the exact solver's worst case.
+    """
+    values = [rng.choice([1, 2, -3]) for _ in range(n_users - 1)]
+    values.append(-sum(values) or 3)
+    if values[-1] == 3:
+        values[0] -= 3
+    return dict(enumerate(values))
+
+SOLVERS = {
+    'greedy': greedy_transfers,
+    'exact': exact_transfers,
+    'heuristic': heuristic_transfers,
+    'auto': lambda balances: plan_settlement(balances, 'auto').transfers,
+}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 12, 16, 20, 30, 100, 500])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--exact-limit', type=int, default=22, help="Skip the exact solver above this size")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for distribution, generate in (('trip', trip_balances), ('random', random_balances), ('dense', dense_balances)):
+        for size in args.sizes:
+            samples = [generate(size, rng) for _ in range(args.repeat)]
+            for name, solver in SOLVERS.items():
+                if name == 'exact' and size > args.exact_limit:
+                    continue
+                timings = []
+                transfers = []
+                for balances in samples:
+                    start = time.perf_counter()
+                    plan = solver(balances)
+                    timings.append(time.perf_counter() - start)
+                    transfers.append(len(plan))
+                print(json.dumps({
+                    'distribution': distribution,
+                    'users': size,
+                    'solver': name,
+                    'median_ms': round(statistics.median(timings) * 1000, 3),
+                    'max_ms': round(max(timings) * 1000, 3),
+                    'mean_transfers': round(statistics.mean(transfers), 2),
+                }))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Concurrent /pay commits and /list reads against a SQLite file, under each SQLite mode.
+
+    python benchmarks/bench_sqlite.py --writers 32 --pays 40 --readers 8
+
+Every writer records --pays split-equally payments in a chat of its own through
+create_full_transaction, while the readers render ledger pages of random chats through
+generate_ledger_view until the writers are done. Runs once per configuration on a fresh
+database file:
+
+    default        SQLite's own journal settings and SQLAlchemy's default pool
+    pragmas        SQLITE_PRAGMAS (WAL, synchronous=NORMAL, mmap, cache, busy_timeout)
+    single_writer  SQLITE_PRAGMAS plus SQLITE_SINGLE_WRITER (write transactions queue on an in-process lock)
+
+Prints one JSON object per configuration.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import database
+from database import init_db, upsert_user, create_full_transaction
+from list import generate_ledger_view
+
+CONFIGS = {
+    'default': dict(SQLITE_PRAGMAS=False, SQLITE_SINGLE_WRITER=False),
+    'pragmas': dict(SQLITE_PRAGMAS=True, SQLITE_SINGLE_WRITER=False),
+    'single_writer': dict(SQLITE_PRAGMAS=True, SQLITE_SINGLE_WRITER=True),
+}
+
+def percentile_ms(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))] * 1000, 3)
+
+async def run_config(name, index, args):
+    for setting, value in CONFIGS[name].items():
+        setattr(database, setting, value)
+    path = os.path.join(tempfile.mkdtemp(), f"bench_sqlite_{name}.db")
+    await init_db(f"sqlite+aiosqlite:///{path}")
+
+    # Fresh chat ids per configuration, so no in-process cache carries over
+    chat_ids = [-(index + 1) * 1000000 - i for i in range(args.writers)]
+    for chat_id in chat_ids:
+        for user_id in range(1, args.users + 1):
+            await upsert_user(user_id, chat_id, None, f"user{user_id}")
+
+    write_latencies, read_latencies = [], []
+    errors = {'locked': 0, 'other': 0}
+    writers_done = asyncio.Event()
+
+    async def writer(chat_id):
+        for k in range(args.pays):
+            start = time.perf_counter()
+            try:
+                await create_full_transaction(
+                    chat_id, None, 1 + k % args.users, {'type': 'SPLIT_ALL'}, 'SGD', 10 + k, f"expense {k}"
+                )
+                write_latencies.append(time.perf_counter() - start)
+            except OperationalError as e:
+                errors['locked' if 'locked' in str(e) else 'other'] += 1
+
+    async def reader(rng):
+        while not writers_done.is_set():
+            start = time.perf_counter()
+            try:
+                await generate_ledger_view(rng.choice(chat_ids), None, 1)
+                read_latencies.append(time.perf_counter() - start)
+            except OperationalError as e:
+                errors['locked' if 'locked' in str(e) else 'other'] += 1
+
+    async def writers():
+        await asyncio.gather(*(writer(chat_id) for chat_id in chat_ids))
+        writers_done.set()
+
+    start = time.perf_counter()
+    await asyncio.gather(writers(), *(reader(random.Random(args.seed + i)) for i in range(args.readers)))
+    elapsed = time.perf_counter() - start
+
+    pools = database.get_pool_stats()
+    await database.dispose_db()
+    write_latencies.sort()
+    read_latencies.sort()
+    return {
+        'bench': 'sqlite', 'config': name,
+        'writers': args.writers, 'pays': args.pays, 'readers': args.readers, 'users': args.users,
+        'seconds': round(elapsed, 3),
+        'writes': len(write_latencies),
+        'writes_per_second': round(len(write_latencies) / elapsed, 1),
+        'write_p50_ms': percentile_ms(write_latencies, 0.50),
+        'write_p95_ms': percentile_ms(write_latencies, 0.95),
+        'write_p99_ms': percentile_ms(write_latencies, 0.99),
+        'reads': len(read_latencies),
+        'reads_per_second': round(len(read_latencies) / elapsed, 1),
+        'read_p95_ms': percentile_ms(read_latencies, 0.95),
+        'locked_errors': errors['locked'],
+        'other_errors': errors['other'],
+        'writer_wait_seconds_max': pools.get('writer_wait_seconds_max'),
+    }
+
+async def run(args):
+    for index, name in enumerate(args.configs):
+        print(json.dumps(await run_config(name, index, args)), flush=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, default=32, help='concurrent /pay writers, one chat each')
+    parser.add_argument('--pays', type=int, default=40, help='payments per writer')
+    parser.add_argument('--readers', type=int, default=8, help='concurrent /list readers')
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGS), default=list(CONFIGS))
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Runs the query plan checks of tests/test_query_plans.py against a PostgreSQL database.
+
+    python benchmarks/check_plans.py --db-url postgresql+asyncpg://localhost/plans
+    python benchmarks/check_plans.py --db-url postgresql+asyncpg://localhost/plans --from-baseline
+
+The test suite checks the SQLite schema; this is the optional PostgreSQL counterpart, with
+larger chats filled like bench_ledger.py. Prints one JSON object per step, the plans of failing
+steps on stderr, and exits non-zero on any failure.
+
+--from-baseline first creates the ledger tables as they were before migrations.py existed,
+so the indexes checked are the ones the migrations give an upgraded database.
+"""
+import os
+import sys
+import json
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from database import init_db
+from bench_ledger import generate_chat
+from baseline_schema import create_baseline
+from test_query_plans import analyze, check_steps
+
+async def run(args):
+    rng = random.Random(args.seed)
+    if args.from_baseline:
+        await create_baseline(args.db_url)
+    await init_db(args.db_url)
+    chat_ids = [-1000 - i for i in range(args.chats)]
+    for chat_id in chat_ids:
+        await generate_chat(chat_id, args, rng)
+    await analyze()
+
+    ok = True
+    for result in await check_steps(chat_ids[len(chat_ids) // 2], args.records):
+        passed = bool(result['statements']) and not result['missing_indexes'] and not result['full_scans']
+        ok &= passed
+        print(json.dumps({
+            'check': result['check'], 'ok': passed, 'dialect': database.engine.dialect.name,
+            'statements': result['statements'], 'missing_indexes': result['missing_indexes'],
+            'full_scans': result['full_scans'],
+        }), flush=True)
+        if not passed:
+            for statement, plan in result['plans']:
+                print(f"--- {' '.join(statement.split())[:200]}\n" + '\n'.join(plan), file=sys.stderr)
+
+    await database.dispose_db()
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-url', required=True, help='a PostgreSQL URL; the tests cover SQLite')
+    parser.add_argument('--from-baseline', action='store_true', help='upgrade the pre-migrations schema first')
+    parser.add_argument('--chats', type=int, default=4)
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--currencies', nargs='+', default=['SGD', 'USD', 'EUR', 'JPY'])
+    parser.add_argument('--records', type=int, default=5000, help='pay records per chat')
+    parser.add_argument('--min-group-size', type=int, default=1)
+    parser.add_argument('--max-group-size', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if not asyncio.run(run(args)):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
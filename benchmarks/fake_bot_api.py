@@ -0,0 +1,163 @@
+"""
+In-process stand-in for the Telegram Bot API, plugged in as the Application's request object.
+
+Answers getMe, sendMessage, editMessageText, deleteMessage and answerCallbackQuery with
+configurable latency and injected failures, and remembers what the bot last showed in each
+chat so a driver can "press" the buttons it sent.
+"""
+import json
+import time
+import random
+import asyncio
+from collections import Counter, defaultdict
+from telegram.request import BaseRequest
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+
+class FakeBotAPI(BaseRequest):
+    """
+    latency/jitter are in seconds per call. error_rate answers 500, retry_after_rate answers
+    429 with retry_after=1; both are drawn per call from a seeded RNG.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, retry_after_rate=0.0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.failures = Counter()
+        self.call_seconds = defaultdict(float)
+        # chat_id -> {message_id: (text, reply_markup)}
+        self.messages = defaultdict(dict)
+        # chat_id -> message_id of the message the bot sent or edited most recently
+        self.last_message_id = {}
+        self._next_message_id = defaultdict(lambda: 1000)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        start = time.perf_counter()
+        self.calls[api_method] += 1
+
+        delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        roll = self.rng.random()
+        if api_method != 'getMe':
+            if roll < self.error_rate:
+                self.failures[api_method] += 1
+                return self._reply(500, error='Internal Server Error: injected')
+            if roll < self.error_rate + self.retry_after_rate:
+                self.failures[api_method] += 1
+                return self._reply(429, error='Too Many Requests: retry after 1', retry_after=1)
+
+        handler = getattr(self, f"api_{api_method}", None)
+        status, body = handler(params) if handler else self._reply(200, result=True)
+        self.call_seconds[api_method] += time.perf_counter() - start
+        return status, body
+
+    def _reply(self, status, result=None, error=None, retry_after=None):
+        if error is None:
+            return status, json.dumps({'ok': True, 'result': result}).encode()
+        payload = {'ok': False, 'error_code': status, 'description': error}
+        if retry_after is not None:
+            payload['parameters'] = {'retry_after': retry_after}
+        return status, json.dumps(payload).encode()
+
+    def _message(self, chat_id, message_id, text, reply_markup, thread_id=None):
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup'},
+            'from': BOT_USER,
+            'text': text,
+        }
+        if reply_markup:
+            message['reply_markup'] = reply_markup
+        if thread_id:
+            message['message_thread_id'] = thread_id
+        return message
+
+    @staticmethod
+    def _markup(params):
+        markup = params.get('reply_markup')
+        return json.loads(markup) if isinstance(markup, str) else markup
+
+    def api_getMe(self, params):
+        return self._reply(200, result=BOT_USER)
+
+    def api_sendMessage(self, params):
+        chat_id = int(params['chat_id'])
+        message_id = self._next_message_id[chat_id]
+        self._next_message_id[chat_id] += 1
+        markup = self._markup(params)
+        self.messages[chat_id][message_id] = (params['text'], markup)
+        self.last_message_id[chat_id] = message_id
+        return self._reply(200, result=self._message(
+            chat_id, message_id, params['text'], markup, params.get('message_thread_id')
+        ))
+
+    def api_editMessageText(self, params):
+        chat_id = int(params['chat_id'])
+        message_id = int(params['message_id'])
+        markup = self._markup(params)
+        if self.messages[chat_id].get(message_id) == (params['text'], markup):
+            self.failures['editMessageText'] += 1
+            return self._reply(400, error='Bad Request: message is not modified')
+        self.messages[chat_id][message_id] = (params['text'], markup)
+        self.last_message_id[chat_id] = message_id
+        return self._reply(200, result=self._message(chat_id, message_id, params['text'], markup))
+
+    def api_deleteMessage(self, params):
+        chat_id = int(params['chat_id'])
+        if self.messages[chat_id].pop(int(params['message_id']), None) is None:
+            self.failures['deleteMessage'] += 1
+            return self._reply(400, error='Bad Request: message to delete not found')
+        return self._reply(200, result=True)
+
+    def api_answerCallbackQuery(self, params):
+        return self._reply(200, result=True)
+
+    def last_message(self, chat_id):
+        """
+        (message_id, text, reply_markup dict or None) the bot last sent or edited in the chat.
+        """
+        message_id = self.last_message_id.get(chat_id)
+        if message_id is None or message_id not in self.messages[chat_id]:
+            return None, None, None
+        text, markup = self.messages[chat_id][message_id]
+        return message_id, text, markup
+
+    def find_button(self, chat_id, label):
+        """
+        (message_id, callback_data) of the first button on the latest message whose text starts with label.
+        """
+        message_id, _, markup = self.last_message(chat_id)
+        for row in (markup or {}).get('inline_keyboard', []):
+            for button in row:
+                if button['text'].startswith(label):
+                    return message_id, button['callback_data']
+        return None
+
+    def stats(self):
+        return {
+            'calls': dict(self.calls),
+            'failures': dict(self.failures),
+            'mean_ms': {
+                name: round(self.call_seconds[name] / count * 1000, 3)
+                for name, count in self.calls.items() if count
+            },
+        }
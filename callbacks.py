@@ -0,0 +1,101 @@
+import os
+import json
+import base64
+import binascii
+import secrets
+from telegram import InlineKeyboardButton
+
+from cache import LRUCache
+
+# Schema marker; bump the digit when the layout of encoded fields changes
+PREFIX = '~1'
+MAX_CALLBACK_BYTES = 64
+
+# Kinds: one character after the prefix, followed by '.'-separated base64url integers
+USER, SINGLE_PAYEE, SPLIT_ALL, SPLIT_AMOUNTS, CANCEL, FINISH, CONFIRM, TOKEN = 'U', 'S', 'A', 'M', 'X', 'F', 'Y', 'T'
+
+# Payloads that don't fit in callback_data are kept here and the button carries a short token
+callback_tokens = LRUCache(
+    maxsize=int(os.getenv('CALLBACK_TOKEN_CACHE_SIZE', '50000')),
+    ttl=float(os.getenv('CALLBACK_TOKEN_TTL', '86400'))
+)
+
+# (kind, excluded user_id, ((user_id, name), ...)) -> ((user_id, button), ...)
+keyboard_cache = LRUCache(maxsize=int(os.getenv('KEYBOARD_CACHE_SIZE', '4096')))
+
+def encode_int(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8 or 1, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+def decode_int(text):
+    return int.from_bytes(base64.urlsafe_b64decode(text + '=' * (-len(text) % 4)), 'big')
+
+def encode(kind, *values):
+    """
+    Packs a button action into callback data, e.g. encode(USER, 123456789) -> '~1UB1vNFQ'.
+    """
+    data = PREFIX + kind + '.'.join(encode_int(value) for value in values)
+    if len(data.encode()) <= MAX_CALLBACK_BYTES:
+        return data
+    token = secrets.token_urlsafe(6)
+    callback_tokens.set(token, data)
+    return PREFIX + TOKEN + token
+
+def decode_legacy(data):
+    """
+    Callback data of buttons sent before the compact schema: plain user ids, CANCEL,
+    FINISH_SPLIT and the JSON payee payloads.
+    """
+    if data == 'CANCEL':
+        return CANCEL, ()
+    if data == 'FINISH_SPLIT':
+        return FINISH, ()
+    if data.isdigit():
+        return USER, (int(data),)
+    if data.startswith('{'):
+        try:
+            payload = json.loads(data)
+            if payload['type'] == 'SINGLE_PAYEE':
+                return SINGLE_PAYEE, (int(payload['id']),)
+            return {'SPLIT_ALL': SPLIT_ALL, 'SPLIT_AMOUNTS': SPLIT_AMOUNTS}[payload['type']], ()
+        except (ValueError, KeyError, TypeError):
+            pass
+    return None, ()
+
+def decode(data):
+    """
+    Returns (kind, values). kind is None for data this schema doesn't know, an expired token
+    or a malformed payload, which callers treat as an expired button.
+    """
+    if not data.startswith(PREFIX):
+        return decode_legacy(data)
+    kind, body = data[len(PREFIX):len(PREFIX) + 1], data[len(PREFIX) + 1:]
+    if kind == TOKEN:
+        stored = callback_tokens.get(body)
+        return decode(stored) if stored is not None else (None, ())
+    try:
+        return kind, tuple(decode_int(part) for part in body.split('.') if part)
+    except (binascii.Error, ValueError):
+        return None, ()
+
+CANCEL_ROW = (InlineKeyboardButton("❌ Cancel", callback_data=encode(CANCEL)),)
+SPLIT_ROWS = (
+    (InlineKeyboardButton("👨‍👩‍👧‍👦 Split Equally (All)", callback_data=encode(SPLIT_ALL)),),
+    (InlineKeyboardButton("📝 Split by amounts", callback_data=encode(SPLIT_AMOUNTS)),),
+)
+
+def user_buttons(user_map, kind, exclude=None):
+    """
+    One button per user in user_map except exclude, labelled with the user's name.
+    Built once per roster, keyed by its contents so a rename or registration gets new
+    buttons; buttons are immutable so the tuples are shared, also between chats.
+    """
+    key = (kind, exclude, tuple(user_map.items()))
+    buttons = keyboard_cache.get(key)
+    if buttons is None:
+        buttons = tuple(
+            (user_id, InlineKeyboardButton(name, callback_data=encode(kind, user_id)))
+            for user_id, name in user_map.items() if user_id != exclude
+        )
+        keyboard_cache.set(key, buttons)
+    return buttons
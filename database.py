@@ -1,11 +1,23 @@
 import os
+import time
+import asyncio
+from collections import defaultdict, namedtuple
 from datetime import datetime
+from itertools import batched
 from sqlalchemy import (
-    select, delete, func, 
-    Column, BigInteger, String, DateTime, Numeric, Integer, ForeignKey, Index
+    select, insert, delete, func, union_all, literal, true, bindparam, text, event,
+    Column, BigInteger, String, DateTime, Numeric, Integer, LargeBinary, ForeignKey, Index
 )
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from cache import LRUCache
+from migrations import migrate
+from money import to_minor, from_minor, split_evenly
 
 Base = declarative_base()
 
@@ -15,33 +27,48 @@ class PayRecord(Base):
     gmt_created = Column(DateTime, default=datetime.utcnow)
     gmt_modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     chat_id = Column(BigInteger, nullable=False)
-    thread_id = Column(Integer, nullable=True)
+    thread_id = Column(Integer, nullable=False, default=0)
     from_user_id = Column(BigInteger, nullable=False)
     to_user_id = Column(BigInteger, nullable=False)
     currency = Column(String(10), nullable=False)
     value = Column(Numeric(10, 2), nullable=False)
+    # Existing databases get indexes through migrations.py; keep both in step.
+    # AUTOINCREMENT keeps SQLite from reusing the ids of archived rows, which settlement
+    # checkpoints would then treat as settled
     __table_args__ = (
-        Index('idx_pay_context', 'chat_id', 'thread_id'),
+        Index('idx_pay_ledger', 'chat_id', 'thread_id', 'gmt_created', 'pay_record_id'),
+        Index('idx_pay_context_record', 'chat_id', 'thread_id', 'pay_record_id'),
         Index('idx_pay_from', 'from_user_id'),
         Index('idx_pay_to', 'to_user_id'),
+        {'sqlite_autoincrement': True},
     )
 
 class PaymentGroup(Base):
     __tablename__ = 'payment_groups'
     group_id = Column(Integer, primary_key=True, autoincrement=True)
     chat_id = Column(BigInteger, nullable=False)
-    thread_id = Column(Integer, nullable=True)
+    thread_id = Column(Integer, nullable=False, default=0)
     name = Column(String(255), nullable=False)
     gmt_created = Column(DateTime, default=datetime.utcnow)
-    __table_args__ = (
-        Index('idx_group_context', 'chat_id', 'thread_id'),
-    )
+    __table_args__ = {'sqlite_autoincrement': True}
+
+# Serves /undo's "latest group in this chat" lookup; group_id breaks gmt_created ties.
+# Like the cascades below, existing databases get it through migrations.py
+Index(
+    'idx_group_recent',
+    PaymentGroup.chat_id, PaymentGroup.thread_id, PaymentGroup.gmt_created.desc(), PaymentGroup.group_id.desc()
+)
 
 class PaymentGroupLink(Base):
     __tablename__ = 'payment_group_links'
     link_id = Column(Integer, primary_key=True, autoincrement=True)
-    group_id = Column(Integer, ForeignKey('payment_groups.group_id'), nullable=False)
-    pay_record_id = Column(Integer, ForeignKey('pay_records.pay_record_id'), nullable=False)
+    group_id = Column(Integer, ForeignKey('payment_groups.group_id', ondelete='CASCADE'), nullable=False)
+    pay_record_id = Column(Integer, ForeignKey('pay_records.pay_record_id', ondelete='CASCADE'), nullable=False)
+    __table_args__ = (
+        Index('idx_link_record', 'pay_record_id', 'group_id'),
+        Index('idx_link_group', 'group_id', 'pay_record_id'),
+        {'sqlite_autoincrement': True},
+    )
 
 class User(Base):
     __tablename__ = 'users'
@@ -55,39 +82,449 @@ class User(Base):
         Index('idx_user_context', 'chat_id', 'thread_id'),
     )
 
+class Balance(Base):
+    __tablename__ = 'balances'
+    chat_id = Column(BigInteger, primary_key=True)
+    thread_id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    currency = Column(String(10), primary_key=True)
+    value = Column(Numeric(14, 2), nullable=False, default=0)
+    gmt_modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SettlementCheckpoint(Base):
+    """
+    A confirmed settlement: every record up to last_pay_record_id has been paid out, so balances
+    restart from zero and only newer records count.
+    """
+    __tablename__ = 'settlement_checkpoints'
+    checkpoint_id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(BigInteger, nullable=False)
+    thread_id = Column(Integer, nullable=False)
+    last_pay_record_id = Column(Integer, nullable=False)
+    last_group_id = Column(Integer, nullable=False)
+    currency = Column(String(10))  # target currency of the confirmed plan
+    confirmed_by = Column(BigInteger)
+    gmt_created = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index('idx_checkpoint_context', 'chat_id', 'thread_id', 'checkpoint_id'),
+    )
+
+class CheckpointBalance(Base):
+    """
+    What each user was owed (+) or owed others (-) when the checkpoint was confirmed.
+    """
+    __tablename__ = 'checkpoint_balances'
+    checkpoint_id = Column(Integer, ForeignKey('settlement_checkpoints.checkpoint_id', ondelete='CASCADE'), primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    currency = Column(String(10), primary_key=True)
+    value = Column(Numeric(14, 2), nullable=False)
+
+# Settled history moved out of the hot tables when ARCHIVE_SETTLED is on; same columns plus the checkpoint
+class ArchivedPayRecord(Base):
+    __tablename__ = 'pay_records_archive'
+    pay_record_id = Column(Integer, primary_key=True)
+    gmt_created = Column(DateTime)
+    gmt_modified = Column(DateTime)
+    chat_id = Column(BigInteger, nullable=False)
+    thread_id = Column(Integer, nullable=False, default=0)
+    from_user_id = Column(BigInteger, nullable=False)
+    to_user_id = Column(BigInteger, nullable=False)
+    currency = Column(String(10), nullable=False)
+    value = Column(Numeric(10, 2), nullable=False)
+    checkpoint_id = Column(Integer, nullable=False, index=True)
+
+class ArchivedPaymentGroup(Base):
+    __tablename__ = 'payment_groups_archive'
+    group_id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False)
+    thread_id = Column(Integer, nullable=False, default=0)
+    name = Column(String(255), nullable=False)
+    gmt_created = Column(DateTime)
+    checkpoint_id = Column(Integer, nullable=False, index=True)
+
+class ArchivedPaymentGroupLink(Base):
+    __tablename__ = 'payment_group_links_archive'
+    link_id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, nullable=False)
+    pay_record_id = Column(Integer, nullable=False)
+    checkpoint_id = Column(Integer, nullable=False, index=True)
+
+class ExchangeRate(Base):
+    __tablename__ = 'exchange_rates'
+    chat_id = Column(BigInteger, primary_key=True)
+    thread_id = Column(Integer, primary_key=True)
+    base_currency = Column(String(10), primary_key=True)
+    quote_currency = Column(String(10), primary_key=True)
+    rate = Column(Numeric(20, 10), nullable=False)  # 1 base = rate quote
+    gmt_modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PersistedData(Base):
+    __tablename__ = 'persisted_data'
+    kind = Column(String(10), primary_key=True)  # 'user' or 'chat'
+    owner_id = Column(BigInteger, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    gmt_modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PersistedConversation(Base):
+    __tablename__ = 'persisted_conversations'
+    name = Column(String(64), primary_key=True)
+    conversation_key = Column(String(128), primary_key=True)
+    state = Column(LargeBinary, nullable=False)
+    gmt_modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class WriterQueueSession(AsyncSession):
+    """
+    SQLite allows one write transaction at a time; the others poll for the file lock for up to
+    busy_timeout and then fail with 'database is locked'. Sessions of this class take the
+    process-wide writer_lock before their first statement and hold it until the transaction
+    ends, so get_session() work runs one at a time in arrival order, and sessions waiting
+    their turn don't hold a pooled connection. get_read_session() doesn't take it.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._writing = False
+
+    async def _begin_write(self):
+        if self._writing:
+            return
+        start = time.perf_counter()
+        await writer_lock.acquire()
+        self._writing = True
+        waited = time.perf_counter() - start
+        writer_queue['sessions'] += 1
+        writer_queue['wait_seconds_total'] += waited
+        writer_queue['wait_seconds_max'] = max(writer_queue['wait_seconds_max'], waited)
+
+    def _end_write(self):
+        if self._writing:
+            self._writing = False
+            writer_lock.release()
+
+    async def execute(self, *args, **kwargs):
+        await self._begin_write()
+        return await super().execute(*args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        await self._begin_write()
+        return await super().scalar(*args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        await self._begin_write()
+        return await super().scalars(*args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        await self._begin_write()
+        return await super().get(*args, **kwargs)
+
+    async def merge(self, *args, **kwargs):
+        await self._begin_write()
+        return await super().merge(*args, **kwargs)
+
+    async def stream(self, *args, **kwargs):
+        await self._begin_write()
+        return await super().stream(*args, **kwargs)
+
+    async def connection(self, *args, **kwargs):
+        await self._begin_write()
+        return await super().connection(*args, **kwargs)
+
+    async def flush(self, objects=None):
+        await self._begin_write()
+        await super().flush(objects)
+
+    async def commit(self):
+        if self.new or self.dirty or self.deleted:
+            await self._begin_write()
+        try:
+            await super().commit()
+        finally:
+            self._end_write()
+
+    async def rollback(self):
+        try:
+            await super().rollback()
+        finally:
+            self._end_write()
+
+    async def close(self):
+        try:
+            await super().close()
+        finally:
+            self._end_write()
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Queue pool that also records how long checkouts wait for a connection.
+    Wait time includes opening a new connection when the pool is below its size.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+def env_flag(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def engine_options(db_url):
+    """
+    Keyword arguments for create_async_engine, tuned through the environment:
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_PRE_PING, DB_POOL_RECYCLE
+    and, for asyncpg, DB_STATEMENT_CACHE_SIZE.
+    """
+    options = {'echo': False}
+    if db_url.startswith('sqlite'):
+        return options
+
+    options.update(
+        poolclass=InstrumentedPool,
+        pool_size=int(os.getenv('DB_POOL_SIZE', '5')),
+        max_overflow=int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', '30')),
+        pool_pre_ping=env_flag('DB_POOL_PRE_PING'),
+        pool_recycle=int(os.getenv('DB_POOL_RECYCLE', '-1')),
+    )
+    if '+asyncpg' in db_url:
+        options['connect_args'] = {
+            'prepared_statement_cache_size': int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))
+        }
+    return options
+
+ARCHIVE_SETTLED = env_flag('ARCHIVE_SETTLED')
+
+# SQLite: applied to every connection when SQLITE_PRAGMAS is on. WAL lets reads run during a
+# write, and NORMAL only syncs the WAL at checkpoints, which is still safe against app crashes
+SQLITE_PRAGMAS = env_flag('SQLITE_PRAGMAS', True)
+SQLITE_PRAGMA_VALUES = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    'cache_size': -int(os.getenv('SQLITE_CACHE_SIZE_KB', str(64 * 1024))),  # negative means KiB
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000')),
+}
+# SQLite: queue write transactions in-process rather than on SQLite's file lock
+SQLITE_SINGLE_WRITER = env_flag('SQLITE_SINGLE_WRITER', True)
+
+writer_lock = None
+writer_queue = {'sessions': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0}
+
+# Optional replica for read-only paths; chats that just wrote keep reading the primary for
+# READ_YOUR_WRITES_SECONDS, which must cover the replica's usual lag
+READ_DATABASE_URL = os.getenv('READ_DATABASE_URL')
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', '10'))
+
+# records: [(from_user_id, to_user_id, currency, value)]
+DeletedTransaction = namedtuple('DeletedTransaction', ['group_id', 'name', 'records'])
+
+RosterEntry = namedtuple('RosterEntry', ['user_id', 'name'])
+
+engine = None
 async_session_factory = None
+# Same as engine/async_session_factory unless a read replica is configured
+read_engine = None
+read_session_factory = None
+
+# (chat_id, thread_id) of contexts written within READ_YOUR_WRITES_SECONDS
+primary_pins = LRUCache(maxsize=int(os.getenv('PRIMARY_PIN_CACHE_SIZE', '100000')), ttl=READ_YOUR_WRITES_SECONDS)
+read_routing = {'replica': 0, 'pinned': 0}
 
-async def init_db(db_url):
-    global async_session_factory
-    engine = create_async_engine(db_url, echo=False) 
+# Bumped whenever a chat context's ledger or names change; used to key render caches
+ledger_versions = {}
+
+# (chat_id, thread_id) -> tuple of RosterEntry sorted by user_id
+roster_cache = LRUCache(
+    maxsize=int(os.getenv('ROSTER_CACHE_SIZE', '4096')),
+    ttl=float(os.getenv('ROSTER_CACHE_TTL', '600'))
+)
+# Bumped on every registration; guards roster loads against racing upserts
+roster_versions = {}
+
+async def init_db(db_url, read_db_url=None):
+    global engine, async_session_factory, read_engine, read_session_factory, writer_lock
+    engine = create_async_engine(db_url, **engine_options(db_url))
+    session_class, writer_lock = AsyncSession, None
+    if db_url.startswith('sqlite'):
+        if SQLITE_PRAGMAS:
+            event.listen(engine.sync_engine, 'connect', apply_sqlite_pragmas)
+        if SQLITE_SINGLE_WRITER:
+            writer_lock = asyncio.Lock()
+            session_class = WriterQueueSession
     
     async_session_factory = sessionmaker(
-        engine, expire_on_commit=False, class_=AsyncSession
+        engine, expire_on_commit=False, class_=session_class
     )
 
+    read_db_url = read_db_url or READ_DATABASE_URL
+    if read_db_url and read_db_url != db_url:
+        read_engine = create_async_engine(read_db_url, **engine_options(read_db_url))
+        read_session_factory = sessionmaker(read_engine, expire_on_commit=False, class_=AsyncSession)
+    else:
+        # Read sessions on the primary skip the SQLite writer queue
+        read_engine = engine
+        read_session_factory = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+
+    migrated = await migrate(engine)
+    if migrated:
+        print(f"Applied schema migrations {migrated}.")
+
+    async with async_session_factory() as session:
+        backfilled = await backfill_balances(session)
+        await session.commit()
+        if backfilled:
+            print(f"Backfilled {backfilled} balance rows from pay_records.")
     
     print("Database initialized.")
 
+async def ensure_db(db_url):
+    """
+    Initializes the database unless that already happened, e.g. from the persistence layer.
+    """
+    if engine is None:
+        await init_db(db_url)
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMA_VALUES.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+def get_engines():
+    """
+    The primary engine, followed by the read replica's if there is one.
+    """
+    return [engine] if read_engine is engine else [engine, read_engine]
+
+async def dispose_db():
+    for e in get_engines():
+        await e.dispose()
+
 def get_session():
+    """
+    Session on the primary; anything that writes, or reads to decide what to write, uses this.
+    On SQLite these queue on the writer lock, so don't open one inside another.
+    """
     if async_session_factory is None:
         raise Exception("Database not initialized. Call init_db first.")
     return async_session_factory()
 
+def get_read_session(chat_id=None, thread_id=None):
+    """
+    Session for read-only work, on the read replica if one is configured. Reads for a chat
+    context that wrote in the last READ_YOUR_WRITES_SECONDS go to the primary instead, so a
+    /list right after /pay or /undo shows it.
+    """
+    if read_session_factory is None:
+        raise Exception("Database not initialized. Call init_db first.")
+    if read_engine is engine:
+        return read_session_factory()
+    safe_thread_id = thread_id if thread_id is not None else 0
+    if chat_id is not None and primary_pins.get((chat_id, safe_thread_id)):
+        read_routing['pinned'] += 1
+        return async_session_factory()
+    read_routing['replica'] += 1
+    return read_session_factory()
+
+def pin_to_primary(chat_id, thread_id):
+    if read_engine is not engine and READ_YOUR_WRITES_SECONDS > 0:
+        safe_thread_id = thread_id if thread_id is not None else 0
+        primary_pins.set((chat_id, safe_thread_id), True)
+
+def get_pool_stats():
+    """
+    Live connection pool statistics for sizing the pool against handler concurrency.
+    """
+    if engine is None:
+        return {}
+    stats = _pool_stats(engine.pool)
+    if read_engine is not engine:
+        stats.update({f"read_{name}": value for name, value in _pool_stats(read_engine.pool).items()})
+        stats.update(reads_replica=read_routing['replica'], reads_pinned=read_routing['pinned'])
+    if writer_lock is not None:
+        stats.update(
+            writer_sessions=writer_queue['sessions'],
+            writer_wait_seconds_total=round(writer_queue['wait_seconds_total'], 6),
+            writer_wait_seconds_max=round(writer_queue['wait_seconds_max'], 6),
+        )
+    return stats
+
+def _pool_stats(pool):
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    if isinstance(pool, InstrumentedPool):
+        stats.update(
+            checkouts=pool.checkouts,
+            timeouts=pool.timeouts,
+            wait_seconds_total=round(pool.wait_total, 6),
+            wait_seconds_max=round(pool.wait_max, 6),
+        )
+    return stats
+
+def get_ledger_version(chat_id, thread_id):
+    safe_thread_id = thread_id if thread_id is not None else 0
+    return ledger_versions.get((chat_id, safe_thread_id), 0)
+
+def bump_ledger_version(chat_id, thread_id):
+    safe_thread_id = thread_id if thread_id is not None else 0
+    key = (chat_id, safe_thread_id)
+    ledger_versions[key] = ledger_versions.get(key, 0) + 1
+    # Every ledger write passes through here
+    pin_to_primary(chat_id, thread_id)
+
 ### USERS ###
 
+def get_roster_version(chat_id, thread_id):
+    safe_thread_id = thread_id if thread_id is not None else 0
+    return roster_versions.get((chat_id, safe_thread_id), 0)
+
 async def get_chat_users(session, chat_id, thread_id):
     """
-    Fetches all registered users for a specific chat context.
+    Fetches all registered users for a specific chat context as RosterEntry tuples.
+    Served from roster_cache; the DB is only read on a miss or after the TTL.
     """
     safe_thread_id = thread_id if thread_id is not None else 0
-    stmt = select(User).where(
+    key = (chat_id, safe_thread_id)
+    roster = roster_cache.get(key)
+    if roster is not None:
+        return roster
+
+    version = roster_versions.get(key, 0)
+    stmt = select(User.user_id, User.name).where(
         User.chat_id == chat_id, 
         User.thread_id == safe_thread_id
-    )
+    ).order_by(User.user_id)
     result = await session.execute(stmt)
-    return result.scalars().all()
+    roster = tuple(RosterEntry(row.user_id, row.name) for row in result)
+
+    # A registration that landed while we were reading may be missing from the result
+    if roster_versions.get(key, 0) == version:
+        roster_cache.set(key, roster)
+    return roster
 
 async def upsert_user(user_id, chat_id, thread_id, username):
     """
@@ -104,169 +541,774 @@ async def upsert_user(user_id, chat_id, thread_id, username):
         await session.merge(new_user)
         await session.commit()
 
+    key = (chat_id, safe_thread_id)
+    roster_versions[key] = roster_versions.get(key, 0) + 1
+    roster = roster_cache.get(key)
+    if roster is not None:
+        others = [entry for entry in roster if entry.user_id != user_id]
+        others.append(RosterEntry(user_id, username))
+        roster_cache.set(key, tuple(sorted(others)))
+    bump_ledger_version(chat_id, thread_id)
+
 async def check_username_exists(chat_id, thread_id, username):
     """
-    Checks if a username is already taken in the specific chat/thread.
+    Checks if a username is already taken in the specific chat/thread (case-insensitive).
+    A read: on SQLite get_session would queue it behind writes. Registrations pin the chat to
+    the primary, so a name registered just now is seen.
     """
-    safe_thread_id = thread_id if thread_id is not None else 0
-    async with get_session() as session:
-        stmt = select(User.user_id).where(
-            User.chat_id == chat_id, 
-            User.thread_id == safe_thread_id,
-            func.lower(User.name) == func.lower(username)
-        ).limit(1)
-        result = await session.execute(stmt)
-        return result.scalar_one_or_none() is not None
+    async with get_read_session(chat_id, thread_id) as session:
+        roster = await get_chat_users(session, chat_id, thread_id)
+    folded = username.casefold()
+    return any(entry.name.casefold() == folded for entry in roster)
 
 ### PAYMENT_RECORDS ###
 
-async def create_payment(chat_id, thread_id, payer_id, payee_id, currency, amount):
+def build_transaction_records(payer_id, payee_id_or_split, currency, total_amount, chat_users):
     """
-    Creates a payment record and returns the payee's name for display.
+    Expands a payment into (to_user_id, value) pairs: Split by amount, Split equally, or Single payee.
+    chat_users is only needed for SPLIT_ALL.
     """
+    records = []
+
+    if payee_id_or_split.get('type') == 'DETAILED_SPLIT':
+        # --- SPLIT BY AMOUNTS LOGIC ---
+        allocations = payee_id_or_split['allocations']
+        for payee_id, payee_amount in allocations.items():
+            # if payee_id == payer_id:
+            #     continue
+            records.append((payee_id, from_minor(to_minor(payee_amount, currency), currency)))
+
+    elif payee_id_or_split.get('type') == "SPLIT_ALL":
+        # --- SPLIT EQUALLY LOGIC ---
+        if not chat_users:
+            raise Exception("No users found to split.")
+
+        # Calculate Split Amounts in minor units
+        # Formula: Total / Count, the remainder goes one unit each to the lowest user ids.
+        # Payer creates debt records only against others.
+        all_users = sorted(chat_users, key=lambda u: u.user_id)
+        shares = split_evenly(to_minor(total_amount, currency), len(all_users))
+
+        for user, share in zip(all_users, shares):
+            # if user.user_id == payer_id:
+            #     continue
+            records.append((user.user_id, from_minor(share, currency)))
+
+    elif payee_id_or_split.get('type') == "SINGLE_PAYEE":
+        # --- SINGLE PAYEE LOGIC ---
+        payee_id = int(payee_id_or_split.get('id'))
+        records.append((payee_id, from_minor(to_minor(total_amount, currency), currency)))
+
+    return records
+
+async def insert_transaction_cte(session, group_row, record_rows):
+    """
+    PostgreSQL: creates the group, its records and their links in a single statement.
+    Records are passed as unnest()ed arrays so the SQL text, and therefore the compiled and
+    prepared statement, is the same whatever the group size.
+    """
+    first = record_rows[0]
+    entries = func.unnest(
+        bindparam('to_user_ids', [r['to_user_id'] for r in record_rows], type_=ARRAY(BigInteger)),
+        bindparam('values', [r['value'] for r in record_rows], type_=ARRAY(PayRecord.value.type))
+    ).table_valued('to_user_id', 'value').render_derived()
+
+    new_group = insert(PaymentGroup).values(group_row).returning(PaymentGroup.group_id).cte('new_group')
+    new_records = insert(PayRecord).from_select(
+        ['chat_id', 'thread_id', 'from_user_id', 'to_user_id', 'currency', 'value', 'gmt_created', 'gmt_modified'],
+        select(
+            bindparam('chat_id', first['chat_id'], type_=BigInteger),
+            bindparam('thread_id', first['thread_id'], type_=Integer),
+            bindparam('from_user_id', first['from_user_id'], type_=BigInteger),
+            entries.c.to_user_id,
+            bindparam('currency', first['currency'], type_=String),
+            entries.c.value,
+            bindparam('gmt_created', first['gmt_created'], type_=DateTime),
+            bindparam('gmt_modified', first['gmt_modified'], type_=DateTime)
+        )
+    ).returning(PayRecord.pay_record_id).cte('new_records')
+    stmt = insert(PaymentGroupLink).from_select(
+        ['group_id', 'pay_record_id'],
+        select(new_group.c.group_id, new_records.c.pay_record_id).select_from(
+            new_group.join(new_records, true())
+        )
+    ).add_cte(new_group, new_records)
+    await session.execute(stmt)
+
+async def insert_transaction_bulk(session, group_row, record_rows):
+    """
+    Other dialects: one INSERT .. RETURNING for the group, then executemany for records and links.
+    """
+    group_id = (await session.execute(
+        insert(PaymentGroup).values(group_row).returning(PaymentGroup.group_id)
+    )).scalar_one()
+
+    # Links don't care which id belongs to which row; asking for parameter order would make
+    # SQLite fall back to one INSERT per record
+    record_ids = (await session.execute(
+        insert(PayRecord).returning(PayRecord.pay_record_id),
+        record_rows
+    )).scalars().all()
+
+    await session.execute(
+        insert(PaymentGroupLink),
+        [dict(group_id=group_id, pay_record_id=record_id) for record_id in record_ids]
+    )
+
+async def create_full_transaction(chat_id, thread_id, payer_id, payee_id_or_split, currency, total_amount, description):
+    safe_thread_id = thread_id if thread_id is not None else 0
     async with get_session() as session:
-        record = PayRecord(
-            chat_id=chat_id,
-            thread_id=thread_id,
-            from_user_id=payer_id,
-            to_user_id=payee_id,
-            currency=currency,
-            value=amount
+        # 1. Work out the records to create
+        chat_users = None
+        if payee_id_or_split.get('type') == "SPLIT_ALL":
+            chat_users = await get_chat_users(session, chat_id, thread_id)
+        records = build_transaction_records(payer_id, payee_id_or_split, currency, total_amount, chat_users)
+
+        now = datetime.utcnow()
+        group_row = dict(chat_id=chat_id, thread_id=safe_thread_id, name=description, gmt_created=now)
+        record_rows = [
+            dict(chat_id=chat_id, thread_id=safe_thread_id, from_user_id=payer_id, to_user_id=payee_id,
+                 currency=currency, value=value, gmt_created=now, gmt_modified=now)
+            for payee_id, value in records
+        ]
+
+        # 2. Write the Group, Records and Links
+        if session.bind.dialect.name == 'postgresql':
+            await insert_transaction_cte(session, group_row, record_rows)
+        else:
+            await insert_transaction_bulk(session, group_row, record_rows)
+
+        # 3. Keep the running balances in step with the new records
+        await apply_balance_deltas(session, chat_id, thread_id, record_deltas(
+            (payer_id, payee_id, currency, value) for payee_id, value in records
+        ))
+
+        await session.commit()
+        bump_ledger_version(chat_id, thread_id)
+        return len(records)
+
+def latest_group_stmt(chat_id, thread_id):
+    # Groups covered by a settlement checkpoint can no longer be undone
+    safe_thread_id = thread_id if thread_id is not None else 0
+    return select(PaymentGroup.group_id).where(
+        PaymentGroup.chat_id == chat_id,
+        PaymentGroup.thread_id == safe_thread_id,
+        PaymentGroup.group_id > settled_through(chat_id, safe_thread_id, SettlementCheckpoint.last_group_id)
+    ).order_by(PaymentGroup.gmt_created.desc(), PaymentGroup.group_id.desc()).limit(1)
+
+async def delete_latest_group_cte(session, chat_id, thread_id):
+    """
+    PostgreSQL: finds and deletes the latest group, its links and its records in one statement.
+    Returns one row per deleted record, each carrying the group's id and name.
+    """
+    target = latest_group_stmt(chat_id, thread_id).cte('target')
+    deleted_links = delete(PaymentGroupLink).where(
+        PaymentGroupLink.group_id.in_(select(target.c.group_id))
+    ).returning(PaymentGroupLink.pay_record_id).cte('deleted_links')
+    deleted_records = delete(PayRecord).where(
+        PayRecord.pay_record_id.in_(select(deleted_links.c.pay_record_id))
+    ).returning(
+        PayRecord.pay_record_id, PayRecord.from_user_id, PayRecord.to_user_id, PayRecord.currency, PayRecord.value
+    ).cte('deleted_records')
+    deleted_group = delete(PaymentGroup).where(
+        PaymentGroup.group_id.in_(select(target.c.group_id))
+    ).returning(PaymentGroup.group_id, PaymentGroup.name).cte('deleted_group')
+
+    stmt = select(
+        deleted_group.c.group_id, deleted_group.c.name,
+        deleted_records.c.from_user_id, deleted_records.c.to_user_id,
+        deleted_records.c.currency, deleted_records.c.value
+    ).select_from(
+        deleted_group.outerjoin(deleted_records, true())
+    ).order_by(deleted_records.c.pay_record_id)
+    return (await session.execute(stmt)).all()
+
+async def delete_latest_group_stepwise(session, chat_id, thread_id):
+    """
+    Other dialects: the same deletion as delete_latest_group_cte, as one statement per table.
+    """
+    group = (await session.execute(
+        select(PaymentGroup.group_id, PaymentGroup.name).where(
+            PaymentGroup.group_id.in_(latest_group_stmt(chat_id, thread_id).scalar_subquery())
         )
-        session.add(record)
-        
-        stmt = select(User.name).where(User.user_id == payee_id)
-        result = await session.execute(stmt)
-        payee_name = result.scalar_one_or_none() or "Unknown"
+    )).first()
+    if group is None:
+        return []
+
+    group_record_ids = select(PaymentGroupLink.pay_record_id).where(PaymentGroupLink.group_id == group.group_id)
+    records = (await session.execute(
+        delete(PayRecord).where(PayRecord.pay_record_id.in_(group_record_ids)).returning(
+            PayRecord.pay_record_id, PayRecord.from_user_id, PayRecord.to_user_id, PayRecord.currency, PayRecord.value
+        )
+    )).all()
+    await session.execute(delete(PaymentGroupLink).where(PaymentGroupLink.group_id == group.group_id))
+    await session.execute(delete(PaymentGroup).where(PaymentGroup.group_id == group.group_id))
+
+    records = sorted(records, key=lambda r: r.pay_record_id)
+    if not records:
+        return [(group.group_id, group.name, None, None, None, None)]
+    return [(group.group_id, group.name, r.from_user_id, r.to_user_id, r.currency, r.value) for r in records]
+
+async def delete_last_transaction(user_id, chat_id, thread_id):
+    """
+    Deletes the most recent PaymentGroup in this context together with its records.
+    Returns a DeletedTransaction describing what was removed, or None if there was nothing to undo.
+    """
+    async with get_session() as session:
+        # 1. Delete the latest group with its links and records
+        if session.bind.dialect.name == 'postgresql':
+            rows = await delete_latest_group_cte(session, chat_id, thread_id)
+        else:
+            rows = await delete_latest_group_stepwise(session, chat_id, thread_id)
+
+        if not rows:
+            return None # No group found
+
+        records = [
+            (from_user_id, to_user_id, currency, value)
+            for _, _, from_user_id, to_user_id, currency, value in rows
+            if from_user_id is not None
+        ]
+
+        # 2. Reverse the group's effect on the running balances
+        deltas = record_deltas(records)
+        await apply_balance_deltas(session, chat_id, thread_id, {k: -v for k, v in deltas.items()})
 
         await session.commit()
-        
-        return payee_name
+        bump_ledger_version(chat_id, thread_id)
+        return DeletedTransaction(group_id=rows[0][0], name=rows[0][1], records=records)
 
-async def create_full_transaction(chat_id, thread_id, payer_id, payee_id_or_split, currency, total_amount, description):
+### BALANCES ###
+
+def record_deltas(records):
+    """
+    Folds (from_user_id, to_user_id, currency, value) tuples into balance deltas.
+    Returns {(user_id, currency): minor units}; the payer is owed, the payee owes.
+    """
+    deltas = defaultdict(int)
+    for from_user_id, to_user_id, currency, value in records:
+        minor = to_minor(value, currency)
+        deltas[(from_user_id, currency)] += minor
+        deltas[(to_user_id, currency)] -= minor
+    return {k: v for k, v in deltas.items() if v}
+
+async def apply_balance_deltas(session, chat_id, thread_id, deltas):
+    """
+    Adds the given minor-unit deltas onto the balances table within the caller's transaction.
+    """
+    if not deltas:
+        return
+    safe_thread_id = thread_id if thread_id is not None else 0
+    now = datetime.utcnow()
+    rows = [
+        dict(chat_id=chat_id, thread_id=safe_thread_id, user_id=user_id,
+             currency=currency, value=from_minor(minor, currency), gmt_modified=now)
+        for (user_id, currency), minor in deltas.items()
+    ]
+
+    dialect = session.bind.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        # executemany keeps one cached statement, unlike a multi-row VALUES per call
+        insert_fn = pg_insert if dialect == 'postgresql' else sqlite_insert
+        stmt = insert_fn(Balance)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Balance.chat_id, Balance.thread_id, Balance.user_id, Balance.currency],
+            set_={'value': Balance.value + stmt.excluded.value, 'gmt_modified': stmt.excluded.gmt_modified}
+        )
+        await session.execute(stmt, rows)
+    else:
+        for row in rows:
+            key = (row['chat_id'], row['thread_id'], row['user_id'], row['currency'])
+            balance = await session.get(Balance, key, with_for_update=True)
+            if balance is None:
+                session.add(Balance(**row))
+            else:
+                balance.value += row['value']
+
+async def get_balances(session, chat_id, thread_id):
+    """
+    Fetches the non-zero net balances for a chat context as (user_id, currency, value) rows.
+    """
+    safe_thread_id = thread_id if thread_id is not None else 0
+    stmt = select(Balance.user_id, Balance.currency, Balance.value).where(
+        Balance.chat_id == chat_id,
+        Balance.thread_id == safe_thread_id,
+        Balance.value != 0
+    ).order_by(Balance.user_id, Balance.currency)
+    result = await session.execute(stmt)
+    return result.all()
+
+async def get_balance_currencies(session, chat_id, thread_id):
+    """
+    Fetches the currencies that still carry a non-zero balance in a chat context.
+    """
+    safe_thread_id = thread_id if thread_id is not None else 0
+    stmt = select(Balance.currency).distinct().where(
+        Balance.chat_id == chat_id,
+        Balance.thread_id == safe_thread_id,
+        Balance.value != 0
+    )
+    result = await session.execute(stmt)
+    return result.scalars().all()
+
+def aggregate_balances_stmt(chat_id=None, thread_id=None, through_record_id=None):
+    """
+    Builds a GROUP BY over pay_records yielding (chat_id, thread_id, user_id, currency, value).
+    Without a chat_id the aggregate covers every chat. Only records after each chat's latest
+    settlement checkpoint count, optionally only up to through_record_id.
+    """
+    unsettled = PayRecord.pay_record_id > settled_through(PayRecord.chat_id, PayRecord.thread_id)
+    if through_record_id is not None:
+        unsettled = unsettled & (PayRecord.pay_record_id <= through_record_id)
+    credits = select(
+        PayRecord.chat_id, PayRecord.thread_id, PayRecord.from_user_id.label('user_id'),
+        PayRecord.currency, PayRecord.value.label('delta')
+    )
+    debits = select(
+        PayRecord.chat_id, PayRecord.thread_id, PayRecord.to_user_id.label('user_id'),
+        PayRecord.currency, (literal(0) - PayRecord.value).label('delta')
+    )
+    credits = credits.where(unsettled)
+    debits = debits.where(unsettled)
+    if chat_id is not None:
+        safe_thread_id = thread_id if thread_id is not None else 0
+        credits = credits.where(PayRecord.chat_id == chat_id, PayRecord.thread_id == safe_thread_id)
+        debits = debits.where(PayRecord.chat_id == chat_id, PayRecord.thread_id == safe_thread_id)
+
+    entries = union_all(credits, debits).subquery()
+    return select(
+        entries.c.chat_id, entries.c.thread_id, entries.c.user_id, entries.c.currency,
+        func.sum(entries.c.delta).label('value')
+    ).group_by(
+        entries.c.chat_id, entries.c.thread_id, entries.c.user_id, entries.c.currency
+    )
+
+async def backfill_balances(session):
+    """
+    Populates an empty balances table from pay_records, e.g. on first start after upgrading.
+    Returns the number of rows written.
+    """
+    has_balances = (await session.execute(select(Balance.chat_id).limit(1))).first()
+    if has_balances is not None:
+        return 0
+
+    now = datetime.utcnow()
+    result = await session.execute(aggregate_balances_stmt())
+    rows = [
+        dict(chat_id=r.chat_id, thread_id=r.thread_id, user_id=r.user_id,
+             currency=r.currency, value=from_minor(to_minor(r.value, r.currency), r.currency),
+             gmt_modified=now)
+        for r in result.all()
+    ]
+    for row in rows:
+        session.add(Balance(**row))
+    return len(rows)
+
+async def rebuild_balances(chat_id, thread_id):
+    """
+    Recomputes a chat context's balances from pay_records and overwrites the stored ones.
+    Returns the mismatches found as (user_id, currency, stored, expected) tuples.
+    """
+    safe_thread_id = thread_id if thread_id is not None else 0
     async with get_session() as session:
-        # 1. Create the Group
-        group = PaymentGroup(
-            chat_id=chat_id,
-            thread_id=thread_id,
-            name=description
+        result = await session.execute(aggregate_balances_stmt(chat_id, thread_id))
+        expected = {(r.user_id, r.currency): to_minor(r.value, r.currency) for r in result.all()}
+
+        stmt_stored = select(Balance).where(
+            Balance.chat_id == chat_id,
+            Balance.thread_id == safe_thread_id
         )
-        session.add(group)
-        await session.flush() # Flush to get group_id
-
-        created_records = []
-
-        # 2. Determine Logic: Split by amount, Split equally, or Single payee
-        if payee_id_or_split.get('type') == 'DETAILED_SPLIT':
-            # --- SPLIT BY AMOUNTS LOGIC ---
-            allocations = payee_id_or_split['allocations']
-            for payee_id, payee_amount in allocations.items():
-                # if payee_id == payer_id:
-                #     continue
-                record = PayRecord(
-                    chat_id=chat_id,
-                    thread_id=thread_id,
-                    from_user_id=payer_id,
-                    to_user_id=payee_id,
-                    currency=currency,
-                    value=payee_amount
-                )
-                session.add(record)
-                created_records.append(record)
-            pass
-
-        elif payee_id_or_split.get('type') == "SPLIT_ALL":
-            # --- SPLIT EQUALLY LOGIC ---
-            all_users = await get_chat_users(session, chat_id, thread_id)
-            
-            if not all_users:
-                raise Exception("No users found to split.")
-
-            # Calculate Split Amount
-            # Formula: Total / Count.
-            # Payer creates debt records only against others.
-            count = len(all_users)
-            split_amount = total_amount / count
-
-            for user in all_users:
-                # if user.user_id == payer_id:
-                #     continue
-                
-                record = PayRecord(
-                    chat_id=chat_id,
-                    thread_id=thread_id,
-                    from_user_id=payer_id,
-                    to_user_id=user.user_id,
-                    currency=currency,
-                    value=split_amount
+        stored_rows = (await session.execute(stmt_stored)).scalars().all()
+        stored = {(b.user_id, b.currency): b for b in stored_rows}
+
+        mismatches = []
+        for user_id, currency in set(expected) | set(stored):
+            key = (user_id, currency)
+            stored_minor = to_minor(stored[key].value, currency) if key in stored else 0
+            expected_minor = expected.get(key, 0)
+            if stored_minor != expected_minor:
+                mismatches.append((
+                    user_id, currency, from_minor(stored_minor, currency), from_minor(expected_minor, currency)
+                ))
+                if key in stored:
+                    stored[key].value = from_minor(expected_minor, currency)
+                else:
+                    session.add(Balance(
+                        chat_id=chat_id, thread_id=safe_thread_id, user_id=user_id,
+                        currency=currency, value=from_minor(expected_minor, currency)
+                    ))
+
+        await session.commit()
+        if mismatches:
+            bump_ledger_version(chat_id, thread_id)
+        return mismatches
+
+### SETTLEMENT_CHECKPOINTS ###
+
+def settled_through(chat_id, safe_thread_id, column=SettlementCheckpoint.last_pay_record_id):
+    """
+    Scalar subquery for the last id covered by the chat context's latest checkpoint, 0 if none.
+    chat_id and safe_thread_id may be columns, which correlates it with the enclosing query.
+    """
+    return select(func.coalesce(func.max(column), 0)).where(
+        SettlementCheckpoint.chat_id == chat_id,
+        SettlementCheckpoint.thread_id == safe_thread_id
+    ).scalar_subquery()
+
+async def get_last_record_id(session, chat_id, thread_id):
+    """
+    Id of the newest unsettled record in a chat context, or None.
+    """
+    safe_thread_id = thread_id if thread_id is not None else 0
+    stmt = select(func.max(PayRecord.pay_record_id)).where(
+        PayRecord.chat_id == chat_id,
+        PayRecord.thread_id == safe_thread_id,
+        PayRecord.pay_record_id > settled_through(chat_id, safe_thread_id)
+    )
+    return (await session.execute(stmt)).scalar_one_or_none()
+
+async def archive_settled(session, checkpoint):
+    """
+    Moves the records covered by a checkpoint, their links and groups to the archive tables.
+    A group is only moved once none of its records remain live.
+    """
+    records = select(PayRecord.pay_record_id).where(
+        PayRecord.chat_id == checkpoint.chat_id,
+        PayRecord.thread_id == checkpoint.thread_id,
+        PayRecord.pay_record_id <= checkpoint.last_pay_record_id
+    )
+    checkpoint_id = literal(checkpoint.checkpoint_id)
+    links = select(PaymentGroupLink.link_id, PaymentGroupLink.group_id, PaymentGroupLink.pay_record_id).where(
+        PaymentGroupLink.pay_record_id.in_(records)
+    )
+    groups = select(PaymentGroupLink.group_id).where(PaymentGroupLink.pay_record_id.in_(records))
+
+    await session.execute(insert(ArchivedPaymentGroupLink).from_select(
+        ['link_id', 'group_id', 'pay_record_id', 'checkpoint_id'], links.add_columns(checkpoint_id)
+    ))
+    await session.execute(insert(ArchivedPayRecord).from_select(
+        ['pay_record_id', 'gmt_created', 'gmt_modified', 'chat_id', 'thread_id', 'from_user_id',
+         'to_user_id', 'currency', 'value', 'checkpoint_id'],
+        select(
+            PayRecord.pay_record_id, PayRecord.gmt_created, PayRecord.gmt_modified, PayRecord.chat_id,
+            PayRecord.thread_id, PayRecord.from_user_id, PayRecord.to_user_id, PayRecord.currency,
+            PayRecord.value, checkpoint_id
+        ).where(PayRecord.pay_record_id.in_(records))
+    ))
+    # Resolve the groups before their links go
+    group_ids = (await session.execute(groups.distinct())).scalars().all()
+
+    await session.execute(delete(PaymentGroupLink).where(PaymentGroupLink.pay_record_id.in_(records)))
+    archived = (await session.execute(
+        delete(PayRecord).where(PayRecord.pay_record_id.in_(records)).returning(PayRecord.pay_record_id)
+    )).scalars().all()
+
+    settled_groups = select(PaymentGroup.group_id).where(
+        PaymentGroup.group_id.in_(group_ids),
+        ~PaymentGroup.group_id.in_(select(PaymentGroupLink.group_id).where(PaymentGroupLink.group_id.in_(group_ids)))
+    )
+    await session.execute(insert(ArchivedPaymentGroup).from_select(
+        ['group_id', 'chat_id', 'thread_id', 'name', 'gmt_created', 'checkpoint_id'],
+        select(
+            PaymentGroup.group_id, PaymentGroup.chat_id, PaymentGroup.thread_id, PaymentGroup.name,
+            PaymentGroup.gmt_created, checkpoint_id
+        ).where(PaymentGroup.group_id.in_(settled_groups))
+    ))
+    await session.execute(delete(PaymentGroup).where(PaymentGroup.group_id.in_(settled_groups)))
+    return len(archived)
+
+async def confirm_settlement(chat_id, thread_id, through_record_id, currency, confirmed_by, archive=ARCHIVE_SETTLED):
+    """
+    Records that everything up to through_record_id has been paid out.
+    Snapshots the balances those records add up to into the checkpoint and subtracts them from
+    the running balances, so payments recorded meanwhile keep counting.
+    Returns (checkpoint, archived record count), or None if those records were already settled.
+    """
+    safe_thread_id = thread_id if thread_id is not None else 0
+    async with get_session() as session:
+        # 1. Balances of the records between the previous checkpoint and this one
+        rows = (await session.execute(
+            aggregate_balances_stmt(chat_id, thread_id, through_record_id)
+        )).all()
+        snapshot = {(r.user_id, r.currency): to_minor(r.value, r.currency) for r in rows}
+        previous = (await session.execute(select(
+            settled_through(chat_id, safe_thread_id),
+            settled_through(chat_id, safe_thread_id, SettlementCheckpoint.last_group_id)
+        ))).one()
+        if through_record_id <= previous[0]:
+            return None
+
+        last_group_id = (await session.execute(
+            select(func.max(PaymentGroupLink.group_id)).where(PaymentGroupLink.pay_record_id.in_(
+                select(PayRecord.pay_record_id).where(
+                    PayRecord.chat_id == chat_id,
+                    PayRecord.thread_id == safe_thread_id,
+                    PayRecord.pay_record_id <= through_record_id
                 )
-                session.add(record)
-                created_records.append(record)
-                
-        elif payee_id_or_split.get('type') == "SINGLE_PAYEE":
-            # --- SINGLE PAYEE LOGIC ---
-            payee_id = int(payee_id_or_split.get('id'))
-            record = PayRecord(
-                chat_id=chat_id,
-                thread_id=thread_id,
-                from_user_id=payer_id,
-                to_user_id=payee_id,
-                currency=currency,
-                value=total_amount
-            )
-            session.add(record)
-            created_records.append(record)
-
-        await session.flush() # Flush to get record IDs
-
-        # 3. Link Records to Group
-        for rec in created_records:
-            link = PaymentGroupLink(
-                group_id=group.group_id,
-                pay_record_id=rec.pay_record_id
-            )
-            session.add(link)
+            ))
+        )).scalar_one_or_none()
+
+        # 2. Write the checkpoint and its snapshot
+        checkpoint = SettlementCheckpoint(
+            chat_id=chat_id, thread_id=safe_thread_id, last_pay_record_id=through_record_id,
+            last_group_id=max(last_group_id or 0, previous[1]), currency=currency, confirmed_by=confirmed_by
+        )
+        session.add(checkpoint)
+        await session.flush()
+        session.add_all(
+            CheckpointBalance(checkpoint_id=checkpoint.checkpoint_id, user_id=user_id, currency=currency,
+                              value=from_minor(minor, currency))
+            for (user_id, currency), minor in snapshot.items() if minor
+        )
+
+        # 3. Settled amounts leave the running balances
+        await apply_balance_deltas(session, chat_id, thread_id, {k: -v for k, v in snapshot.items() if v})
 
+        archived = await archive_settled(session, checkpoint) if archive else 0
         await session.commit()
-        return len(created_records)
+        bump_ledger_version(chat_id, thread_id)
+        return checkpoint, archived
+
+### EXCHANGE_RATES ###
+
+async def get_exchange_rates(session, chat_id, thread_id, since=None):
+    """
+    Returns {(base, quote): rate} entered in this chat context, optionally only those modified after since.
+    """
+    safe_thread_id = thread_id if thread_id is not None else 0
+    stmt = select(ExchangeRate.base_currency, ExchangeRate.quote_currency, ExchangeRate.rate).where(
+        ExchangeRate.chat_id == chat_id,
+        ExchangeRate.thread_id == safe_thread_id
+    )
+    if since is not None:
+        stmt = stmt.where(ExchangeRate.gmt_modified >= since)
+    result = await session.execute(stmt)
+    return {(row.base_currency, row.quote_currency): row.rate for row in result}
+
+async def save_exchange_rate(chat_id, thread_id, base_currency, quote_currency, rate):
+    """
+    Stores 1 base = rate quote for this chat context, replacing the inverse pair if present.
+    """
+    safe_thread_id = thread_id if thread_id is not None else 0
+    async with get_session() as session:
+        await session.execute(delete(ExchangeRate).where(
+            ExchangeRate.chat_id == chat_id,
+            ExchangeRate.thread_id == safe_thread_id,
+            ExchangeRate.base_currency == quote_currency,
+            ExchangeRate.quote_currency == base_currency
+        ))
+        await upsert_rows(
+            session, ExchangeRate,
+            [dict(chat_id=chat_id, thread_id=safe_thread_id, base_currency=base_currency,
+                  quote_currency=quote_currency, rate=rate, gmt_modified=datetime.utcnow())],
+            [ExchangeRate.chat_id, ExchangeRate.thread_id, ExchangeRate.base_currency, ExchangeRate.quote_currency],
+            ['rate', 'gmt_modified']
+        )
+        await session.commit()
+    pin_to_primary(chat_id, thread_id)
+
+### IMPORT_EXPORT ###
+
+# One record of a chat's ledger with its group; the group columns are None for ungrouped records
+LedgerRow = namedtuple('LedgerRow', [
+    'group_id', 'group_name', 'group_created', 'pay_record_id', 'gmt_created',
+    'from_user_id', 'to_user_id', 'currency', 'value'
+])
+
+async def stream_ledger(chat_id, thread_id, batch_size=1000):
+    """
+    Yields a chat context's records joined with their groups as LedgerRow, oldest first,
+    through a server-side cursor that fetches batch_size rows at a time.
+    """
+    safe_thread_id = thread_id if thread_id is not None else 0
+    stmt = select(
+        PaymentGroup.group_id, PaymentGroup.name, PaymentGroup.gmt_created,
+        PayRecord.pay_record_id, PayRecord.gmt_created, PayRecord.from_user_id,
+        PayRecord.to_user_id, PayRecord.currency, PayRecord.value
+    ).outerjoin(
+        PaymentGroupLink,
+        PayRecord.pay_record_id == PaymentGroupLink.pay_record_id
+    ).outerjoin(
+        PaymentGroup,
+        PaymentGroupLink.group_id == PaymentGroup.group_id
+    ).where(
+        PayRecord.chat_id == chat_id,
+        PayRecord.thread_id == safe_thread_id
+    ).order_by(PayRecord.gmt_created, PayRecord.pay_record_id).execution_options(yield_per=batch_size)
+
+    async with get_read_session(chat_id, thread_id) as session:
+        result = await session.stream(stmt)
+        async for row in result:
+            yield LedgerRow(*row)
+
+async def reserve_ids(session, column, count):
+    """
+    Allocates count primary keys for column inside the caller's transaction, so rows can be
+    written without RETURNING: from the sequence on PostgreSQL, above both the current maximum
+    and the AUTOINCREMENT high-water mark on SQLite, where the caller must already hold the
+    write lock. Ids of archived rows are never handed out again.
+    """
+    if count == 0:
+        return []
+    table = column.table.name
+    if session.bind.dialect.name == 'postgresql':
+        sequence = func.pg_get_serial_sequence(table, column.name)
+        stmt = select(func.nextval(sequence)).select_from(func.generate_series(1, count))
+        return (await session.execute(stmt)).scalars().all()
+    # Inserting explicit ids above sqlite_sequence moves it up, so the next allocation sees them
+    stmt = text(
+        f"SELECT max(coalesce((SELECT max({column.name}) FROM {table}), 0), "
+        f"coalesce((SELECT seq FROM sqlite_sequence WHERE name = :table), 0))"
+    )
+    start = (await session.execute(stmt, {'table': table})).scalar_one() + 1
+    return list(range(start, start + count))
+
+async def write_rows(session, model, rows):
+    """
+    Inserts row dicts (all with the same keys) within the caller's transaction:
+    COPY on asyncpg, executemany elsewhere.
+    """
+    if not rows:
+        return
+    if session.bind.dialect.driver == 'asyncpg':
+        connection = await (await session.connection()).get_raw_connection()
+        columns = list(rows[0])
+        await connection.driver_connection.copy_records_to_table(
+            model.__tablename__, records=[tuple(row[c] for c in columns) for row in rows], columns=columns
+        )
+    else:
+        await session.execute(insert(model), rows)
+
+async def import_ledger(chat_id, thread_id, rows, batch_size=1000):
+    """
+    Writes LedgerRow rows into a chat context in one transaction, batch_size records at a time.
+    rows may be any iterable, e.g. a generator over an uploaded file, and is consumed once.
+    Rows sharing a group_id become one new payment group; pay_record_id is ignored.
+    Returns the number of records written.
+    """
+    safe_thread_id = thread_id if thread_id is not None else 0
+    now = datetime.utcnow()
+    deltas = defaultdict(int)
+    count = 0
+    # Source group_id -> new group_id; only ids are kept, so memory grows with groups, not rows
+    group_ids = {}
 
-async def delete_last_transaction(user_id, chat_id, thread_id):
     async with get_session() as session:
-        # 1. Find the most recently created PaymentGroup ID in this context
-        stmt_find_group = select(PaymentGroup.group_id).where(
-            PaymentGroup.chat_id == chat_id,
-            PaymentGroup.thread_id == thread_id,
-        ).order_by(PaymentGroup.gmt_created.desc()).limit(1)
-        
-        group_id_to_delete = (await session.execute(stmt_find_group)).scalar_one_or_none()
-
-        if not group_id_to_delete:
-            return False # No group found
-
-        # 2. Find ALL PayRecord IDs belonging to that group
-        stmt_find_all_records = select(PaymentGroupLink.pay_record_id).where(
-            PaymentGroupLink.group_id == group_id_to_delete
+        if session.bind.dialect.name == 'sqlite':
+            # reserve_ids reads max(); hold the write lock from the start
+            await session.execute(text('BEGIN IMMEDIATE'))
+
+        for batch in batched(rows, batch_size):
+            # 1. Create the groups first seen in this batch
+            opening = {}
+            for row in batch:
+                if row.group_id is not None and row.group_id not in group_ids and row.group_id not in opening:
+                    opening[row.group_id] = row
+            group_rows = []
+            for (key, row), group_id in zip(opening.items(), await reserve_ids(session, PaymentGroup.group_id, len(opening))):
+                group_ids[key] = group_id
+                group_rows.append(dict(
+                    group_id=group_id, chat_id=chat_id, thread_id=safe_thread_id, name=row.group_name,
+                    gmt_created=row.group_created or row.gmt_created or now
+                ))
+
+            # 2. Write the records and their links under pre-allocated ids
+            record_rows, link_rows = [], []
+            for row, record_id in zip(batch, await reserve_ids(session, PayRecord.pay_record_id, len(batch))):
+                record_rows.append(dict(
+                    pay_record_id=record_id, chat_id=chat_id, thread_id=safe_thread_id,
+                    from_user_id=row.from_user_id, to_user_id=row.to_user_id, currency=row.currency,
+                    value=row.value, gmt_created=row.gmt_created or now, gmt_modified=now
+                ))
+                if row.group_id is not None:
+                    link_rows.append(dict(group_id=group_ids[row.group_id], pay_record_id=record_id))
+                minor = to_minor(row.value, row.currency)
+                deltas[(row.from_user_id, row.currency)] += minor
+                deltas[(row.to_user_id, row.currency)] -= minor
+
+            await write_rows(session, PaymentGroup, group_rows)
+            await write_rows(session, PayRecord, record_rows)
+            await write_rows(session, PaymentGroupLink, link_rows)
+            count += len(batch)
+
+        # 3. Keep the running balances in step with the new records
+        await apply_balance_deltas(session, chat_id, thread_id, {k: v for k, v in deltas.items() if v})
+        await session.commit()
+
+    if count:
+        bump_ledger_version(chat_id, thread_id)
+    return count
+
+### PERSISTENCE ###
+
+async def upsert_rows(session, model, rows, index_elements, update_columns):
+    """
+    Inserts rows, overwriting update_columns on primary key conflicts, within the caller's transaction.
+    """
+    if not rows:
+        return
+    dialect = session.bind.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert_fn = pg_insert if dialect == 'postgresql' else sqlite_insert
+        stmt = insert_fn(model)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: stmt.excluded[column] for column in update_columns}
         )
-        record_ids_in_group = (await session.execute(stmt_find_all_records)).scalars().all()
-        
-        # 3. Delete all links in the group
-        stmt_delete_links = delete(PaymentGroupLink).where(
-            PaymentGroupLink.group_id == group_id_to_delete
+        await session.execute(stmt, rows)
+    else:
+        for row in rows:
+            await session.merge(model(**row))
+
+async def load_persisted_data(kind, owner_id):
+    """
+    Returns the pickled user_data/chat_data blob for one owner, or None.
+    """
+    async with get_session() as session:
+        stmt = select(PersistedData.data).where(
+            PersistedData.kind == kind,
+            PersistedData.owner_id == owner_id
         )
-        await session.execute(stmt_delete_links)
-
-        # 4. Delete all PayRecords that belonged to the group (using .in_() for the list)
-        if record_ids_in_group:
-            stmt_delete_records = delete(PayRecord).where(
-                PayRecord.pay_record_id.in_(record_ids_in_group)
-            )
-            await session.execute(stmt_delete_records)
-
-        # 5. Delete the PaymentGroup itself
-        stmt_delete_group = delete(PaymentGroup).where(
-            PaymentGroup.group_id == group_id_to_delete
+        result = await session.execute(stmt)
+        return result.scalar_one_or_none()
+
+async def load_persisted_conversations(name):
+    """
+    Returns [(conversation_key, pickled state)] for one ConversationHandler.
+    """
+    async with get_session() as session:
+        stmt = select(PersistedConversation.conversation_key, PersistedConversation.state).where(
+            PersistedConversation.name == name
         )
-        await session.execute(stmt_delete_group)
+        result = await session.execute(stmt)
+        return result.all()
 
+async def save_persisted_batch(data_rows, dropped_data, conversation_rows, ended_conversations):
+    """
+    Writes one batch of persistence changes in a single transaction.
+    data_rows / conversation_rows are upserted; dropped_data is [(kind, owner_id)] and
+    ended_conversations is [(name, conversation_key)] to delete.
+    """
+    now = datetime.utcnow()
+    async with get_session() as session:
+        await upsert_rows(
+            session, PersistedData,
+            [dict(row, gmt_modified=now) for row in data_rows],
+            [PersistedData.kind, PersistedData.owner_id], ['data', 'gmt_modified']
+        )
+        await upsert_rows(
+            session, PersistedConversation,
+            [dict(row, gmt_modified=now) for row in conversation_rows],
+            [PersistedConversation.name, PersistedConversation.conversation_key], ['state', 'gmt_modified']
+        )
+        for kind, owner_id in dropped_data:
+            await session.execute(delete(PersistedData).where(
+                PersistedData.kind == kind,
+                PersistedData.owner_id == owner_id
+            ))
+        for name, conversation_key in ended_conversations:
+            await session.execute(delete(PersistedConversation).where(
+                PersistedConversation.name == name,
+                PersistedConversation.conversation_key == conversation_key
+            ))
         await session.commit()
-        return True
\ No newline at end of file
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+
+MAX_BODY_BYTES = 1 << 20
+
+REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large', 503: 'Service Unavailable',
+}
+
+class BadRequest(Exception):
+    def __init__(self, status):
+        super().__init__(REASONS.get(status, str(status)))
+        self.status = status
+
+async def read_request(reader):
+    """
+    Reads one HTTP/1.1 request. Returns (method, path, headers, body), or None on a closed connection.
+    Header names are lower-cased.
+    """
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise BadRequest(400)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length', '0'))
+    except ValueError:
+        raise BadRequest(400)
+    if length > MAX_BODY_BYTES:
+        raise BadRequest(413)
+    body = await reader.readexactly(length) if length else b''
+    return method, path.split('?', 1)[0], headers, body
+
+def write_response(writer, status, body=b'', content_type='text/plain; charset=utf-8', keep_alive=True):
+    head = [
+        f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}",
+        f"Content-Type: {content_type}",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+
+class HTTPServer:
+    """
+    The asyncio server plus its open connections. Closing an asyncio server only stops new
+    connections, and wait_closed() then waits for a keep-alive client to hang up, which an idle
+    one never does; shutdown() closes those connections itself.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.server = None
+        self.closing = False
+        self.connections = set()
+        # Connections waiting for their next request, as opposed to handling one
+        self.idle = set()
+
+    @property
+    def sockets(self):
+        return self.server.sockets
+
+    async def on_connection(self, reader, writer):
+        self.connections.add(asyncio.current_task())
+        try:
+            while not self.closing:
+                self.idle.add(writer)
+                try:
+                    request = await read_request(reader)
+                except BadRequest as e:
+                    write_response(writer, e.status, keep_alive=False)
+                    break
+                finally:
+                    self.idle.discard(writer)
+                if request is None:
+                    break
+
+                method, path, headers, body = request
+                status, response_body, content_type = await self.handler(method, path, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close' and not self.closing
+                write_response(writer, status, response_body, content_type, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logging.error(f"HTTP handler error: {e}")
+        finally:
+            writer.close()
+            self.connections.discard(asyncio.current_task())
+
+    async def shutdown(self):
+        """
+        Stops accepting connections, lets requests being handled finish (their responses say
+        Connection: close), closes idle connections and waits until every connection is gone.
+        """
+        self.closing = True
+        self.server.close()
+        for writer in list(self.idle):
+            writer.close()
+        # Before 3.12 wait_closed() doesn't wait for open connections
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+async def start_server(handler, host, port):
+    """
+    Serves `handler(method, path, headers, body) -> (status, body, content_type)` over plain HTTP.
+    Meant to sit behind a TLS-terminating proxy or on localhost, not to face the internet directly.
+    Returns an HTTPServer; stop it with shutdown().
+    """
+    http_server = HTTPServer(handler)
+    http_server.server = await asyncio.start_server(http_server.on_connection, host, port)
+    return http_server
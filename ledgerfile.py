@@ -0,0 +1,204 @@
+import os
+import io
+import csv
+import json
+import logging
+import tempfile
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from database import (
+    get_session, get_read_session, get_chat_users, upsert_user, check_username_exists, stream_ledger, import_ledger, LedgerRow
+)
+from money import fits_currency, exponent
+
+FORMATS = ('csv', 'jsonl')
+FIELDS = [
+    'group_id', 'group_name', 'group_created', 'record_id', 'created',
+    'from_user_id', 'from_name', 'to_user_id', 'to_name', 'currency', 'value'
+]
+# Exports and uploads stay in memory up to this size and spill to a temporary file beyond it
+SPOOL_BYTES = 1024 * 1024
+# Bots can't download files larger than 20 MB through the Bot API
+MAX_IMPORT_BYTES = 20 * 1024 * 1024
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '1000'))
+
+class LedgerFormatError(Exception):
+    pass
+
+def _iso(value):
+    return value.isoformat() if value is not None else None
+
+async def write_export(rows, names, out, fmt):
+    """
+    Writes LedgerRows from an async iterator to a text file as CSV or JSON lines, one row at a time.
+    Returns the number of rows written.
+    """
+    writer = csv.DictWriter(out, FIELDS) if fmt == 'csv' else None
+    if writer:
+        writer.writeheader()
+    count = 0
+    async for row in rows:
+        record = {
+            'group_id': row.group_id,
+            'group_name': row.group_name,
+            'group_created': _iso(row.group_created),
+            'record_id': row.pay_record_id,
+            'created': _iso(row.gmt_created),
+            'from_user_id': row.from_user_id,
+            'from_name': names.get(row.from_user_id),
+            'to_user_id': row.to_user_id,
+            'to_name': names.get(row.to_user_id),
+            'currency': row.currency,
+            'value': str(row.value),
+        }
+        if writer:
+            writer.writerow(record)
+        else:
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        count += 1
+    return count
+
+def _optional(record, key):
+    value = record.get(key)
+    return None if value is None or value == '' else value
+
+def to_ledger_row(record, names):
+    """
+    Validates one parsed CSV/JSON record into a LedgerRow, noting user names into names.
+    """
+    try:
+        from_user_id = int(record['from_user_id'])
+        to_user_id = int(record['to_user_id'])
+        currency = str(record['currency']).strip().upper()
+        value = Decimal(str(record['value']).strip())
+    except KeyError as e:
+        raise LedgerFormatError(f"missing column {e}")
+    except (ValueError, TypeError, InvalidOperation):
+        raise LedgerFormatError("from_user_id, to_user_id and value must be numbers")
+    if not (1 <= len(currency) <= 10):
+        raise LedgerFormatError(f"invalid currency {currency!r}")
+    if not value.is_finite() or value < 0 or not fits_currency(value, currency):
+        raise LedgerFormatError(f"{value} is not a valid {currency} amount ({exponent(currency)} decimal places)")
+
+    try:
+        created = _optional(record, 'created')
+        group_created = _optional(record, 'group_created')
+        created = datetime.fromisoformat(created) if created else None
+        group_created = datetime.fromisoformat(group_created) if group_created else None
+    except (ValueError, TypeError):
+        raise LedgerFormatError("dates must be in ISO 8601 format")
+
+    for user_id, key in ((from_user_id, 'from_name'), (to_user_id, 'to_name')):
+        name = _optional(record, key)
+        if name and user_id not in names:
+            names[user_id] = str(name)[:40]
+
+    group_id = _optional(record, 'group_id')
+    group_name = str(_optional(record, 'group_name') or 'Imported')[:255]
+    return LedgerRow(
+        group_id=str(group_id) if group_id is not None else None, group_name=group_name,
+        group_created=group_created, pay_record_id=None, gmt_created=created,
+        from_user_id=from_user_id, to_user_id=to_user_id, currency=currency, value=value
+    )
+
+def parse_ledger(data, fmt, names):
+    """
+    Lazily parses an uploaded binary file of CSV or JSON lines into LedgerRows.
+    Raises LedgerFormatError naming the offending line.
+    """
+    text = io.TextIOWrapper(data, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            try:
+                yield to_ledger_row(record, names)
+            except LedgerFormatError as e:
+                raise LedgerFormatError(f"Line {reader.line_num}: {e}")
+    else:
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise LedgerFormatError("expected a JSON object")
+                yield to_ledger_row(record, names)
+            except json.JSONDecodeError:
+                raise LedgerFormatError(f"Line {line_number}: not valid JSON")
+            except LedgerFormatError as e:
+                raise LedgerFormatError(f"Line {line_number}: {e}")
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [csv|jsonl]: sends this chat's ledger as a document."""
+    chat_id = update.effective_chat.id
+    thread_id = update.effective_message.message_thread_id
+    fmt = context.args[0].lower() if context.args else 'csv'
+    if fmt not in FORMATS:
+        await update.effective_message.reply_text("Usage: /export [csv|jsonl]")
+        return
+
+    async with get_read_session(chat_id, thread_id) as session:
+        names = {entry.user_id: entry.name for entry in await get_chat_users(session, chat_id, thread_id)}
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as data:
+        text = io.TextIOWrapper(data, encoding='utf-8', newline='')
+        count = await write_export(stream_ledger(chat_id, thread_id, EXPORT_BATCH_SIZE), names, text, fmt)
+        text.flush()
+        text.detach()
+        if count == 0:
+            await update.effective_message.reply_text("Nothing to export yet.")
+            return
+        data.seek(0)
+        filename = f"ledger_{chat_id}_{thread_id or 0}_{datetime.utcnow():%Y%m%d}.{fmt}"
+        # The multipart upload needs the whole body anyway; only this last step holds it in memory
+        await update.effective_message.reply_document(
+            document=data.read(), filename=filename, caption=f"📦 {count} records"
+        )
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/import as the caption of a CSV/JSONL document, or as a reply to one."""
+    message = update.effective_message
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if document is None:
+        await message.reply_text("Send a .csv or .jsonl file from /export with the caption /import, or reply to one with /import.")
+        return
+    if document.file_size and document.file_size > MAX_IMPORT_BYTES:
+        await message.reply_text("❌ File is too large; the limit is 20 MB.")
+        return
+    fmt = 'jsonl' if (document.file_name or '').lower().endswith(('.jsonl', '.json')) else 'csv'
+
+    chat_id = update.effective_chat.id
+    thread_id = message.message_thread_id
+    names = {}
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as data:
+        file = await context.bot.get_file(document.file_id)
+        await file.download_to_memory(out=data)
+        data.seek(0)
+        try:
+            count = await import_ledger(chat_id, thread_id, parse_ledger(data, fmt, names), IMPORT_BATCH_SIZE)
+        except (LedgerFormatError, UnicodeDecodeError, csv.Error) as e:
+            await message.reply_text(f"❌ Import failed, nothing was recorded.\n{e}")
+            return
+        except Exception as e:
+            logging.error(f"Import error: {e}")
+            await message.reply_text("❌ Error importing ledger, nothing was recorded.")
+            return
+
+    # Register people named in the file who aren't in this chat yet, so the ledger shows names
+    async with get_session() as session:
+        known = {entry.user_id for entry in await get_chat_users(session, chat_id, thread_id)}
+    registered = []
+    for user_id, name in names.items():
+        if user_id not in known and not await check_username_exists(chat_id, thread_id, name):
+            await upsert_user(user_id, chat_id, thread_id, name)
+            registered.append(name)
+
+    reply = f"✅ Imported {count} records."
+    if registered:
+        # Spell out who was added so the chat can spot anyone who shouldn't be there
+        reply += f"\n👤 Registered {len(registered)} new user(s) from the file: {', '.join(registered)}"
+    await message.reply_text(reply)
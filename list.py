@@ -1,11 +1,19 @@
+import os
 import math
 import logging
 from collections import defaultdict
-from sqlalchemy import select
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, tuple_
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 
-from database import get_session, PayRecord, User, PaymentGroup, PaymentGroupLink, get_chat_users
+from cache import LRUCache
+from database import (
+    get_read_session, PayRecord, User, PaymentGroup, PaymentGroupLink, get_chat_users, get_balances,
+    rebuild_balances, get_ledger_version, settled_through
+)
+from money import to_minor, format_minor, format_amount
+from querybudget import query_budget, per_chat_user
 from utils import split_lines
 
 LIST_PAGE = range(1)
@@ -13,39 +21,110 @@ LIST_PAGE = range(1)
 MAX_PAGES = 10000000
 ITEMS_PER_PAGE = 20
 
-async def generate_ledger_view(chat_id, thread_id, page_number):
-    async with get_session() as session:
-        # 1. Fetch all records in this chat
-        stmt = select(
-            PayRecord, 
-            PaymentGroup.name, 
-            PaymentGroup.group_id
-        ).outerjoin(
-            PaymentGroupLink, 
-            PayRecord.pay_record_id == PaymentGroupLink.pay_record_id
-        ).outerjoin(
-            PaymentGroup, 
-            PaymentGroupLink.group_id == PaymentGroup.group_id
-        ).where(
+EPOCH = datetime(1970, 1, 1)
+
+# Rendered (text, reply_markup) pages keyed by (chat_id, thread_id, page, cursor, ledger_version)
+ledger_cache = LRUCache(
+    maxsize=int(os.getenv('LEDGER_CACHE_SIZE', '512')),
+    ttl=float(os.getenv('LEDGER_CACHE_TTL', '300'))
+)
+
+def encode_page_cursor(direction, page_number, record):
+    """
+    Packs a page request into callback data: list_<n|p>_<page>_<gmt_created us>_<pay_record_id>.
+    'n' pages forward from the given record, 'p' pages backward from it.
+    """
+    micros = (record.gmt_created - EPOCH) // timedelta(microseconds=1)
+    return f"list_{direction}_{page_number}_{micros}_{record.pay_record_id}"
+
+def decode_page_callback(data):
+    """
+    Returns (page_number, cursor) from a pagination callback; cursor is None for list_page_<n>.
+    """
+    parts = data.split("_")
+    if parts[1] == "page":
+        return int(parts[2]), None
+    direction, page_number, micros, pay_record_id = parts[1], int(parts[2]), int(parts[3]), int(parts[4])
+    return page_number, (direction, EPOCH + timedelta(microseconds=micros), pay_record_id)
+
+async def fetch_ledger_page(session, chat_id, thread_id, page_number, total_records, cursor=None):
+    """
+    Fetches one page of history with a keyset range scan on (gmt_created, pay_record_id).
+    Returns (prev_row, page_rows) where prev_row is the row just before the page, if any,
+    so group headers carry over correctly across page boundaries.
+    """
+    sort_key = tuple_(PayRecord.gmt_created, PayRecord.pay_record_id)
+    stmt = select(
+        PayRecord,
+        PaymentGroup.name,
+        PaymentGroup.group_id
+    ).outerjoin(
+        PaymentGroupLink,
+        PayRecord.pay_record_id == PaymentGroupLink.pay_record_id
+    ).outerjoin(
+        PaymentGroup,
+        PaymentGroupLink.group_id == PaymentGroup.group_id
+    ).where(
+        PayRecord.chat_id == chat_id,
+        PayRecord.thread_id == (thread_id or 0),
+        PayRecord.pay_record_id > settled_through(chat_id, thread_id or 0)
+    )
+    ascending = (PayRecord.gmt_created.asc(), PayRecord.pay_record_id.asc())
+    descending = (PayRecord.gmt_created.desc(), PayRecord.pay_record_id.desc())
+
+    if cursor is not None:
+        direction, gmt_created, pay_record_id = cursor
+        if direction == "n":
+            # Start at the cursor row itself so it doubles as prev_row
+            stmt = stmt.where(sort_key >= (gmt_created, pay_record_id)).order_by(*ascending)
+            rows = (await session.execute(stmt.limit(ITEMS_PER_PAGE + 1))).all()
+            if rows and rows[0][0].pay_record_id == pay_record_id:
+                return rows[0], rows[1:]
+            return None, rows[:ITEMS_PER_PAGE]
+
+        stmt = stmt.where(sort_key < (gmt_created, pay_record_id)).order_by(*descending)
+        rows = (await session.execute(stmt.limit(ITEMS_PER_PAGE + 1))).all()[::-1]
+    else:
+        start_index = (page_number - 1) * ITEMS_PER_PAGE
+        if start_index + ITEMS_PER_PAGE >= total_records:
+            # Last page: read backwards from the newest record
+            limit = total_records - start_index
+            stmt = stmt.order_by(*descending).limit(limit + 1)
+            rows = (await session.execute(stmt)).all()[::-1]
+            return (rows[0], rows[1:]) if len(rows) > limit else (None, rows)
+        else:
+            stmt = stmt.order_by(*ascending).offset(max(start_index - 1, 0)).limit(ITEMS_PER_PAGE + 1)
+            rows = (await session.execute(stmt)).all()
+            return (rows[0], rows[1:]) if start_index > 0 else (None, rows[:ITEMS_PER_PAGE])
+
+    if len(rows) > ITEMS_PER_PAGE:
+        return rows[0], rows[1:]
+    return None, rows
+
+async def generate_ledger_view(chat_id, thread_id, page_number, cursor=None):
+    async with get_read_session(chat_id, thread_id) as session:
+        # 1. Count records since the last settlement in this chat
+        floor = settled_through(chat_id, thread_id or 0)
+        stmt_count = select(func.count(), floor).select_from(PayRecord).where(
             PayRecord.chat_id == chat_id,
-            PayRecord.thread_id == thread_id
-        ).order_by(PayRecord.gmt_created.asc())
-        
-        records_result = await session.execute(stmt)
-        all_rows = records_result.all()
+            PayRecord.thread_id == (thread_id or 0),
+            PayRecord.pay_record_id > floor
+        )
+        total_records, settled_id = (await session.execute(stmt_count)).one()
 
-        if not all_rows:
+        if not total_records:
+            if settled_id:
+                return "No transactions since the last settlement. All settled up! ✅", None
             return "No transactions found in this chat.", None
 
         # 2. Fetch all users in this chat
         users = await get_chat_users(session, chat_id, thread_id)
         user_map = {u.user_id: u.name for u in users}
 
-        # 3. Calculate global net balances
-        balances = defaultdict(lambda: defaultdict(float))
-        for record, _, _ in all_rows:
-            balances[record.from_user_id][record.currency] += float(record.value)
-            balances[record.to_user_id][record.currency] -= float(record.value)
+        # 3. Read global net balances
+        balances = defaultdict(dict)
+        for user_id, currency, value in await get_balances(session, chat_id, thread_id):
+            balances[user_id][currency] = to_minor(value, currency)
 
         # 4. Format net balances
         summary_text_lines = ["📊 <b>Net Balances</b>\n"]
@@ -56,12 +135,12 @@ async def generate_ledger_view(chat_id, thread_id, page_number):
             user_lines = []
             
             for currency, amount in currencies.items():
-                if abs(amount) < 0.01: 
+                if amount == 0:
                     continue
                 if amount > 0:
-                    user_lines.append(f"receives {amount:.2f} {currency}")
+                    user_lines.append(f"receives {format_minor(amount, currency)} {currency}")
                 else:
-                    user_lines.append(f"owes {abs(amount):.2f} {currency}")
+                    user_lines.append(f"owes {format_minor(-amount, currency)} {currency}")
             
             if user_lines:
                 has_balances = True
@@ -72,24 +151,20 @@ async def generate_ledger_view(chat_id, thread_id, page_number):
 
         summary_text_lines.append("\n" + "─" * 15 + "\n") # Separator
 
-        # 5. Handle pagination
-        total_records = len(all_rows)
+        # 5. Fetch the requested page
         total_pages = math.ceil(total_records / ITEMS_PER_PAGE)
 
         if page_number < 1: page_number = 1
         if page_number > total_pages: page_number = total_pages
 
-        start_index = (page_number - 1) * ITEMS_PER_PAGE
-        end_index = start_index + ITEMS_PER_PAGE
-        page_rows = all_rows[start_index:end_index]
+        prev_row, page_rows = await fetch_ledger_page(
+            session, chat_id, thread_id, page_number, total_records, cursor
+        )
 
         # 6. Format transaction history in this page
         history_text_lines = [f"📜 <b>History (Page {page_number}/{total_pages})</b>\n"]
         
-        last_group_id = None
-        
-        if start_index > 0:
-            _, _, last_group_id = all_rows[start_index - 1]
+        last_group_id = prev_row[2] if prev_row else None
 
         for record, group_name, group_id in page_rows:
             payer = user_map.get(record.from_user_id, "Unknown")
@@ -99,7 +174,7 @@ async def generate_ledger_view(chat_id, thread_id, page_number):
                 history_text_lines.append(f"\n📂 <b>{group_name}</b>")
             
             prefix = "  •" if group_id else "•"
-            history_text_lines.append(f"{prefix} {payer} ➜ {payee}: {record.value:.2f} {record.currency}")
+            history_text_lines.append(f"{prefix} {payer} ➜ {payee}: {format_amount(record.value, record.currency)} {record.currency}")
             
             last_group_id = group_id
 
@@ -108,11 +183,13 @@ async def generate_ledger_view(chat_id, thread_id, page_number):
         keyboard = []
         nav_row = []
         
-        if page_number > 1:
-            nav_row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"list_page_{page_number - 1}"))
+        if page_number > 1 and page_rows:
+            prev_data = encode_page_cursor("p", page_number - 1, page_rows[0][0])
+            nav_row.append(InlineKeyboardButton("⬅️ Prev", callback_data=prev_data))
         
-        if page_number < total_pages:
-            nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"list_page_{page_number + 1}"))
+        if page_number < total_pages and page_rows:
+            next_data = encode_page_cursor("n", page_number + 1, page_rows[-1][0])
+            nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=next_data))
         
         nav_row.append(InlineKeyboardButton("Close", callback_data="CLOSE"))
             
@@ -121,7 +198,19 @@ async def generate_ledger_view(chat_id, thread_id, page_number):
 
         return full_text, InlineKeyboardMarkup(keyboard)
 
+async def get_ledger_view(chat_id, thread_id, page_number, cursor=None):
+    """
+    Serves generate_ledger_view from ledger_cache until the chat's ledger version changes.
+    """
+    # Read the version first so a concurrent write can only make this entry unreachable
+    key = (chat_id, thread_id, page_number, cursor, get_ledger_version(chat_id, thread_id))
+    view = ledger_cache.get(key)
+    if view is None:
+        view = await generate_ledger_view(chat_id, thread_id, page_number, cursor)
+        ledger_cache.set(key, view)
+    return view
 
+@query_budget(statements=4, rows=per_chat_user(ITEMS_PER_PAGE + 2, 10))
 async def list_settlements(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     thread_id = update.effective_message.message_thread_id
@@ -129,7 +218,7 @@ async def list_settlements(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if "ledger_messages" not in context.chat_data:
         context.chat_data["ledger_messages"] = {}
     
-    text, reply_markup = await generate_ledger_view(chat_id, thread_id, page_number=MAX_PAGES)
+    text, reply_markup = await get_ledger_view(chat_id, thread_id, page_number=MAX_PAGES)
     
     if text:
         thread_key = thread_id if thread_id else "general"
@@ -145,6 +234,7 @@ async def list_settlements(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.chat_data["ledger_messages"][thread_key] = message.message_id
     return LIST_PAGE
 
+@query_budget(statements=4, rows=per_chat_user(ITEMS_PER_PAGE + 2, 10))
 async def list_pagination_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -153,12 +243,12 @@ async def list_pagination_callback(update: Update, context: ContextTypes.DEFAULT
         await query.edit_message_text("List closed.")
         return ConversationHandler.END
     
-    target_page = int(query.data.split("_")[-1])
+    target_page, cursor = decode_page_callback(query.data)
     
     chat_id = update.effective_chat.id
     thread_id = update.effective_message.message_thread_id
     
-    text, reply_markup = await generate_ledger_view(chat_id, thread_id, page_number=target_page)
+    text, reply_markup = await get_ledger_view(chat_id, thread_id, page_number=target_page, cursor=cursor)
     
     try:
         await query.edit_message_text(text, parse_mode='HTML', reply_markup=reply_markup)
@@ -168,4 +258,30 @@ async def list_pagination_callback(update: Update, context: ContextTypes.DEFAULT
     return LIST_PAGE
 
 async def close_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    return ConversationHandler.END
\ No newline at end of file
+    return ConversationHandler.END
+
+async def rebuild_balances_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    thread_id = update.effective_message.message_thread_id
+
+    try:
+        mismatches = await rebuild_balances(chat_id, thread_id)
+    except Exception as e:
+        logging.error(f"DB Error: {e}")
+        await update.message.reply_text("❌ Error rebuilding balances.")
+        return
+
+    if not mismatches:
+        await update.message.reply_text("✅ Balances verified, no mismatches found.")
+        return
+
+    async with get_read_session(chat_id, thread_id) as session:
+        users = await get_chat_users(session, chat_id, thread_id)
+    user_map = {u.user_id: u.name for u in users}
+
+    lines = [f"🛠 Fixed {len(mismatches)} balance mismatch(es):"]
+    for user_id, currency, stored, expected in mismatches:
+        name = user_map.get(user_id, "Unknown")
+        lines.append(f"• {name} {currency}: {format_amount(stored, currency)} ➜ {format_amount(expected, currency)}")
+    for msg in split_lines([line + "\n" for line in lines]):
+        await update.message.reply_text(msg)
@@ -0,0 +1,248 @@
+"""
+Prometheus-format metrics for handler latency, SQL statements and Bot API calls.
+
+Nothing here is installed unless METRICS_PORT is set: handlers are not wrapped, no engine
+events are registered and the Bot API request object is left alone, so a disabled build
+pays nothing.
+"""
+import os
+import sys
+import time
+import logging
+import functools
+import contextvars
+from sqlalchemy import event
+from telegram.ext import ConversationHandler
+from telegram.request import BaseRequest
+
+from httpserver import start_server
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labelvalues, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.children = {}
+
+    def labels(self, *labelvalues):
+        child = self.children.get(labelvalues)
+        if child is None:
+            child = self.children[labelvalues] = _HistogramChild(self.buckets)
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labelvalues, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labelvalues, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, labelvalues, [('le', '+Inf')])} {child.count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {child.sum}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {child.count}")
+        return lines
+
+class Gauge:
+    """
+    Read at scrape time from collect(), which returns {labelvalues tuple: value}.
+    """
+    def __init__(self, name, documentation, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labelvalues, value in self.collect().items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+HANDLER_SECONDS = Histogram(
+    'bot_handler_seconds', 'Handler callback latency.', ('handler', 'state'))
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total', 'Handler callbacks that raised.', ('handler', 'state'))
+HANDLER_STATEMENTS = Histogram(
+    'bot_handler_db_statements', 'SQL statements executed per handler invocation.', ('handler',), COUNT_BUCKETS)
+HANDLER_DB_SECONDS = Histogram(
+    'bot_handler_db_seconds', 'Time spent in SQL statements per handler invocation.', ('handler',))
+DB_STATEMENT_SECONDS = Histogram(
+    'bot_db_statement_seconds', 'SQL statement latency by statement type.', ('kind',))
+API_CALL_SECONDS = Histogram(
+    'bot_telegram_api_seconds', 'Bot API call latency.', ('method', 'status'))
+
+registry = [
+    HANDLER_SECONDS, HANDLER_ERRORS, HANDLER_STATEMENTS, HANDLER_DB_SECONDS,
+    DB_STATEMENT_SECONDS, API_CALL_SECONDS,
+]
+
+# [statements, seconds] for the handler running in the current task
+_handler_db_usage = contextvars.ContextVar('handler_db_usage', default=None)
+
+def state_name(callback, state):
+    """
+    Name of the module-level constant a conversation state was defined as, e.g. 'SELECT_PAYER'.
+    """
+    module = sys.modules.get(callback.__module__)
+    for name, value in vars(module).items() if module else ():
+        if name.isupper() and type(value) is type(state) and value == state:
+            return name
+    return str(state)
+
+def timed_callback(callback, state):
+    handler = callback.__name__
+    latency = HANDLER_SECONDS.labels(handler, state)
+    statements = HANDLER_STATEMENTS.labels(handler)
+    db_seconds = HANDLER_DB_SECONDS.labels(handler)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        usage = [0, 0.0]
+        token = _handler_db_usage.set(usage)
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler, state)
+            raise
+        finally:
+            latency.observe(time.perf_counter() - start)
+            statements.observe(usage[0])
+            db_seconds.observe(usage[1])
+            _handler_db_usage.reset(token)
+    return wrapper
+
+def instrument_handlers(application):
+    """
+    Wraps every handler callback, including those inside ConversationHandlers, with timing.
+    """
+    for group in application.handlers.values():
+        for handler in group:
+            if isinstance(handler, ConversationHandler):
+                for inner in handler.entry_points:
+                    inner.callback = timed_callback(inner.callback, f"{handler.name}:entry")
+                for state, inner_handlers in handler.states.items():
+                    for inner in inner_handlers:
+                        inner.callback = timed_callback(inner.callback, f"{handler.name}:{state_name(inner.callback, state)}")
+                for inner in handler.fallbacks:
+                    inner.callback = timed_callback(inner.callback, f"{handler.name}:fallback")
+            elif hasattr(handler, 'callback'):
+                handler.callback = timed_callback(handler.callback, '')
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_start
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+    DB_STATEMENT_SECONDS.labels(kind).observe(elapsed)
+    usage = _handler_db_usage.get()
+    if usage is not None:
+        usage[0] += 1
+        usage[1] += elapsed
+
+def instrument_engine(engine):
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+
+class InstrumentedRequest(BaseRequest):
+    """
+    Delegates to another request object, timing each Bot API call by method and HTTP status.
+    """
+    def __init__(self, request):
+        self.request = request
+
+    @property
+    def read_timeout(self):
+        return self.request.read_timeout
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            status, payload = await self.request.do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+            )
+            return status, payload
+        finally:
+            API_CALL_SECONDS.labels(api_method, status).observe(time.perf_counter() - start)
+
+def register_gauge(name, documentation, labelnames, collect):
+    registry.append(Gauge(name, documentation, labelnames, collect))
+
+def render():
+    lines = []
+    for metric in registry:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            logging.warning(f"Could not render metric {metric.name}: {e}")
+    return ('\n'.join(lines) + '\n').encode()
+
+async def handle_scrape(method, path, headers, body):
+    if path != '/metrics':
+        return 404, b'', 'text/plain'
+    return 200, render(), 'text/plain; version=0.0.4; charset=utf-8'
+
+server = None
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    global server
+    server = await start_server(handle_scrape, host, port)
+    logging.info(f"Metrics available on http://{host}:{port}/metrics")
+    return server
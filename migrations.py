@@ -0,0 +1,189 @@
+"""
+Schema migrations. Base.metadata.create_all only creates missing tables, so changes to tables
+that already exist are applied here, once each, in version order, and recorded in schema_version.
+
+Migrations are plain SQL against table names rather than the models in database.py: they
+describe how the schema changed at that point and must keep working as the models move on.
+Every step is idempotent, so a fresh database (whose tables create_all just made in their
+current shape) runs through them harmlessly.
+"""
+from datetime import datetime
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, select, insert, text
+
+metadata = MetaData()
+
+schema_version = Table(
+    'schema_version', metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(255), nullable=False),
+    Column('gmt_applied', DateTime, nullable=False),
+)
+
+# [(version, description, async fn(conn))]
+MIGRATIONS = []
+
+def migration(version, description):
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return decorator
+
+@migration(1, "Store a missing thread_id as 0 in every table")
+async def normalise_thread_ids(conn):
+    # users, balances and exchange_rates key on thread_id and always stored 0
+    for table in ('pay_records', 'payment_groups', 'pay_records_archive', 'payment_groups_archive'):
+        await conn.execute(text(f"UPDATE {table} SET thread_id = 0 WHERE thread_id IS NULL"))
+        if conn.dialect.name == 'postgresql':
+            # SQLite can't change a column's constraints without rebuilding the table
+            await conn.execute(text(
+                f"ALTER TABLE {table} ALTER COLUMN thread_id SET DEFAULT 0, ALTER COLUMN thread_id SET NOT NULL"
+            ))
+
+@migration(2, "Covering indexes for the ledger, undo and settle queries")
+async def covering_indexes(conn):
+    statements = [
+        # /list filters on the chat context and walks (gmt_created, pay_record_id)
+        "CREATE INDEX IF NOT EXISTS idx_pay_ledger ON pay_records (chat_id, thread_id, gmt_created, pay_record_id)",
+        # Counts, max() and the checkpoint floor range over pay_record_id within a chat context
+        "CREATE INDEX IF NOT EXISTS idx_pay_context_record ON pay_records (chat_id, thread_id, pay_record_id)",
+        "DROP INDEX IF EXISTS idx_pay_context",
+        # record -> group for the ledger join, group -> records for /undo and archiving
+        "CREATE INDEX IF NOT EXISTS idx_link_record ON payment_group_links (pay_record_id, group_id)",
+        "CREATE INDEX IF NOT EXISTS idx_link_group ON payment_group_links (group_id, pay_record_id)",
+        # /undo's latest group in a chat context; idx_group_context is a prefix of it
+        "CREATE INDEX IF NOT EXISTS idx_group_recent ON payment_groups (chat_id, thread_id, gmt_created DESC, group_id DESC)",
+        "DROP INDEX IF EXISTS idx_group_context",
+    ]
+    for statement in statements:
+        await conn.execute(text(statement))
+    if conn.dialect.name == 'postgresql':
+        await conn.execute(text("ANALYZE pay_records"))
+        await conn.execute(text("ANALYZE payment_groups"))
+        await conn.execute(text("ANALYZE payment_group_links"))
+
+@migration(3, "Cascade link deletes from groups and records")
+async def cascade_links(conn):
+    # Databases that ran migration 2 before it created idx_group_recent
+    await conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS idx_group_recent ON payment_groups (chat_id, thread_id, gmt_created DESC, group_id DESC)"
+    ))
+    if conn.dialect.name == 'postgresql':
+        for column, parent in (('group_id', 'payment_groups'), ('pay_record_id', 'pay_records')):
+            constraint = f"payment_group_links_{column}_fkey"
+            await conn.execute(text(
+                f"ALTER TABLE payment_group_links DROP CONSTRAINT IF EXISTS {constraint}, "
+                f"ADD CONSTRAINT {constraint} FOREIGN KEY ({column}) REFERENCES {parent} ({column}) ON DELETE CASCADE"
+            ))
+        return
+
+    # SQLite can't alter a foreign key, so the table is rebuilt unless it already cascades
+    foreign_keys = (await conn.execute(text("PRAGMA foreign_key_list(payment_group_links)"))).mappings().all()
+    if foreign_keys and all(fk['on_delete'] == 'CASCADE' for fk in foreign_keys):
+        return
+    statements = [
+        """CREATE TABLE payment_group_links_new (
+            link_id INTEGER NOT NULL PRIMARY KEY,
+            group_id INTEGER NOT NULL REFERENCES payment_groups (group_id) ON DELETE CASCADE,
+            pay_record_id INTEGER NOT NULL REFERENCES pay_records (pay_record_id) ON DELETE CASCADE
+        )""",
+        "INSERT INTO payment_group_links_new (link_id, group_id, pay_record_id) "
+        "SELECT link_id, group_id, pay_record_id FROM payment_group_links",
+        "DROP TABLE payment_group_links",
+        "ALTER TABLE payment_group_links_new RENAME TO payment_group_links",
+        "CREATE INDEX idx_link_record ON payment_group_links (pay_record_id, group_id)",
+        "CREATE INDEX idx_link_group ON payment_group_links (group_id, pay_record_id)",
+    ]
+    for statement in statements:
+        await conn.execute(text(statement))
+
+# Ledger tables SQLite must not reuse ids in: (columns, indexes, tables and columns ids come from)
+AUTOINCREMENT_TABLES = {
+    'pay_records': (
+        """pay_record_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        gmt_created DATETIME,
+        gmt_modified DATETIME,
+        chat_id BIGINT NOT NULL,
+        thread_id INTEGER NOT NULL DEFAULT 0,
+        from_user_id BIGINT NOT NULL,
+        to_user_id BIGINT NOT NULL,
+        currency VARCHAR(10) NOT NULL,
+        value NUMERIC(10, 2) NOT NULL""",
+        [
+            "CREATE INDEX idx_pay_ledger ON pay_records (chat_id, thread_id, gmt_created, pay_record_id)",
+            "CREATE INDEX idx_pay_context_record ON pay_records (chat_id, thread_id, pay_record_id)",
+            "CREATE INDEX idx_pay_from ON pay_records (from_user_id)",
+            "CREATE INDEX idx_pay_to ON pay_records (to_user_id)",
+        ],
+        [('pay_records', 'pay_record_id'), ('pay_records_archive', 'pay_record_id'),
+         ('settlement_checkpoints', 'last_pay_record_id')],
+    ),
+    'payment_groups': (
+        """group_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        chat_id BIGINT NOT NULL,
+        thread_id INTEGER NOT NULL DEFAULT 0,
+        name VARCHAR(255) NOT NULL,
+        gmt_created DATETIME""",
+        [
+            "CREATE INDEX idx_group_recent ON payment_groups (chat_id, thread_id, gmt_created DESC, group_id DESC)",
+        ],
+        [('payment_groups', 'group_id'), ('payment_groups_archive', 'group_id'),
+         ('settlement_checkpoints', 'last_group_id')],
+    ),
+    'payment_group_links': (
+        """link_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        group_id INTEGER NOT NULL REFERENCES payment_groups (group_id) ON DELETE CASCADE,
+        pay_record_id INTEGER NOT NULL REFERENCES pay_records (pay_record_id) ON DELETE CASCADE""",
+        [
+            "CREATE INDEX idx_link_record ON payment_group_links (pay_record_id, group_id)",
+            "CREATE INDEX idx_link_group ON payment_group_links (group_id, pay_record_id)",
+        ],
+        [('payment_group_links', 'link_id'), ('payment_group_links_archive', 'link_id')],
+    ),
+}
+
+@migration(4, "Never reuse ledger ids on SQLite")
+async def sqlite_autoincrement(conn):
+    # Without AUTOINCREMENT SQLite hands out max(id) + 1, so archiving the newest settled rows
+    # frees ids a checkpoint already covers. PostgreSQL sequences never go back.
+    if conn.dialect.name != 'sqlite':
+        return
+    for table, (columns, indexes, id_sources) in AUTOINCREMENT_TABLES.items():
+        create_sql = (await conn.execute(
+            text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table}
+        )).scalar_one()
+        if 'AUTOINCREMENT' not in create_sql.upper():
+            copied = ', '.join(line.split()[0] for line in columns.split(',\n'))
+            await conn.execute(text(f"CREATE TABLE {table}_new ({columns})"))
+            await conn.execute(text(f"INSERT INTO {table}_new ({copied}) SELECT {copied} FROM {table}"))
+            await conn.execute(text(f"DROP TABLE {table}"))
+            await conn.execute(text(f"ALTER TABLE {table}_new RENAME TO {table}"))
+            for statement in indexes:
+                await conn.execute(text(statement))
+
+        # Start above every id already handed out, including archived and checkpointed ones
+        sources = [f"(SELECT coalesce(max({column}), 0) FROM {source})" for source, column in id_sources]
+        sources.append(f"(SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = '{table}')")
+        floor = (await conn.execute(text(f"SELECT max({', '.join(sources)})"))).scalar_one()
+        await conn.execute(text("DELETE FROM sqlite_sequence WHERE name = :name"), {'name': table})
+        await conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"), {'name': table, 'seq': floor})
+
+async def migrate(engine):
+    """
+    Applies the migrations this database hasn't seen yet, each in its own transaction.
+    Returns the versions applied.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+        applied = set((await conn.execute(select(schema_version.c.version))).scalars().all())
+
+    done = []
+    for version, description, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        async with engine.begin() as conn:
+            await fn(conn)
+            await conn.execute(insert(schema_version).values(
+                version=version, description=description, gmt_applied=datetime.utcnow()
+            ))
+        done.append(version)
+    return done
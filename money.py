@@ -0,0 +1,59 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# Minor-unit exponents for currencies that don't use 2 decimal places
+CURRENCY_EXPONENTS = {
+    'JPY': 0, 'KRW': 0, 'VND': 0, 'CLP': 0, 'ISK': 0, 'IDR': 0,
+    'BHD': 3, 'KWD': 3, 'OMR': 3, 'JOD': 3, 'TND': 3,
+}
+DEFAULT_EXPONENT = 2
+
+def exponent(currency):
+    return CURRENCY_EXPONENTS.get(currency, DEFAULT_EXPONENT)
+
+def to_minor(amount, currency):
+    """
+    Converts an amount (Decimal, str, int or float) to integer minor units, rounding half up.
+    """
+    if isinstance(amount, float):
+        amount = str(amount)
+    scaled = Decimal(amount).scaleb(exponent(currency))
+    return int(scaled.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def from_minor(minor, currency):
+    """
+    Converts integer minor units back to a Decimal, e.g. for a Numeric column.
+    """
+    return Decimal(minor).scaleb(-exponent(currency))
+
+def format_minor(minor, currency):
+    return f"{from_minor(minor, currency):.{exponent(currency)}f}"
+
+def format_amount(amount, currency):
+    return format_minor(to_minor(amount, currency), currency)
+
+def fits_currency(amount, currency):
+    """
+    Whether an amount can be expressed in the currency's minor units without rounding.
+    """
+    return Decimal(amount).scaleb(exponent(currency)) == to_minor(amount, currency)
+
+def parse_amount(text, max_places=2):
+    """
+    Parses user input into a finite Decimal with at most max_places decimal places.
+    Raises ValueError for anything else.
+    """
+    try:
+        amount = Decimal(text.strip())
+    except InvalidOperation:
+        raise ValueError(f"Not a number: {text!r}")
+    if not amount.is_finite() or -amount.as_tuple().exponent > max_places:
+        raise ValueError(f"Not an amount with at most {max_places} decimal places: {text!r}")
+    return amount
+
+def split_evenly(total_minor, parts):
+    """
+    Splits total_minor into `parts` integer shares that add up exactly.
+    The first `total_minor % parts` shares carry the extra unit, so the split is deterministic.
+    """
+    share, remainder = divmod(total_minor, parts)
+    return [share + 1 if i < remainder else share for i in range(parts)]
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import warnings
+from datetime import timedelta
+from telegram.error import RetryAfter
+from telegram.warnings import PTBDeprecationWarning
+from telegram.ext import BaseRateLimiter
+
+from cache import LRUCache
+
+# Telegram allows roughly 30 messages/s overall and 20 messages/min in one group
+GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+GLOBAL_BURST = int(os.getenv('OUTBOUND_GLOBAL_BURST', '30'))
+CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', str(20 / 60)))
+CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '20'))
+MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+
+# Only calls that post, change or remove messages count against the global limit; every call is retried on RetryAfter
+LIMITED_PREFIXES = ('send', 'edit', 'delete', 'copy', 'forward')
+# The 20/min limit counts new messages in a group; private chats and edits aren't subject to it
+GROUP_SEND_PREFIXES = ('send', 'copy', 'forward')
+
+class TokenBucket:
+    """
+    Reservation-style bucket: take() always succeeds and returns how long the caller must wait,
+    so concurrent callers queue up in arrival order without a lock.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+def retry_delay(error):
+    # retry_after is a number of seconds until PTB_TIMEDELTA opts into timedelta, and warns meanwhile
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', PTBDeprecationWarning)
+        delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+def is_group_chat(chat_id):
+    # Group, supergroup and channel ids are negative; @usernames only ever name public ones
+    return isinstance(chat_id, str) or (chat_id is not None and int(chat_id) < 0)
+
+def content_hash(data):
+    payload = {
+        key: value.to_dict() if hasattr(value, 'to_dict') else value
+        for key, value in data.items()
+        if key in ('text', 'parse_mode', 'reply_markup', 'caption')
+    }
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True, default=str).encode(), digest_size=16).digest()
+
+class OutboundDispatcher(BaseRateLimiter):
+    """
+    Paces outbound Bot API calls through a global token bucket, and new messages in groups
+    through a per-chat one as well.
+
+    Edits whose content matches what the message already shows are dropped, returning True as
+    the Bot API does for edits it doesn't echo, and RetryAfter responses are retried after the
+    server's delay.
+    """
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, max_retries=MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets = LRUCache(maxsize=10000)
+        # (chat_id, message_id) -> hash of the content the message currently shows
+        self.shown = LRUCache(maxsize=50000)
+        self.stats = {'sent': 0, 'noop_dropped': 0, 'retries': 0, 'waited_seconds': 0.0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        limited = endpoint.startswith(LIMITED_PREFIXES)
+        chat_id = data.get('chat_id')
+        message_key = (chat_id, data.get('message_id')) if data.get('message_id') is not None else None
+
+        if endpoint.startswith('edit') and message_key is not None:
+            if self.shown.get(message_key) == content_hash(data):
+                self.stats['noop_dropped'] += 1
+                return True
+
+        group_send = endpoint.startswith(GROUP_SEND_PREFIXES) and is_group_chat(chat_id)
+        chat_bucket = self._chat_bucket(chat_id) if group_send else None
+        for attempt in range(self.max_retries + 1):
+            wait = max(self.global_bucket.take() if limited else 0.0, chat_bucket.take() if chat_bucket else 0.0)
+            if wait > 0:
+                self.stats['waited_seconds'] += wait
+                await asyncio.sleep(wait)
+
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = retry_delay(e)
+                if attempt == self.max_retries:
+                    raise
+                self.stats['retries'] += 1
+                logging.warning(f"{endpoint} to {chat_id} rate limited, retrying in {delay}s")
+                if chat_bucket:
+                    chat_bucket.block(delay)
+                else:
+                    await asyncio.sleep(delay)
+                continue
+
+            self.stats['sent'] += 1
+            self._remember(endpoint, chat_id, message_key, data, result)
+            return result
+
+    def _remember(self, endpoint, chat_id, message_key, data, result):
+        if endpoint.startswith('delete'):
+            if message_key is not None:
+                self.shown.pop(message_key)
+            return
+        if endpoint == 'sendMessage' and isinstance(result, dict) and 'message_id' in result:
+            self.shown.set((chat_id, result['message_id']), content_hash(data))
+        elif endpoint.startswith('edit') and message_key is not None:
+            self.shown.set(message_key, content_hash(data))
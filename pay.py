@@ -1,15 +1,29 @@
 import logging
-import json
 import asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 
-from database import get_session, get_chat_users, create_full_transaction, delete_last_transaction
+import callbacks
+from callbacks import USER, SINGLE_PAYEE, SPLIT_ALL, SPLIT_AMOUNTS, CANCEL, FINISH, CANCEL_ROW, SPLIT_ROWS
+from database import get_read_session, get_chat_users, create_full_transaction, delete_last_transaction
+from money import parse_amount, fits_currency, format_amount, exponent
+from querybudget import query_budget, per_chat_user
 from utils import get_chat_thread_user_id
 
 SELECT_PAYER, ENTER_COMMENT, ENTER_AMOUNT, SELECT_CURRENCY, SELECT_PAYEE, \
     SELECT_CONSUMER_FOR_SPLIT, ENTER_CONSUMER_AMOUNT = range(7)
 
+# Currency codes are short enough to be their own callback data
+CURRENCY_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(curr, callback_data=curr) for curr in row] for row in (
+        ["SGD", "MYR", "USD", "EUR"],
+        ["CNY", "THB", "VND", "HKD"],
+        ["JPY", "GBP", "CAD", "AUD"],
+        ["CHF", "NZD", "SEK", "NOK"],
+    )] + [CANCEL_ROW]
+)
+
+@query_budget(statements=1, rows=per_chat_user(0, 1))
 async def start_pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Step 1: Fetch users and ask who paid."""
     context.user_data.clear()
@@ -21,7 +35,7 @@ async def start_pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     context.user_data['initiator_id'] = user_id
 
-    async with get_session() as session:
+    async with get_read_session(chat_id, thread_id) as session:
         users = await get_chat_users(session, chat_id, thread_id)
         context.user_data['user_map'] = {u.user_id: u.name for u in users}
 
@@ -29,11 +43,8 @@ async def start_pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Need at least 2 registered users. Use /register first.")
         return ConversationHandler.END
 
-    keyboard = []
-    for user in users:
-        keyboard.append([InlineKeyboardButton(user.name, callback_data=str(user.user_id))])
-
-    keyboard.append([InlineKeyboardButton("❌ Cancel", callback_data="CANCEL")])
+    keyboard = [(button,) for _, button in user_keyboard(update, context, USER)]
+    keyboard.append(CANCEL_ROW)
 
     await update.message.reply_text(
         "💸 New Payment Record\n\nWho **PAID** the money?",
@@ -42,16 +53,27 @@ async def start_pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return SELECT_PAYER
 
+def user_keyboard(update, context, kind, exclude=None):
+    return callbacks.user_buttons(context.user_data['user_map'], kind, exclude)
+
+async def expired_button(query):
+    await query.edit_message_text("⌛ This button has expired. Please start again.")
+    return ConversationHandler.END
+
+@query_budget(statements=0)
 async def select_payer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Step 2: Save payer and ask for comment."""
     query = update.callback_query
     await query.answer()
 
-    if query.data == "CANCEL":
+    kind, values = callbacks.decode(query.data)
+    if kind == CANCEL:
         await query.edit_message_text("❌ Transaction cancelled.")
         return ConversationHandler.END
+    if kind != USER:
+        return await expired_button(query)
 
-    payer_id = int(query.data)
+    payer_id = values[0]
     context.user_data['payer_id'] = payer_id
     context.user_data['payer_name'] = context.user_data['user_map'].get(payer_id, "Unknown")
 
@@ -61,6 +83,7 @@ async def select_payer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return ENTER_COMMENT
 
+@query_budget(statements=0)
 async def enter_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Step 3: Save comment and ask for total amount."""
     if not is_message_sender_initiator(update, context):
@@ -76,6 +99,7 @@ async def enter_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return ENTER_AMOUNT
 
+@query_budget(statements=0)
 async def enter_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Step 4: Validate amount and ask for currency."""
     if not is_message_sender_initiator(update, context):
@@ -90,7 +114,7 @@ async def enter_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if len(decimal_part) > 2:
                 await update.message.reply_text("Invalid amount. Please limit to 2 decimal places (e.g., 10.50).")
                 return ENTER_AMOUNT
-        amount = float(text)
+        amount = parse_amount(text)
         if amount <= 0:
             raise ValueError
         context.user_data['amount'] = amount
@@ -98,51 +122,40 @@ async def enter_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Invalid amount. Please enter a positive number.")
         return ENTER_AMOUNT
 
-    currencies_1 = ["SGD", "MYR", "USD", "EUR"]
-    currencies_2 = ["CNY", "THB", "VND", "HKD"]
-    currencies_3 = ["JPY", "GBP", "CAD", "AUD"]
-    currencies_4 = ["CHF", "NZD", "SEK", "NOK"]
-    keyboard = [[InlineKeyboardButton(curr, callback_data=curr) for curr in currencies_1]]
-    keyboard.append([InlineKeyboardButton(curr, callback_data=curr) for curr in currencies_2])
-    keyboard.append([InlineKeyboardButton(curr, callback_data=curr) for curr in currencies_3])
-    keyboard.append([InlineKeyboardButton(curr, callback_data=curr) for curr in currencies_4])
-    keyboard.append([InlineKeyboardButton("❌ Cancel", callback_data="CANCEL")])
-
     await update.message.reply_text(
         f"💵 Amount: {amount}\nSelect **CURRENCY**:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=CURRENCY_KEYBOARD,
         parse_mode='Markdown'
     )
     return SELECT_CURRENCY
 
+@query_budget(statements=0)
 async def select_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Step 5: Save Currency and prompt for Payee type."""
     query = update.callback_query
     await query.answer()
 
-    if query.data == "CANCEL":
+    if callbacks.decode(query.data)[0] == CANCEL:
         await query.edit_message_text("❌ Transaction cancelled.")
         return ConversationHandler.END
 
-    context.user_data['currency'] = query.data
+    currency = query.data
+    if not fits_currency(context.user_data['amount'], currency):
+        await query.edit_message_text(
+            f"❌ {currency} amounts allow at most {exponent(currency)} decimal places.\n\n"
+            f"💰 Enter the **TOTAL AMOUNT** again:\n/cancel to cancel",
+            parse_mode='Markdown'
+        )
+        return ENTER_AMOUNT
+
+    context.user_data['currency'] = currency
 
     payer_id = context.user_data['payer_id']
     payer_name = context.user_data['payer_name']
 
-    keyboard = []
-    for user_id, name in context.user_data['user_map'].items():
-        if user_id != payer_id:
-            keyboard.append([InlineKeyboardButton(name, callback_data=json.dumps({
-                'type': 'SINGLE_PAYEE',
-                'id': str(user_id)
-            }))])
-    keyboard.append([InlineKeyboardButton("👨‍👩‍👧‍👦 Split Equally (All)", callback_data=json.dumps({
-        'type': "SPLIT_ALL"
-    }))])
-    keyboard.append([InlineKeyboardButton("📝 Split by amounts", callback_data=json.dumps({
-        'type': "SPLIT_AMOUNTS"
-    }))])
-    keyboard.append([InlineKeyboardButton("❌ Cancel", callback_data="CANCEL")])
+    keyboard = [(button,) for _, button in user_keyboard(update, context, SINGLE_PAYEE, exclude=payer_id)]
+    keyboard.extend(SPLIT_ROWS)
+    keyboard.append(CANCEL_ROW)
 
     await query.edit_message_text(
         f"✅ **{payer_name}** paid.\n\nWho is this **FOR**?",
@@ -151,16 +164,24 @@ async def select_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return SELECT_PAYEE
 
+@query_budget(statements=6, rows=per_chat_user(2, 2))
 async def select_payee(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Step 6: Branch logic: Detailed Split vs Simple Save."""
     query = update.callback_query
     await query.answer()
 
-    if query.data == "CANCEL":
+    kind, values = callbacks.decode(query.data)
+    if kind == CANCEL:
         await query.edit_message_text("❌ Transaction cancelled.")
         return ConversationHandler.END
-
-    payee_data = json.loads(query.data)
+    if kind == SINGLE_PAYEE:
+        payee_data = {'type': 'SINGLE_PAYEE', 'id': str(values[0])}
+    elif kind == SPLIT_ALL:
+        payee_data = {'type': 'SPLIT_ALL'}
+    elif kind == SPLIT_AMOUNTS:
+        payee_data = {'type': 'SPLIT_AMOUNTS'}
+    else:
+        return await expired_button(query)
     context.user_data['payee_data'] = payee_data
 
     if payee_data['type'] == "SPLIT_AMOUNTS":
@@ -174,6 +195,7 @@ async def select_payee(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def prompt_consumer_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Helper to show available users to allocate amounts to."""
     total_amount = context.user_data['amount']
+    currency = context.user_data['currency']
     allocations = context.user_data['split_allocations']
     current_spent = sum(allocations.values())
     remaining = total_amount - current_spent
@@ -182,27 +204,26 @@ async def prompt_consumer_selection(update: Update, context: ContextTypes.DEFAUL
     payer_name = context.user_data['payer_name']
 
     keyboard = []
-    for user_id, name in context.user_data['user_map'].items():
-        if user_id != payer_id:
-            label = name
-            if user_id in allocations:
-                label = f"{name} ({allocations[user_id]:.2f})"
-            keyboard.append([InlineKeyboardButton(label, callback_data=str(user_id))])
+    for user_id, button in user_keyboard(update, context, USER, exclude=payer_id):
+        if user_id in allocations:
+            label = f"{button.text} ({format_amount(allocations[user_id], currency)})"
+            button = InlineKeyboardButton(label, callback_data=button.callback_data)
+        keyboard.append((button,))
 
     payer_label = f"🧑‍💻 {payer_name} (Payer)"
     if payer_id in allocations:
-        payer_label = f"🧑‍💻 {payer_name} ({allocations[payer_id]:.2f})"
-    keyboard.append([InlineKeyboardButton(payer_label, callback_data=str(payer_id))])
+        payer_label = f"🧑‍💻 {payer_name} ({format_amount(allocations[payer_id], currency)})"
+    keyboard.append((InlineKeyboardButton(payer_label, callback_data=callbacks.encode(USER, payer_id)),))
 
     if current_spent > 0:
-        finish_lbl = f"✅ FINISH ({remaining:.2f} left)"
-        keyboard.append([InlineKeyboardButton(finish_lbl, callback_data="FINISH_SPLIT")])
+        finish_lbl = f"✅ FINISH ({format_amount(remaining, currency)} left)"
+        keyboard.append((InlineKeyboardButton(finish_lbl, callback_data=callbacks.encode(FINISH)),))
 
-    keyboard.append([InlineKeyboardButton("❌ Cancel", callback_data="CANCEL")])
+    keyboard.append(CANCEL_ROW)
 
-    msg = (f"**Total:** {total_amount:.2f}\n"
-           f"**Allocated:** {current_spent:.2f}\n"
-           f"**Remaining:** {remaining:.2f}\n\n"
+    msg = (f"**Total:** {format_amount(total_amount, currency)}\n"
+           f"**Allocated:** {format_amount(current_spent, currency)}\n"
+           f"**Remaining:** {format_amount(remaining, currency)}\n\n"
            f"Select a person to add or modify:")
 
     if update.callback_query:
@@ -212,19 +233,24 @@ async def prompt_consumer_selection(update: Update, context: ContextTypes.DEFAUL
 
     return SELECT_CONSUMER_FOR_SPLIT
 
+@query_budget(statements=6, rows=per_chat_user(2, 2))
 async def select_consumer_for_split(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Step 7: Handle selection of a specific consumer in detailed split."""
     query = update.callback_query
     await query.answer()
 
-    if query.data == "CANCEL":
+    kind, values = callbacks.decode(query.data)
+    if kind == CANCEL:
         await query.edit_message_text("❌ Transaction cancelled.")
         return ConversationHandler.END
 
-    if query.data == "FINISH_SPLIT":
+    if kind == FINISH:
         return await finalize_split(update, context, detailed=True)
 
-    consumer_id = int(query.data)
+    if kind != USER:
+        return await expired_button(query)
+
+    consumer_id = values[0]
     context.user_data['current_consumer_id'] = consumer_id
 
     consumer_name = context.user_data['user_map'].get(consumer_id, "Unknown")
@@ -232,14 +258,15 @@ async def select_consumer_for_split(update: Update, context: ContextTypes.DEFAUL
     current_val = context.user_data['split_allocations'].get(consumer_id)
 
     total_amount = context.user_data['amount']
+    currency = context.user_data['currency']
     current_spent = sum(context.user_data['split_allocations'].values())
     remaining = total_amount - current_spent
 
     prompt_text = f"👤 Selected: **{consumer_name}**\n"
-    prompt_text += f"💸 Remaining to allocate: {remaining:.2f}\n"
+    prompt_text += f"💸 Remaining to allocate: {format_amount(remaining, currency)}\n"
 
     if current_val is not None:
-        prompt_text += f"✏️ **Current allocation:** {current_val:.2f}\n\n"
+        prompt_text += f"✏️ **Current allocation:** {format_amount(current_val, currency)}\n\n"
     else:
         prompt_text += "\n"
 
@@ -248,6 +275,7 @@ async def select_consumer_for_split(update: Update, context: ContextTypes.DEFAUL
     await query.edit_message_text(prompt_text, parse_mode='Markdown')
     return ENTER_CONSUMER_AMOUNT
 
+@query_budget(statements=0)
 async def enter_consumer_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Step 8: Save amount for consumer and loop back."""
     if not is_message_sender_initiator(update, context):
@@ -258,11 +286,12 @@ async def enter_consumer_amount(update: Update, context: ContextTypes.DEFAULT_TY
     consumer_id = context.user_data.get('current_consumer_id')
 
     try:
+        places = exponent(context.user_data['currency'])
         if "." in text:
-            if len(text.split(".")[1]) > 2:
-                await update.message.reply_text("Limit to 2 decimal places.")
+            if len(text.split(".")[1]) > places:
+                await update.message.reply_text(f"Limit to {places} decimal places.")
                 return ENTER_CONSUMER_AMOUNT
-        val = float(text)
+        val = parse_amount(text, max_places=places)
         if val < 0: raise ValueError
 
         context.user_data['split_allocations'][consumer_id] = val
@@ -287,7 +316,7 @@ async def finalize_split(update, context, detailed=False):
 
     if detailed:
         allocated_sum = sum(data['split_allocations'].values())
-        if allocated_sum > total_amount + 0.05: 
+        if allocated_sum > total_amount:
             error_msg = "❌ Total allocated exceeds original amount. Please retry."
             if update.callback_query:
                 await update.callback_query.edit_message_text(error_msg)
@@ -297,7 +326,7 @@ async def finalize_split(update, context, detailed=False):
             return await prompt_consumer_selection(update, context)
 
         remaining = total_amount - allocated_sum
-        if remaining > 0.01:
+        if remaining > 0:
             payer_id = data['payer_id']
             data['split_allocations'][payer_id] = data['split_allocations'].get(payer_id, 0) + remaining
 
@@ -318,24 +347,24 @@ async def finalize_split(update, context, detailed=False):
         )
 
         if detailed:
-            payee_info = [f"{value:.2f} to {user_map.get(id)}" for (id, value) in data['split_allocations'].items()]
+            payee_info = [f"{format_amount(value, data['currency'])} to {user_map.get(id)}" for (id, value) in data['split_allocations'].items()]
             msg = (f"✅ **Manual Split Recorded!**\n"
                    f"📌 {data['description']}\n"
                    f"👤 Payer: {payer_name}\n"
-                   f"💵 Total: {total_amount:.2f} {data['currency']}\n"
+                   f"💵 Total: {format_amount(total_amount, data['currency'])} {data['currency']}\n"
                    f"{'\n'.join(payee_info)}")
         elif payee_arg['type'] == "SPLIT_ALL":
             msg = (f"✅ **Equal Split Recorded!**\n"
                    f"📌 {data['description']}\n"
                    f"👤 Payer: {payer_name}\n"
-                   f"💵 Total: {total_amount:.2f} {data['currency']}\n"
+                   f"💵 Total: {format_amount(total_amount, data['currency'])} {data['currency']}\n"
                    f"🔗 Split among {record_count} people")
         else:
             msg = (f"✅ **Payment Recorded!**\n"
                    f"📌 {data['description']}\n"
                    f"👤 From: {payer_name}\n"
                    f"👤 To: {user_map.get(int(payee_arg['id']))}\n"
-                   f"💵 Amount: {total_amount:.2f} {data['currency']}")
+                   f"💵 Amount: {format_amount(total_amount, data['currency'])} {data['currency']}")
 
         if update.callback_query:
             await update.callback_query.edit_message_text(msg, parse_mode='Markdown')
@@ -361,13 +390,25 @@ def is_message_sender_initiator(update: Update, context: ContextTypes.DEFAULT_TY
     sender_id = update.effective_user.id
     return sender_id == initiator_id
 
+@query_budget(statements=6, rows=per_chat_user(2, 2))
 async def undo_pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id, thread_id, user_id = get_chat_thread_user_id(update)
     try:
-        await delete_last_transaction(user_id, chat_id, thread_id)
-        success_msg = f"✅ **Last transaction deleted**"
+        deleted = await delete_last_transaction(user_id, chat_id, thread_id)
+        if deleted is None:
+            await update.message.reply_text("Nothing to undo in this chat.")
+            return
+
+        totals = {}
+        for _, _, currency, value in deleted.records:
+            totals[currency] = totals.get(currency, 0) + value
+        total_text = ", ".join(f"{format_amount(value, currency)} {currency}" for currency, value in totals.items())
+
+        success_msg = (f"✅ Last transaction deleted\n"
+                       f"📌 {deleted.name}\n"
+                       f"🔗 {len(deleted.records)} record(s), {total_text}")
         await update.message.reply_text(success_msg)
     except Exception as e: 
         logging.error(f"DB Error: {e}")
-        error_msg = "❌ Error saving transaction."
+        error_msg = "❌ Error deleting transaction."
         await update.message.reply_text(error_msg)
\ No newline at end of file
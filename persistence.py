@@ -0,0 +1,182 @@
+import os
+import json
+import pickle
+import asyncio
+import logging
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import (
+    ensure_db, load_persisted_data, load_persisted_conversations, save_persisted_batch
+)
+
+USER, CHAT = 'user', 'chat'
+
+# A failed flush is retried after FLUSH_RETRY_DELAY, doubling each time up to FLUSH_RETRY_MAX_DELAY
+FLUSH_RETRY_DELAY = float(os.getenv('PERSISTENCE_RETRY_DELAY', '1'))
+FLUSH_RETRY_MAX_DELAY = float(os.getenv('PERSISTENCE_RETRY_MAX_DELAY', '60'))
+
+class DatabasePersistence(BasePersistence):
+    """
+    Stores user_data, chat_data and ConversationHandler states in the bot's database.
+
+    Writes are write-behind: the Application hands over changed data every update_interval
+    seconds, we only remember the latest copy per key, and the whole batch is written in one
+    transaction right after. user_data/chat_data are loaded lazily the first time a chat or
+    user shows up, so startup only reads conversation states (active conversations only).
+    bot_data and callback_data are not stored.
+    """
+    def __init__(self, db_url, update_interval=10):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db_url = db_url
+        self._loaded = {USER: set(), CHAT: set()}
+        self._dirty_data = {}
+        self._dirty_conversations = {}
+        self._flush_task = None
+        self._closing = asyncio.Event()
+
+    # Data is loaded lazily through refresh_*_data instead
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        await ensure_db(self.db_url)
+        rows = await load_persisted_conversations(name)
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._load_into(USER, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._load_into(CHAT, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def _load_into(self, kind, owner_id, data):
+        if owner_id in self._loaded[kind]:
+            return
+        await ensure_db(self.db_url)
+        blob = await load_persisted_data(kind, owner_id)
+        self._loaded[kind].add(owner_id)
+        if blob is not None:
+            # Anything already written in memory is newer than what was stored
+            for key, value in pickle.loads(blob).items():
+                data.setdefault(key, value)
+
+    async def update_user_data(self, user_id, data):
+        self._mark_dirty(USER, user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._mark_dirty(CHAT, chat_id, data)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._mark_dirty(USER, user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._mark_dirty(CHAT, chat_id, None)
+
+    async def update_conversation(self, name, key, new_state):
+        self._dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_flush()
+
+    def _mark_dirty(self, kind, owner_id, data):
+        # None means drop; either way only the latest change per key is written
+        self._dirty_data[(kind, owner_id)] = data
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # The Application hands over a whole round of updates at once, so flushing on the
+        # next loop iteration writes them as one batch
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        """
+        Writes batches until nothing is dirty, so changes made while a batch was being written
+        go out right after it, and retries failed batches with a capped exponential backoff.
+        """
+        failures = 0
+        while (self._dirty_data or self._dirty_conversations) and not self._closing.is_set():
+            if await self._write_batch():
+                failures = 0
+                continue
+            failures += 1
+            delay = min(FLUSH_RETRY_MAX_DELAY, FLUSH_RETRY_DELAY * 2 ** (failures - 1))
+            logging.error(f"Persistence flush failed {failures} time(s), retrying in {delay}s")
+            try:
+                # flush() at shutdown cuts the wait short
+                await asyncio.wait_for(self._closing.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _write_batch(self):
+        """
+        Writes everything dirty in one transaction. Returns False if that failed, in which
+        case the batch is dirty again.
+        """
+        dirty_data, self._dirty_data = self._dirty_data, {}
+        dirty_conversations, self._dirty_conversations = self._dirty_conversations, {}
+        if not dirty_data and not dirty_conversations:
+            return True
+
+        data_rows = []
+        dropped_data = []
+        for (kind, owner_id), data in dirty_data.items():
+            if data is None:
+                dropped_data.append((kind, owner_id))
+            else:
+                data_rows.append(dict(kind=kind, owner_id=owner_id, data=pickle.dumps(data)))
+
+        conversation_rows = []
+        ended_conversations = []
+        for (name, key), state in dirty_conversations.items():
+            if state is None:
+                ended_conversations.append((name, key))
+            else:
+                conversation_rows.append(dict(name=name, conversation_key=key, state=pickle.dumps(state)))
+
+        try:
+            await save_persisted_batch(data_rows, dropped_data, conversation_rows, ended_conversations)
+        except Exception as e:
+            logging.error(f"Persistence flush failed: {e}")
+            # Put the batch back unless something newer arrived meanwhile
+            for key, value in dirty_data.items():
+                self._dirty_data.setdefault(key, value)
+            for key, value in dirty_conversations.items():
+                self._dirty_conversations.setdefault(key, value)
+            return False
+        logging.debug(
+            f"Persisted {len(dirty_data)} data and {len(dirty_conversations)} conversation changes."
+        )
+        return True
+
+    async def flush(self):
+        self._closing.set()
+        try:
+            if self._flush_task is not None:
+                await self._flush_task
+            if not await self._write_batch():
+                logging.error(
+                    f"Lost {len(self._dirty_data)} data and {len(self._dirty_conversations)} "
+                    f"conversation changes at shutdown."
+                )
+        finally:
+            self._closing.clear()
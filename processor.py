@@ -0,0 +1,135 @@
+import asyncio
+from telegram.ext import BaseUpdateProcessor
+
+def update_chat_key(update):
+    """
+    (chat_id, thread_id) an update belongs to, or None for updates without a chat.
+    """
+    chat = getattr(update, 'effective_chat', None)
+    if chat is None:
+        return None
+    message = update.effective_message
+    return chat.id, (message.message_thread_id if message else None) or 0
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates from different chats concurrently while updates within one (chat_id, thread_id)
+    run one at a time, in arrival order, so conversation state never sees interleaved steps.
+
+    The base class bounds the updates inside do_process_update (waiting on their chat or
+    running) at max_pending_updates; the queue from create_queue() reserves one of those
+    slots before handing an update out. A separate running semaphore caps how many handlers
+    actually run, and is taken only once an update holds its chat lock, so a busy chat never
+    occupies running slots other chats need.
+    """
+    def __init__(self, max_concurrent_updates, max_pending_updates=None):
+        self.max_pending_updates = max_pending_updates or max_concurrent_updates * 64
+        # Bounding admitted updates by max_concurrent_updates would let one chat's backlog,
+        # waiting on its lock, fill every slot
+        super().__init__(self.max_pending_updates)
+        self.max_running_updates = max_concurrent_updates
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._pending = asyncio.Semaphore(self.max_pending_updates)
+        self._running_count = 0
+        self._admitted = 0
+        self._reserved = 0
+        self._chat_locks = {}
+        self._chat_depths = {}
+
+    def create_queue(self, maxsize=0):
+        """
+        Update queue for the Application. In concurrent mode the Application starts a task for
+        every update it takes off its queue, so this queue holds updates back until one of the
+        max_pending_updates slots is free; a bounded queue then fills and its producers wait.
+        """
+        return AdmissionQueue(self, maxsize)
+
+    async def reserve(self):
+        """
+        Takes a pending slot for an update about to be handed to process_update.
+        """
+        await self._pending.acquire()
+        self._reserved += 1
+
+    def unreserve(self):
+        self._reserved -= 1
+        self._pending.release()
+
+    def chat_depths(self):
+        """
+        Snapshot of {(chat_id, thread_id): updates waiting or running} for chats with a backlog.
+        """
+        return dict(self._chat_depths)
+
+    def stats(self):
+        depths = self._chat_depths.values()
+        return {
+            'running': self._running_count,
+            'admitted': self._admitted,
+            'queued': sum(depths),
+            'busy_chats': len(self._chat_depths),
+            'max_chat_depth': max(depths, default=0),
+        }
+
+    async def do_process_update(self, update, coroutine):
+        # The base class caps admitted updates; ones from create_queue() also reserved a
+        # pending slot before leaving the queue, held until they are done
+        reserved = self._reserved > 0
+        if reserved:
+            self._reserved -= 1
+        self._admitted += 1
+        try:
+            key = update_chat_key(update)
+            if key is None:
+                await self._run(coroutine)
+                return
+
+            # Locks are FIFO and tasks reach this point in arrival order, which preserves ordering
+            lock = self._chat_locks.get(key)
+            if lock is None:
+                lock = self._chat_locks[key] = asyncio.Lock()
+            self._chat_depths[key] = self._chat_depths.get(key, 0) + 1
+            try:
+                async with lock:
+                    await self._run(coroutine)
+            finally:
+                self._chat_depths[key] -= 1
+                if not self._chat_depths[key]:
+                    del self._chat_depths[key]
+                    del self._chat_locks[key]
+        finally:
+            self._admitted -= 1
+            if reserved:
+                self._pending.release()
+
+    async def _run(self, coroutine):
+        async with self._running:
+            self._running_count += 1
+            try:
+                await coroutine
+            finally:
+                self._running_count -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class AdmissionQueue(asyncio.Queue):
+    """
+    asyncio.Queue whose get() first reserves a pending slot in the processor, released when
+    the update it hands out is done. The Application's stop signal also takes one; it is the
+    last item ever read, so that slot is never needed again.
+    """
+    def __init__(self, processor, maxsize=0):
+        super().__init__(maxsize)
+        self._processor = processor
+
+    async def get(self):
+        await self._processor.reserve()
+        try:
+            return await super().get()
+        except BaseException:
+            self._processor.unreserve()
+            raise
@@ -0,0 +1,114 @@
+"""
+Query budgets: handlers declare how many SQL statements and fetched rows one invocation may
+use, so a change that turns a page read into a full-ledger scan (or a loop of queries) is
+caught instead of silently scaling with history size.
+
+QUERY_BUDGET=off (default) | log | raise. With 'off' no engine events are installed and a
+budgeted handler costs one extra check per call.
+"""
+import os
+import logging
+import functools
+import contextvars
+from sqlalchemy import event
+
+import database
+
+OFF, LOG, RAISE = 'off', 'log', 'raise'
+
+QUERY_BUDGET = os.getenv('QUERY_BUDGET', OFF).lower()
+
+# Budget breaches seen so far, as (name, statements, rows, limits) tuples
+violations = []
+
+# [statements, rows] for the budgeted call running in the current task
+_usage = contextvars.ContextVar('query_budget_usage', default=None)
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+def per_chat_user(base, per_user):
+    """
+    Row budget that grows with the number of registered users in the update's chat.
+    """
+    def budget(update, context):
+        chat_id = update.effective_chat.id
+        thread_id = (update.effective_message.message_thread_id if update.effective_message else None) or 0
+        roster = database.roster_cache.peek((chat_id, thread_id)) or ()
+        return base + per_user * max(len(roster), 1)
+    return budget
+
+class _CountingCursor:
+    """
+    Wraps a DBAPI cursor and adds the rows fetched through it to a budget's usage.
+    """
+    def __init__(self, cursor, usage):
+        self._cursor = cursor
+        self._usage = usage
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._usage[1] += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._usage[1] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._usage[1] += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    usage = _usage.get()
+    if usage is None:
+        return
+    usage[0] += 1
+    # rowcount is -1 for SELECTs, so rows are counted as the result fetches them: the result
+    # is built from context.cursor once this event returns
+    if context is not None and cursor.description is not None:
+        context.cursor = _CountingCursor(cursor, usage)
+
+def install(engine):
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+
+def check(name, usage, statements, rows):
+    statement_count, row_count = usage
+    if (statements is None or statement_count <= statements) and (rows is None or row_count <= rows):
+        return
+    violations.append((name, statement_count, row_count, (statements, rows)))
+    message = (
+        f"Query budget exceeded in {name}: {statement_count} statements (budget {statements}), "
+        f"{row_count} rows (budget {rows})"
+    )
+    if QUERY_BUDGET == RAISE:
+        raise QueryBudgetExceeded(message)
+    logging.warning(message)
+
+def query_budget(statements=None, rows=None):
+    """
+    Declares the budget of a handler. rows may be a callable (update, context) -> int,
+    evaluated after the handler ran.
+    """
+    def decorator(callback):
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            if QUERY_BUDGET == OFF:
+                return await callback(update, context)
+            usage = [0, 0]
+            token = _usage.set(usage)
+            try:
+                result = await callback(update, context)
+            finally:
+                _usage.reset(token)
+            row_limit = rows(update, context) if callable(rows) else rows
+            check(callback.__name__, usage, statements, row_limit)
+            return result
+        return wrapper
+    return decorator
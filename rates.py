@@ -0,0 +1,92 @@
+import os
+import json
+import logging
+from collections import deque
+from decimal import Decimal
+
+# JSON file like {"base": "SGD", "date": "2025-01-31", "rates": {"USD": 0.74, "MYR": 3.3}}
+RATES_SNAPSHOT_PATH = os.getenv('RATES_SNAPSHOT_PATH', 'rates_snapshot.json')
+# Rates entered in a chat are reused for this many hours
+RATE_MAX_AGE_HOURS = float(os.getenv('RATE_MAX_AGE_HOURS', '72'))
+
+_snapshot = None
+
+def load_snapshot(path=None):
+    """
+    Reads offline seed rates as {(base, quote): Decimal}. A missing file just means no seed rates;
+    an unreadable or malformed one is logged and ignored the same way.
+    """
+    path = path or RATES_SNAPSHOT_PATH
+    try:
+        with open(path) as f:
+            data = json.load(f, parse_float=Decimal, parse_int=Decimal)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read rates snapshot {path}: {e}")
+        return {}
+
+    if not isinstance(data, dict) or not isinstance(data.get('base'), str) or not isinstance(data.get('rates'), dict):
+        logging.warning(f"Ignoring rates snapshot {path}: it needs a \"base\" currency and a \"rates\" object.")
+        return {}
+
+    base = data['base']
+    rates = {
+        (base, quote): rate for quote, rate in data['rates'].items()
+        if isinstance(rate, Decimal) and rate.is_finite() and rate > 0 and quote != base
+    }
+    skipped = sum(quote != base for quote in data['rates']) - len(rates)
+    if skipped:
+        logging.warning(f"Skipped {skipped} invalid rates in snapshot {path}.")
+    logging.info(f"Loaded {len(rates)} snapshot rates from {path} ({data.get('date', 'undated')}).")
+    return rates
+
+def snapshot_rates():
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = load_snapshot()
+    return _snapshot
+
+def find_rate(known, source, target):
+    """
+    Rate for 1 source = ? target using direct, inverse or chained pairs from known
+    ({(base, quote): rate}). Takes the path with the fewest conversions; None if unreachable.
+    """
+    if source == target:
+        return Decimal(1)
+
+    graph = {}
+    for (base, quote), rate in known.items():
+        graph.setdefault(base, {})[quote] = rate
+        graph.setdefault(quote, {}).setdefault(base, 1 / rate)
+
+    best = {source: Decimal(1)}
+    queue = deque([source])
+    while queue:
+        currency = queue.popleft()
+        for neighbour, rate in graph.get(currency, {}).items():
+            if neighbour not in best:
+                best[neighbour] = best[currency] * rate
+                if neighbour == target:
+                    return best[neighbour]
+                queue.append(neighbour)
+    return None
+
+def resolve_rate(chat_rates, source, target):
+    """
+    Prefers the chat's own rates; falls back to mixing in the offline snapshot.
+    Returns (rate, origin) where origin is 'chat' or 'snapshot', or (None, None).
+    """
+    rate = find_rate(chat_rates, source, target)
+    if rate is not None:
+        return rate, 'chat'
+    # Chat rates win over the snapshot for the same pair in either direction
+    merged = {
+        (base, quote): rate for (base, quote), rate in snapshot_rates().items()
+        if (base, quote) not in chat_rates and (quote, base) not in chat_rates
+    }
+    merged.update(chat_rates)
+    rate = find_rate(merged, source, target)
+    if rate is not None:
+        return rate, 'snapshot'
+    return None, None
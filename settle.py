@@ -1,13 +1,28 @@
+import asyncio
 from collections import defaultdict
+from datetime import datetime, timedelta
 from decimal import Decimal, InvalidOperation
-from sqlalchemy import select
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 
-from database import get_session, PayRecord, User, get_chat_users
+import callbacks
+from callbacks import CONFIRM, CANCEL
+from database import (
+    get_read_session, get_chat_users, get_balances, get_balance_currencies, get_exchange_rates, save_exchange_rate,
+    get_last_record_id, confirm_settlement
+)
+from money import to_minor, format_minor
+from rates import resolve_rate, RATE_MAX_AGE_HOURS
+from settlement import plan_settlement
+from querybudget import query_budget, per_chat_user
 from utils import get_chat_thread_user_id
 
-SELECT_SETTLE_CURRENCY, ENTER_RATE = range(2)
+SELECT_SETTLE_CURRENCY, ENTER_RATE, CONFIRM_SETTLEMENT = range(3)
+
+CONFIRM_KEYBOARD = InlineKeyboardMarkup([[
+    InlineKeyboardButton("✅ Everyone has paid", callback_data=callbacks.encode(CONFIRM)),
+    InlineKeyboardButton("Not yet", callback_data=callbacks.encode(CANCEL)),
+]])
 
 async def start_settle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     currencies_1 = ["SGD", "MYR", "USD", "EUR"]
@@ -34,6 +49,7 @@ async def start_settle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
     return SELECT_SETTLE_CURRENCY
 
+@query_budget(statements=5, rows=per_chat_user(50, 10))
 async def select_settle_currency(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -41,36 +57,49 @@ async def select_settle_currency(update: Update, context: ContextTypes.DEFAULT_T
     target_currency = query.data
     context.user_data["target_currency"] = target_currency
     context.user_data["exchange_rates"] = {} # e.g. 'EUR_USD': 1.1
+    chat_id = context.user_data["chat_id"]
+    thread_id = context.user_data["thread_id"]
     
-    async with get_session() as session: 
-        # 1. Get all unique currencies
-        stmt_records = select(PayRecord).where(
-            PayRecord.chat_id == context.user_data["chat_id"],
-            PayRecord.thread_id == context.user_data["thread_id"]
-        )
-        records_result = await session.execute(stmt_records)
-        records = records_result.scalars().all()
-        tx_currencies = set(r.currency for r in records)
-    
-        # 2. Determine which pairs need conversion
-        needed_pairs = []
-        for tx_curr in tx_currencies:
-            if tx_curr != target_currency:
-                needed_pairs.append((tx_curr, target_currency))
-                
-        context.user_data["needed_pairs_queue"] = needed_pairs
-        
-        await query.edit_message_text(f"Target currency set to: **{target_currency}**", parse_mode="Markdown")
-        
-        # 3. Check if we need to ask for rates or jump straight to calc
-        if not needed_pairs:
-            return await calculate_settlements(update, context)
-        else:
-            return await ask_next_rate(update, context)
+    async with get_read_session(chat_id, thread_id) as session: 
+        # 1. Get all currencies that still have outstanding balances
+        tx_currencies = await get_balance_currencies(session, chat_id, thread_id)
+
+        # 2. Recent rates entered in this chat, reused for direct, inverse and cross rates
+        since = datetime.utcnow() - timedelta(hours=RATE_MAX_AGE_HOURS)
+        context.user_data["known_rates"] = await get_exchange_rates(session, chat_id, thread_id, since)
+
+    # 3. Determine which pairs need conversion
+    needed_pairs = [(tx_curr, target_currency) for tx_curr in tx_currencies if tx_curr != target_currency]
+    context.user_data["needed_pairs_queue"] = needed_pairs
+
+    await query.edit_message_text(f"Target currency set to: **{target_currency}**", parse_mode="Markdown")
+
+    # 4. Ask only for rates that cannot be derived, then calculate
+    return await ask_next_rate(update, context)
+
+def resolve_known_pairs(context):
+    """
+    Moves every queued pair that can be derived from known rates into exchange_rates.
+    Returns description lines for the rates that were filled in.
+    """
+    lines = []
+    unresolved = []
+    for source, target in context.user_data["needed_pairs_queue"]:
+        rate, origin = resolve_rate(context.user_data["known_rates"], source, target)
+        if rate is None:
+            unresolved.append((source, target))
+            continue
+        context.user_data["exchange_rates"][f"{source}_{target}"] = rate
+        lines.append(f"1 {source} = {rate:.6g} {target} ({'saved' if origin == 'chat' else 'offline snapshot'})")
+    context.user_data["needed_pairs_queue"] = unresolved
+    return lines
 
 async def ask_next_rate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    queue = context.user_data.get("needed_pairs_queue", [])
-    
+    reused = resolve_known_pairs(context)
+    if reused:
+        await update.effective_message.reply_text("Using known rates:\n" + "\n".join(reused))
+
+    queue = context.user_data["needed_pairs_queue"]
     if not queue: 
         return await calculate_settlements(update, context)
     
@@ -88,14 +117,15 @@ async def ask_next_rate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         
     return ENTER_RATE
 
+@query_budget(statements=7, rows=per_chat_user(50, 10))
 async def store_rate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # parse rate to float
     text = update.message.text.strip()
     try:
         rate = Decimal(text)
-        if rate <= 0:
+        if not rate.is_finite() or rate <= 0:
             raise ValueError
-    except ValueError:
+    except (ValueError, InvalidOperation):
         await update.message.reply_text("Invalid rate. Please enter a positive number (e.g., 1.05).")
         return ENTER_RATE
 
@@ -103,15 +133,39 @@ async def store_rate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     queue = context.user_data["needed_pairs_queue"]
     current_source, current_target = queue.pop(0) # Remove from queue
     
-    # Store the rate
+    # Store the rate for this run and for later runs in this chat
     key = f"{current_source}_{current_target}"
     context.user_data["exchange_rates"][key] = rate
+    context.user_data["known_rates"][(current_source, current_target)] = rate
+    await save_exchange_rate(
+        context.user_data["chat_id"], context.user_data["thread_id"], current_source, current_target, rate
+    )
     
     await update.message.reply_text(f"Saved: 1 {current_source} = {rate} {current_target}")
     
     # Loop back to check if more rates are needed
     return await ask_next_rate(update, context)
 
+async def load_settle_balances(session, chat_id, thread_id, target_currency, rates):
+    """
+    Net balance per user in target currency minor units, summing to exactly zero.
+    rates maps 'SRC_TGT' to the rate for 1 SRC in the target currency.
+    """
+    converted = defaultdict(Decimal)
+    for user_id, currency, value in await get_balances(session, chat_id, thread_id):
+        if currency != target_currency:
+            value = value * Decimal(rates.get(f"{currency}_{target_currency}", 1))
+        converted[user_id] += value
+
+    balances = {user_id: to_minor(value, target_currency) for user_id, value in converted.items()}
+
+    # Per-user rounding can leave a few minor units over; the largest balance absorbs them
+    residual = sum(balances.values())
+    if residual:
+        largest = max(balances, key=lambda uid: abs(balances[uid]))
+        balances[largest] -= residual
+    return balances
+
 async def calculate_settlements(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Calculates the most efficient way to settle debts (minimize transactions).
@@ -122,92 +176,64 @@ async def calculate_settlements(update: Update, context: ContextTypes.DEFAULT_TY
     target_currency = context.user_data["target_currency"]
     rates = context.user_data["exchange_rates"]
 
-    async with get_session() as session:
-        # 1. Fetch all records
-        stmt_records = select(PayRecord).where(
-            PayRecord.chat_id == chat_id,
-            PayRecord.thread_id == thread_id
-        )
-        records_result = await session.execute(stmt_records)
-        records = records_result.scalars().all()
-
-        if not records:
-            await update.message.reply_text("No transactions found to settle.")
-            return
-
-        # 1a. Normalize all records to target currency
-        for r in records:
-            if r.currency != target_currency:
-                rate = rates.get(f"{r.currency}_{target_currency}", 1.0)
-                r.value = r.value * rate
-                r.currency = target_currency
+    async with get_read_session(chat_id, thread_id) as session:
+        # 1. Net balances per user, converted to target currency minor units
+        balances = await load_settle_balances(session, chat_id, thread_id, target_currency, rates)
+        # Confirming this plan settles the records up to here, not ones added while it's shown
+        context.user_data["settle_through"] = await get_last_record_id(session, chat_id, thread_id)
 
         # 2. Fetch Users for Name Mapping
         users = await get_chat_users(session, chat_id, thread_id)
         user_map = {u.user_id: u.name for u in users}
 
-        # 3. Calculate Net Balances per Currency
-        # Structure: {'USD': {user_id: 10.0}, 'EUR': {user_id: -5.0}}
-        balances = defaultdict(lambda: defaultdict(float))
-        
-        for r in records:
-            balances[r.currency][r.from_user_id] += float(r.value)
-            balances[r.currency][r.to_user_id] -= float(r.value)
-
-        # 4. Simplification Algorithm
-        settlement_plan = [] # (payer_name, payee_name, amount, currency)
-
-        for currency, user_balances in balances.items():
-            debtors = []
-            creditors = []
-
-            # Separate into two lists
-            for uid, amount in user_balances.items():
-                if abs(amount) < 0.01: continue # Skip settled users
-                
-                if amount < 0:
-                    debtors.append({'id': uid, 'val': amount})
-                else:
-                    creditors.append({'id': uid, 'val': amount})
-
-            # Sort to optimize (Greedy approach: match largest debt with largest credit)
-            debtors.sort(key=lambda x: x['val'])       # Ascending (most negative first)
-            creditors.sort(key=lambda x: x['val'], reverse=True) # Descending (most positive first)
-
-            d_idx = 0
-            c_idx = 0
-
-            while d_idx < len(debtors) and c_idx < len(creditors):
-                debtor = debtors[d_idx]
-                creditor = creditors[c_idx]
-
-                # The amount to settle is the minimum of the absolute debt or the available credit
-                amount = min(abs(debtor['val']), creditor['val'])
-
-                # Record the transaction
-                payer_name = user_map.get(debtor['id'], "Unknown")
-                payee_name = user_map.get(creditor['id'], "Unknown")
-                
-                if amount > 0.00:
-                    settlement_plan.append((payer_name, payee_name, amount, currency))
-
-                # Update balances
-                debtor['val'] += amount
-                creditor['val'] -= amount
-
-                # Move pointers if settled (approximate for float precision)
-                if abs(debtor['val']) < 0.01:
-                    d_idx += 1
-                if creditor['val'] < 0.01:
-                    c_idx += 1
-
-        # 5. Output Results
+        # 3. Simplification Algorithm
+        plan = await asyncio.to_thread(plan_settlement, balances)
+        settlement_plan = [
+            (user_map.get(debtor_id, "Unknown"), user_map.get(creditor_id, "Unknown"),
+             amount, target_currency)
+            for debtor_id, creditor_id, amount in plan.transfers
+        ] # (payer_name, payee_name, amount, currency)
+
+        # 4. Output Results
         if not settlement_plan:
-            await update.message.reply_text("Everyone is all settled up! 🎉")
+            await update.effective_message.reply_text("Everyone is all settled up! 🎉")
         else:
             msg = "🤝 To settle all owed amounts efficiently:\n"
             for payer, payee, amount, curr in settlement_plan:
-                msg += f"• **{payer}** pays **{payee}** {amount:.2f} {curr}\n"
-            await update.message.reply_text(msg, parse_mode='Markdown')
-        
+                msg += f"• **{payer}** pays **{payee}** {format_minor(amount, curr)} {curr}\n"
+            if plan.saved:
+                msg += f"\n💡 {plan.saved} fewer transfer(s) than the simple greedy plan."
+            msg += "\nOnce everyone has paid, confirm to start the balances afresh."
+            await update.effective_message.reply_text(msg, parse_mode='Markdown', reply_markup=CONFIRM_KEYBOARD)
+            return CONFIRM_SETTLEMENT
+
+    return ConversationHandler.END
+
+async def confirm_settlement_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Writes a settlement checkpoint once the group has paid out the plan."""
+    query = update.callback_query
+    await query.answer()
+
+    kind, _ = callbacks.decode(query.data)
+    through = context.user_data.get("settle_through")
+    if kind != CONFIRM or through is None:
+        await query.edit_message_reply_markup(reply_markup=None)
+        return ConversationHandler.END
+
+    chat_id = update.effective_chat.id
+    thread_id = update.effective_message.message_thread_id
+    result = await confirm_settlement(
+        chat_id, thread_id, through, context.user_data.get("target_currency"), update.effective_user.id
+    )
+    if result is None:
+        await query.edit_message_reply_markup(reply_markup=None)
+        await query.message.reply_text("These payments were already settled.")
+        return ConversationHandler.END
+
+    checkpoint, archived = result
+    msg = "✅ Settlement recorded. Balances now only count payments made from here on."
+    if archived:
+        msg += f"\n🗄 {archived} settled record(s) archived."
+    await query.edit_message_reply_markup(reply_markup=None)
+    await query.message.reply_text(msg)
     return ConversationHandler.END
\ No newline at end of file
@@ -0,0 +1,266 @@
+import os
+import time
+from collections import namedtuple
+
+GREEDY, EXACT, HEURISTIC, AUTO = 'greedy', 'exact', 'heuristic', 'auto'
+
+SETTLE_MODE = os.getenv('SETTLE_MODE', AUTO)
+
+# Largest number of non-zero balances handed to the exact solver in AUTO mode
+EXACT_MAX_BALANCES = int(os.getenv('SETTLE_EXACT_MAX_BALANCES', '20'))
+# Wall-clock budget (seconds) for the exact solver, after which the plan falls back to the
+# heuristic. Trip balances solve in a few ms at 20; balances with many zero-sum subsets would
+# take ~20 ms at 14, ~80 ms at 16 and ~1.5 s at 20
+EXACT_TIME_BUDGET = float(os.getenv('SETTLE_EXACT_TIME_BUDGET', '0.05'))
+# Wall-clock budget (seconds) for the heuristic's zero-sum subgroup search
+HEURISTIC_TIME_BUDGET = float(os.getenv('SETTLE_HEURISTIC_TIME_BUDGET', '0.05'))
+
+# transfers: [(debtor_id, creditor_id, amount)], amounts in integer minor units
+SettlementPlan = namedtuple('SettlementPlan', ['transfers', 'method', 'greedy_count', 'saved'])
+
+class ExactSolverTimeout(Exception):
+    pass
+
+def _check_deadline(deadline):
+    if deadline is not None and time.monotonic() >= deadline:
+        raise ExactSolverTimeout
+
+def greedy_transfers(balances):
+    """
+    Matches the largest debtor with the largest creditor until everyone is settled.
+    balances: {user_id: int} in minor units, positive = is owed money.
+    """
+    debtors = sorted(([uid, val] for uid, val in balances.items() if val < 0), key=lambda x: x[1])
+    creditors = sorted(([uid, val] for uid, val in balances.items() if val > 0), key=lambda x: -x[1])
+
+    transfers = []
+    d_idx = 0
+    c_idx = 0
+    while d_idx < len(debtors) and c_idx < len(creditors):
+        debtor = debtors[d_idx]
+        creditor = creditors[c_idx]
+
+        amount = min(-debtor[1], creditor[1])
+        transfers.append((debtor[0], creditor[0], amount))
+
+        debtor[1] += amount
+        creditor[1] -= amount
+        if debtor[1] == 0:
+            d_idx += 1
+        if creditor[1] == 0:
+            c_idx += 1
+    return transfers
+
+def _cancel_pairs(items):
+    """
+    Splits off (x, -x) pairs, which always form their own group in some optimal plan.
+    Returns (pair_groups, remaining_items).
+    """
+    waiting = {}
+    groups = []
+    remaining = []
+    for uid, val in items:
+        partners = waiting.get(-val)
+        if partners:
+            groups.append([partners.pop(), (uid, val)])
+        else:
+            waiting.setdefault(val, []).append((uid, val))
+    for entries in waiting.values():
+        remaining.extend(entries)
+    return groups, remaining
+
+def _subset_sums(values, deadline=None):
+    sums = [0] * (1 << len(values))
+    for mask in range(1, len(sums)):
+        if not mask & 0xFFF:
+            _check_deadline(deadline)
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + values[low.bit_length() - 1]
+    return sums
+
+def _zero_sum_masks(values, deadline=None):
+    """
+    Enumerates every non-empty zero-sum subset by meeting in the middle over two halves.
+    """
+    half = len(values) // 2
+    low_sums = _subset_sums(values[:half], deadline)
+    high_by_sum = {}
+    for mask, total in enumerate(_subset_sums(values[half:], deadline)):
+        high_by_sum.setdefault(total, []).append(mask << half)
+
+    masks = []
+    for low_mask, total in enumerate(low_sums):
+        if not low_mask & 0xFF:
+            _check_deadline(deadline)
+        for high_mask in high_by_sum.get(-total, ()):
+            if low_mask or high_mask:
+                masks.append(low_mask | high_mask)
+    return masks
+
+def _chain_partition(n, zero_masks, deadline=None):
+    """
+    Longest chain of nested zero-sum masks ending at the full set.
+    Cheap when zero-sum subsets are rare, which is the usual case for real balances.
+    """
+    zero_masks.sort(key=lambda m: bin(m).count('1'))
+    depth = {}
+    parent = {}
+    for mask in zero_masks:
+        _check_deadline(deadline)
+        best = 0
+        best_parent = 0
+        for inner, inner_depth in depth.items():
+            if inner_depth > best and inner & mask == inner:
+                best = inner_depth
+                best_parent = inner
+        depth[mask] = best + 1
+        parent[mask] = best_parent
+
+    chain = [(1 << n) - 1]
+    while chain[-1]:
+        chain.append(parent[chain[-1]])
+    return chain
+
+def _bitmask_partition(values, deadline=None):
+    """
+    dp[mask] is the most zero-sum groups the items in mask can be split into.
+    O(n * 2^n), independent of how many zero-sum subsets exist.
+    """
+    full = (1 << len(values)) - 1
+    sums = _subset_sums(values, deadline)
+    dp = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        if not mask & 0xFFF:
+            _check_deadline(deadline)
+        best = 0
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            candidate = dp[mask ^ bit]
+            if candidate > best:
+                best = candidate
+            rest ^= bit
+        dp[mask] = best + (sums[mask] == 0)
+
+    # Walk back down from the full set; the zero-sum masks on the path nest into groups
+    chain = []
+    mask = full
+    while mask:
+        if sums[mask] == 0:
+            chain.append(mask)
+        target = dp[mask] - (sums[mask] == 0)
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            if dp[mask ^ bit] == target:
+                break
+            rest ^= bit
+        mask ^= bit
+    chain.append(0)
+    return chain
+
+def _zero_sum_partition(items, deadline=None):
+    """
+    Partitions items into the maximum number of zero-sum groups.
+    Runs the chain DP over enumerated zero-sum subsets, or the full bitmask DP when
+    there are so many zero-sum subsets that the chain DP would cost more.
+    """
+    n = len(items)
+    values = [val for _, val in items]
+    zero_masks = _zero_sum_masks(values, deadline)
+    if len(zero_masks) ** 2 <= n << n:
+        chain = _chain_partition(n, zero_masks, deadline)
+    else:
+        chain = _bitmask_partition(values, deadline)
+
+    return [
+        [items[i] for i in range(n) if (outer ^ inner) >> i & 1]
+        for outer, inner in zip(chain, chain[1:])
+    ]
+
+def _settle_groups(groups):
+    transfers = []
+    for group in groups:
+        transfers.extend(greedy_transfers(dict(group)))
+    return transfers
+
+def exact_transfers(balances, time_budget=None):
+    """
+    Minimum number of transfers: n - (max number of zero-sum groups).
+    Exponential in the number of non-zero balances, see EXACT_MAX_BALANCES. Raises
+    ExactSolverTimeout once time_budget seconds have passed, if one is given.
+    """
+    deadline = time.monotonic() + time_budget if time_budget is not None else None
+    items = [(uid, val) for uid, val in balances.items() if val]
+    groups, remaining = _cancel_pairs(items)
+    if remaining:
+        groups.extend(_zero_sum_partition(remaining, deadline))
+    return _settle_groups(groups)
+
+def heuristic_transfers(balances, time_budget=HEURISTIC_TIME_BUDGET):
+    """
+    Peels off zero-sum pairs and triples within a time budget, then settles the rest greedily.
+    """
+    deadline = time.monotonic() + time_budget
+    items = [(uid, val) for uid, val in balances.items() if val]
+    groups, remaining = _cancel_pairs(items)
+
+    found = True
+    while found and len(remaining) >= 3 and time.monotonic() < deadline:
+        found = False
+        index = {}
+        for i, (_, val) in enumerate(remaining):
+            index.setdefault(val, []).append(i)
+        for i in range(len(remaining)):
+            if time.monotonic() >= deadline:
+                break
+            for j in range(i + 1, len(remaining)):
+                third = next(
+                    (k for k in index.get(-(remaining[i][1] + remaining[j][1]), ()) if k != i and k != j),
+                    None
+                )
+                if third is not None:
+                    picked = {i, j, third}
+                    groups.append([remaining[k] for k in sorted(picked)])
+                    remaining = [item for k, item in enumerate(remaining) if k not in picked]
+                    found = True
+                    break
+            if found:
+                break
+
+    transfers = _settle_groups(groups)
+    transfers.extend(greedy_transfers(dict(remaining)))
+    return transfers
+
+def plan_settlement(balances, mode=None):
+    """
+    Builds a settlement plan for {user_id: int} balances that sum to zero.
+    AUTO uses the exact solver up to EXACT_MAX_BALANCES non-zero balances, else the heuristic.
+    The exact solver gets EXACT_TIME_BUDGET seconds; it runs in a worker thread but holds the
+    GIL, so past that the heuristic takes over.
+    """
+    if sum(balances.values()) != 0:
+        raise ValueError("Balances must sum to zero.")
+
+    mode = mode or SETTLE_MODE
+    greedy = greedy_transfers(balances)
+    if mode == GREEDY:
+        return SettlementPlan(greedy, GREEDY, len(greedy), 0)
+
+    if mode == AUTO:
+        non_zero = sum(1 for val in balances.values() if val)
+        mode = EXACT if non_zero <= EXACT_MAX_BALANCES else HEURISTIC
+
+    transfers = None
+    if mode == EXACT:
+        try:
+            transfers = exact_transfers(balances, EXACT_TIME_BUDGET)
+        except ExactSolverTimeout:
+            mode = HEURISTIC
+    if transfers is None:
+        transfers = heuristic_transfers(balances)
+
+    # Never do worse than the baseline
+    if len(transfers) > len(greedy):
+        return SettlementPlan(greedy, GREEDY, len(greedy), 0)
+    return SettlementPlan(transfers, mode, len(greedy), len(greedy) - len(transfers))
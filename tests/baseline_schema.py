@@ -0,0 +1,56 @@
+"""
+The ledger tables as they were before migrations.py, for tests of databases upgraded from them.
+"""
+from sqlalchemy import (
+    MetaData, Table, Column, BigInteger, Integer, String, DateTime, Numeric, ForeignKey, Index
+)
+from sqlalchemy.ext.asyncio import create_async_engine
+
+# The schema before migrations.py; create_all leaves existing tables as they are
+baseline = MetaData()
+Table(
+    'pay_records', baseline,
+    Column('pay_record_id', Integer, primary_key=True, autoincrement=True),
+    Column('gmt_created', DateTime),
+    Column('gmt_modified', DateTime),
+    Column('chat_id', BigInteger, nullable=False),
+    Column('thread_id', Integer, nullable=True),
+    Column('from_user_id', BigInteger, nullable=False),
+    Column('to_user_id', BigInteger, nullable=False),
+    Column('currency', String(10), nullable=False),
+    Column('value', Numeric(10, 2), nullable=False),
+    Index('idx_pay_context', 'chat_id', 'thread_id'),
+    Index('idx_pay_from', 'from_user_id'),
+    Index('idx_pay_to', 'to_user_id'),
+)
+Table(
+    'payment_groups', baseline,
+    Column('group_id', Integer, primary_key=True, autoincrement=True),
+    Column('chat_id', BigInteger, nullable=False),
+    Column('thread_id', Integer, nullable=True),
+    Column('name', String(255), nullable=False),
+    Column('gmt_created', DateTime),
+    Index('idx_group_context', 'chat_id', 'thread_id'),
+)
+Table(
+    'payment_group_links', baseline,
+    Column('link_id', Integer, primary_key=True, autoincrement=True),
+    Column('group_id', Integer, ForeignKey('payment_groups.group_id'), nullable=False),
+    Column('pay_record_id', Integer, ForeignKey('pay_records.pay_record_id'), nullable=False),
+)
+Table(
+    'users', baseline,
+    Column('user_id', BigInteger, primary_key=True),
+    Column('chat_id', BigInteger, primary_key=True),
+    Column('thread_id', Integer, primary_key=True),
+    Column('gmt_created', DateTime),
+    Column('gmt_modified', DateTime),
+    Column('name', String(255)),
+    Index('idx_user_context', 'chat_id', 'thread_id'),
+)
+
+async def create_baseline(db_url):
+    engine = create_async_engine(db_url)
+    async with engine.begin() as conn:
+        await conn.run_sync(baseline.create_all)
+    await engine.dispose()
@@ -0,0 +1,55 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+@pytest.fixture
+def run_db(tmp_path, monkeypatch):
+    """
+    Runs an async scenario against a fresh SQLite file database, created and migrated by
+    init_db, with the in-process caches emptied so nothing carries over between tests.
+    run_db(scenario, setup) awaits setup(db_url) before init_db.
+    """
+    import database
+    import list as ledger_list
+    import callbacks
+
+    for cache in (database.roster_cache, database.primary_pins, ledger_list.ledger_cache, callbacks.keyboard_cache):
+        cache.clear()
+    for versions in (database.ledger_versions, database.roster_versions):
+        versions.clear()
+
+    def run(scenario, setup=None):
+        async def main():
+            db_url = f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}"
+            if setup is not None:
+                # e.g. create an older schema for init_db to migrate
+                await setup(db_url)
+            await database.init_db(db_url)
+            try:
+                return await scenario()
+            finally:
+                await database.dispose_db()
+        return asyncio.run(main())
+    return run
+
+@pytest.fixture
+def query_budget_raise(monkeypatch):
+    """
+    Runs the test with QUERY_BUDGET=raise: budgeted handlers raise QueryBudgetExceeded when
+    over budget, counting on every engine init_db creates. Returns the list of violations.
+    """
+    import database
+    import querybudget
+    monkeypatch.setattr(querybudget, 'QUERY_BUDGET', querybudget.RAISE)
+    monkeypatch.setattr(querybudget, 'violations', [])
+    init_db = database.init_db
+    async def init_db_with_budgets(*args, **kwargs):
+        await init_db(*args, **kwargs)
+        for engine in database.get_engines():
+            querybudget.install(engine)
+    monkeypatch.setattr(database, 'init_db', init_db_with_budgets)
+    return querybudget.violations
@@ -0,0 +1,28 @@
+import pytest
+
+import callbacks
+from callbacks import encode, decode, user_buttons, USER, SINGLE_PAYEE, PREFIX
+
+def test_encode_roundtrip():
+    for kind, values in ((USER, (123456789,)), (SINGLE_PAYEE, (1, 2 ** 40)), (USER, ())):
+        assert decode(encode(kind, *values)) == (kind, values)
+
+@pytest.mark.parametrize('data', [
+    PREFIX + USER + 'A',          # truncated: one base64 character can't hold a byte
+    PREFIX + USER + 'AB.C',
+    PREFIX + USER + 'é',
+])
+def test_malformed_payload_is_expired(data):
+    assert decode(data) == (None, ())
+
+def test_keyboards_are_keyed_by_roster_contents():
+    callbacks.keyboard_cache.clear()
+    roster = {1: 'alice', 2: 'bob'}
+    buttons = user_buttons(roster, USER)
+    # A restart, or another chat with the same roster, gets the cached buttons
+    assert user_buttons(dict(roster), USER) is buttons
+    assert user_buttons(roster, USER, exclude=1) == buttons[1:]
+
+    renamed = user_buttons({1: 'alice', 2: 'robert'}, USER)
+    assert [button.text for _, button in renamed] == ['alice', 'robert']
+    assert [button.text for _, button in user_buttons({**roster, 3: 'carol'}, USER)] == ['alice', 'bob', 'carol']
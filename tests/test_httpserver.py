@@ -0,0 +1,46 @@
+import asyncio
+
+from httpserver import start_server
+
+REQUEST = b'POST /telegram HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}'
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    return head.decode('latin-1')
+
+def test_shutdown_closes_idle_and_finishes_in_flight():
+    async def run():
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def handler(method, path, headers, body):
+            if headers.get('x-slow'):
+                started.set()
+                await release.wait()
+            return 200, b'', 'text/plain'
+
+        server = await start_server(handler, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        # A keep-alive client that stays connected after its request
+        idle_reader, idle_writer = await asyncio.open_connection('127.0.0.1', port)
+        idle_writer.write(REQUEST)
+        assert 'keep-alive' in await read_response(idle_reader)
+
+        busy_reader, busy_writer = await asyncio.open_connection('127.0.0.1', port)
+        busy_writer.write(REQUEST.replace(b'\r\n\r\n', b'\r\nX-Slow: 1\r\n\r\n'))
+        await started.wait()
+
+        shutdown = asyncio.create_task(server.shutdown())
+        await asyncio.sleep(0.05)
+        assert await idle_reader.read() == b''
+        assert not shutdown.done()
+
+        release.set()
+        response = await read_response(busy_reader)
+        assert response.startswith('HTTP/1.1 200') and 'Connection: close' in response
+        await asyncio.wait_for(shutdown, timeout=2)
+
+        for writer in (idle_writer, busy_writer):
+            writer.close()
+
+    asyncio.run(run())
@@ -0,0 +1,64 @@
+import random
+from decimal import Decimal
+
+import pytest
+
+from money import to_minor, from_minor, fits_currency, split_evenly, parse_amount, exponent
+
+# One currency per minor-unit exponent
+CURRENCIES = {0: 'JPY', 2: 'SGD', 3: 'KWD'}
+CASES = 2000
+
+@pytest.fixture
+def rng():
+    return random.Random(20241017)
+
+def test_exponents():
+    assert {places: exponent(currency) for places, currency in CURRENCIES.items()} == {0: 0, 2: 2, 3: 3}
+
+def test_split_evenly_sums_exactly(rng):
+    for _ in range(CASES):
+        total = rng.randint(-10**12, 10**12)
+        parts = rng.randint(1, 50)
+        shares = split_evenly(total, parts)
+        assert len(shares) == parts
+        assert sum(shares) == total
+        assert max(shares) - min(shares) <= 1
+
+def test_split_evenly_is_deterministic(rng):
+    for _ in range(CASES):
+        total, parts = rng.randint(0, 10**9), rng.randint(1, 50)
+        shares = split_evenly(total, parts)
+        assert split_evenly(total, parts) == shares
+        # Extra units go to the first shares
+        assert shares == sorted(shares, reverse=True)
+
+@pytest.mark.parametrize('places', sorted(CURRENCIES))
+def test_minor_round_trip(rng, places):
+    currency = CURRENCIES[places]
+    for _ in range(CASES):
+        minor = rng.randint(-10**12, 10**12)
+        amount = from_minor(minor, currency)
+        assert to_minor(amount, currency) == minor
+        assert to_minor(str(amount), currency) == minor
+        assert fits_currency(amount, currency)
+        assert -amount.as_tuple().exponent <= places
+
+@pytest.mark.parametrize('places', sorted(CURRENCIES))
+def test_fits_currency_rejects_extra_places(rng, places):
+    currency = CURRENCIES[places]
+    for _ in range(CASES):
+        minor = rng.randint(0, 10**9)
+        extra_places = rng.randint(1, 4)
+        digit = rng.randint(1, 9)
+        # A nonzero digit beyond the currency's precision
+        amount = from_minor(minor, currency) + Decimal(digit).scaleb(-(places + extra_places))
+        assert not fits_currency(amount, currency)
+        assert abs(to_minor(amount, currency) - minor) <= 1
+
+def test_parse_amount_limits_places():
+    assert parse_amount(' 12.50 ') == Decimal('12.50')
+    assert parse_amount('7.125', max_places=3) == Decimal('7.125')
+    for text in ('7.125', 'abc', 'NaN', 'Infinity'):
+        with pytest.raises(ValueError):
+            parse_amount(text)
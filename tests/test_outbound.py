@@ -0,0 +1,56 @@
+import asyncio
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from outbound import OutboundDispatcher, retry_delay
+
+def send(dispatcher, endpoint, data, callback=None):
+    async def ok():
+        return {'message_id': 1}
+    return dispatcher.process_request(callback or ok, (), {}, endpoint, data, None)
+
+def test_chat_bucket_only_paces_group_sends():
+    async def run():
+        dispatcher = OutboundDispatcher(global_rate=1000, global_burst=1000, chat_rate=1, chat_burst=2)
+        for n in range(5):
+            await send(dispatcher, 'sendMessage', {'chat_id': 42, 'text': str(n)})
+            await send(dispatcher, 'editMessageText', {'chat_id': -100, 'message_id': 1, 'text': str(n)})
+        assert dispatcher.stats['waited_seconds'] == 0
+
+        for n in range(3):
+            await send(dispatcher, 'sendMessage', {'chat_id': -100, 'text': str(n)})
+        assert dispatcher.stats['waited_seconds'] > 0.5
+
+    asyncio.run(run())
+
+def test_unchanged_edit_is_dropped():
+    async def run():
+        dispatcher = OutboundDispatcher()
+        data = {'chat_id': -100, 'message_id': 1, 'text': 'page 1'}
+        await send(dispatcher, 'editMessageText', data)
+        assert await send(dispatcher, 'editMessageText', dict(data)) is True
+        assert dispatcher.stats == {'sent': 1, 'noop_dropped': 1, 'retries': 0, 'waited_seconds': 0.0}
+
+    asyncio.run(run())
+
+def test_retry_after_is_retried():
+    async def run():
+        dispatcher = OutboundDispatcher()
+        calls = []
+
+        async def flaky():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RetryAfter(0)
+            return True
+
+        assert await send(dispatcher, 'sendMessage', {'chat_id': 42, 'text': 'hi'}, flaky) is True
+        assert dispatcher.stats['retries'] == 1
+
+    asyncio.run(run())
+
+def test_retry_delay_accepts_seconds_and_timedelta(monkeypatch):
+    assert retry_delay(RetryAfter(3)) == 3.0
+    monkeypatch.setenv('PTB_TIMEDELTA', 'true')
+    assert retry_delay(RetryAfter(timedelta(seconds=1.5))) == 1.5
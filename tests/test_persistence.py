@@ -0,0 +1,77 @@
+import asyncio
+
+import persistence
+from persistence import DatabasePersistence
+
+class FakeStore:
+    """
+    Stands in for save_persisted_batch; each write waits for `gate` and the first `failures` raise.
+    """
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.batches = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def save(self, data_rows, dropped_data, conversation_rows, ended_conversations):
+        await self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('database unavailable')
+        self.batches.append(([row['owner_id'] for row in data_rows], [row['conversation_key'] for row in conversation_rows]))
+
+async def settle(store, batches):
+    for _ in range(200):
+        if len(store.batches) >= batches:
+            return
+        await asyncio.sleep(0.01)
+
+def test_changes_during_a_write_are_flushed_after_it(monkeypatch):
+    async def run():
+        store = FakeStore()
+        monkeypatch.setattr(persistence, 'save_persisted_batch', store.save)
+        db = DatabasePersistence('sqlite+aiosqlite://')
+
+        store.gate.clear()
+        await db.update_chat_data(1, {'a': 1})
+        await asyncio.sleep(0.01)
+        # The first batch is being written; these arrive meanwhile and nothing else changes later
+        await db.update_chat_data(2, {'b': 2})
+        await db.update_conversation('pay', (2, 3), 1)
+        store.gate.set()
+
+        await settle(store, 2)
+        assert store.batches == [([1], []), ([2], ['[2, 3]'])]
+        assert not db._dirty_data and not db._dirty_conversations
+
+    asyncio.run(run())
+
+def test_failed_batch_is_retried(monkeypatch):
+    async def run():
+        store = FakeStore(failures=2)
+        monkeypatch.setattr(persistence, 'save_persisted_batch', store.save)
+        monkeypatch.setattr(persistence, 'FLUSH_RETRY_DELAY', 0.01)
+        db = DatabasePersistence('sqlite+aiosqlite://')
+
+        await db.update_chat_data(1, {'a': 1})
+        await db.update_conversation('pay', (1, 1), 2)
+        await settle(store, 1)
+        assert store.batches == [([1], ['[1, 1]'])]
+        assert store.failures == 0
+
+    asyncio.run(run())
+
+def test_flush_cuts_the_backoff_short(monkeypatch):
+    async def run():
+        store = FakeStore(failures=1)
+        monkeypatch.setattr(persistence, 'save_persisted_batch', store.save)
+        monkeypatch.setattr(persistence, 'FLUSH_RETRY_DELAY', 60)
+        db = DatabasePersistence('sqlite+aiosqlite://')
+
+        await db.drop_chat_data(5)
+        await db.update_chat_data(6, {'c': 3})
+        await asyncio.sleep(0.05)
+        await asyncio.wait_for(db.flush(), timeout=1)
+        assert store.batches == [([6], [])]
+
+    asyncio.run(run())
@@ -0,0 +1,100 @@
+import asyncio
+from types import SimpleNamespace
+
+from processor import ChatOrderedUpdateProcessor
+
+def make_update(chat_id, thread_id=None):
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id),
+        effective_message=SimpleNamespace(message_thread_id=thread_id),
+    )
+
+async def fetch(queue, processor, tasks):
+    # What Application's update fetcher does in concurrent mode: a task per update taken off the queue
+    while True:
+        update, coroutine = await queue.get()
+        tasks.append(asyncio.create_task(processor.process_update(update, coroutine)))
+
+def test_busy_chat_does_not_stall_other_chats():
+    async def run():
+        processor = ChatOrderedUpdateProcessor(16)
+        queue = processor.create_queue(256)
+        release = asyncio.Event()
+        started = asyncio.Event()
+        tasks = []
+
+        async def blocked():
+            await release.wait()
+
+        async def other():
+            started.set()
+
+        for _ in range(40):
+            await queue.put((make_update(1), blocked()))
+        await queue.put((make_update(2), other()))
+        fetcher = asyncio.create_task(fetch(queue, processor, tasks))
+        try:
+            await asyncio.wait_for(started.wait(), timeout=1)
+            assert processor.stats()['max_chat_depth'] == 40
+        finally:
+            release.set()
+            await asyncio.gather(*tasks)
+            fetcher.cancel()
+
+    asyncio.run(run())
+
+def test_chat_updates_run_in_order():
+    async def run():
+        processor = ChatOrderedUpdateProcessor(4)
+        queue = processor.create_queue()
+        seen, tasks = [], []
+
+        async def record(n):
+            await asyncio.sleep(0.001 * (n % 3))
+            seen.append(n)
+
+        for n in range(20):
+            await queue.put((make_update(1, 7), record(n)))
+        fetcher = asyncio.create_task(fetch(queue, processor, tasks))
+        while len(tasks) < 20:
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+        fetcher.cancel()
+        assert seen == list(range(20))
+
+    asyncio.run(run())
+
+def test_full_processor_backs_up_the_queue():
+    async def run():
+        processor = ChatOrderedUpdateProcessor(2, max_pending_updates=8)
+        queue = processor.create_queue(4)
+        release = asyncio.Event()
+        tasks = []
+
+        async def blocked():
+            await release.wait()
+
+        fetcher = asyncio.create_task(fetch(queue, processor, tasks))
+        timeouts = 0
+        for n in range(2000):
+            coroutine = blocked()
+            try:
+                await asyncio.wait_for(queue.put((make_update(n), coroutine)), timeout=0.001)
+            except asyncio.TimeoutError:
+                coroutine.close()
+                timeouts += 1
+        assert len(tasks) == 8
+        assert processor.stats()['admitted'] == 8
+        assert processor.stats()['running'] == 2
+        assert queue.full()
+        assert timeouts == 2000 - 8 - 4
+
+        release.set()
+        while tasks and not all(task.done() for task in tasks) or not queue.empty():
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+        assert len(tasks) == 12
+        assert processor.stats()['admitted'] == 0
+        fetcher.cancel()
+
+    asyncio.run(run())
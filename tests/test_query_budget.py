@@ -0,0 +1,141 @@
+from types import SimpleNamespace
+
+import pytest
+
+import querybudget
+from querybudget import query_budget, QueryBudgetExceeded
+from database import upsert_user, get_read_session, get_chat_users, roster_cache
+from list import list_settlements, list_pagination_callback, ITEMS_PER_PAGE
+from pay import (
+    start_pay, select_payer, enter_comment, enter_amount, select_currency, select_payee, undo_pay
+)
+
+CHAT = -1001
+USERS = ((1, 'alice'), (2, 'bob'), (3, 'carol'))
+
+class FakeChat:
+    """
+    Builds the updates a user would send and records what the handlers send back.
+    """
+    def __init__(self, user_id=1):
+        self.user_id = user_id
+        self.sent = []
+        self.context = SimpleNamespace(user_data={}, chat_data={}, bot=SimpleNamespace(delete_message=self.delete))
+
+    async def reply(self, text, reply_markup=None, **kwargs):
+        self.sent.append((text, reply_markup))
+        return SimpleNamespace(message_id=len(self.sent))
+
+    async def delete(self, **kwargs):
+        pass
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    def message(self, text=None):
+        message = SimpleNamespace(text=text, message_thread_id=None, reply_text=self.reply)
+        return SimpleNamespace(
+            effective_chat=SimpleNamespace(id=CHAT), effective_user=SimpleNamespace(id=self.user_id),
+            effective_message=message, message=message, callback_query=None
+        )
+
+    def press(self, data):
+        message = SimpleNamespace(message_thread_id=None)
+        query = SimpleNamespace(data=data, answer=self.answer, edit_message_text=self.reply)
+        return SimpleNamespace(
+            effective_chat=SimpleNamespace(id=CHAT), effective_user=SimpleNamespace(id=self.user_id),
+            effective_message=message, message=None, callback_query=query
+        )
+
+    def button(self, label):
+        """
+        callback_data of the first button in the last keyboard sent whose text contains label,
+        or None.
+        """
+        _, markup = self.sent[-1]
+        for row in markup.inline_keyboard:
+            for button in row:
+                if label in button.text:
+                    return button.callback_data
+        return None
+
+    async def send(self, handler, update):
+        return await handler(update, self.context)
+
+async def register():
+    for user_id, name in USERS:
+        await upsert_user(user_id, CHAT, None, name)
+
+async def pay(chat, description, amount='30', split='👨‍👩‍👧‍👦 Split Equally'):
+    await chat.send(start_pay, chat.message('/pay'))
+    await chat.send(select_payer, chat.press(chat.button('alice')))
+    await chat.send(enter_comment, chat.message(description))
+    await chat.send(enter_amount, chat.message(amount))
+    await chat.send(select_currency, chat.press('SGD'))
+    await chat.send(select_payee, chat.press(chat.button(split)))
+    return chat.sent[-1][0]
+
+def test_pay_and_undo_stay_within_budget(run_db, query_budget_raise):
+    async def scenario():
+        await register()
+        chat = FakeChat()
+        assert 'Equal Split Recorded' in await pay(chat, 'dinner')
+        assert 'Payment Recorded' in await pay(chat, 'taxi', split='bob')
+
+        await chat.send(undo_pay, chat.message('/undo'))
+        assert 'taxi' in chat.sent[-1][0]
+
+    run_db(scenario)
+    assert query_budget_raise == []
+
+def test_list_and_pages_stay_within_budget(run_db, query_budget_raise):
+    async def scenario():
+        await register()
+        chat = FakeChat()
+        for i in range(ITEMS_PER_PAGE):
+            await pay(chat, f"expense {i}")
+
+        await chat.send(list_settlements, chat.message('/list'))
+        text, _ = chat.sent[-1]
+        assert f"expense {ITEMS_PER_PAGE - 1}" in text
+
+        # Back to the first page and forward again, each step reading one page
+        pages = 1
+        while chat.button('Prev') is not None:
+            await chat.send(list_pagination_callback, chat.press(chat.button('Prev')))
+            pages += 1
+        assert pages > 1 and 'expense 0' in chat.sent[-1][0]
+        await chat.send(list_pagination_callback, chat.press(chat.button('Next')))
+
+    run_db(scenario)
+    assert query_budget_raise == []
+
+def test_over_budget_handler_raises(run_db, query_budget_raise):
+    @query_budget(statements=1, rows=len(USERS) - 1)
+    async def read_roster_twice(update, context):
+        for _ in range(2):
+            roster_cache.clear()
+            async with get_read_session() as session:
+                await get_chat_users(session, CHAT, None)
+
+    async def scenario():
+        await register()
+        chat = FakeChat()
+        with pytest.raises(QueryBudgetExceeded):
+            await chat.send(read_roster_twice, chat.message())
+
+    run_db(scenario)
+    [(name, statements, rows, limits)] = query_budget_raise
+    assert (name, statements, rows) == ('read_roster_twice', 2, 2 * len(USERS))
+
+def test_row_budget_does_not_touch_roster_cache(run_db):
+    async def scenario():
+        await register()
+        async with get_read_session() as session:
+            await get_chat_users(session, CHAT, None)
+        before = roster_cache.stats()
+        budget = querybudget.per_chat_user(2, 1)
+        assert budget(FakeChat().message(), None) == 2 + len(USERS)
+        assert roster_cache.stats() == before
+
+    run_db(scenario)
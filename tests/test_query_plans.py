@@ -0,0 +1,198 @@
+"""
+Checks that the ledger, undo and settle queries are served by their indexes.
+
+Each step runs through the real database functions while the SQL they send is captured, then
+every captured SELECT/DELETE is EXPLAINed. A step fails if a ledger table is read by a full scan
+or an expected index is missing from its plans. The SQLite schema is checked both as create_all
+makes it and as the migrations upgrade the pre-migrations one; benchmarks/check_plans.py runs
+the same checks against PostgreSQL.
+"""
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import event
+
+import database
+from database import (
+    get_session, upsert_user, import_ledger, create_full_transaction, delete_last_transaction,
+    get_balance_currencies, get_last_record_id, confirm_settlement, LedgerRow
+)
+from list import generate_ledger_view, decode_page_callback, ITEMS_PER_PAGE
+from settle import load_settle_balances
+from baseline_schema import create_baseline
+
+# Tables that grow with history; reading one of them in full is a failure
+LEDGER_TABLES = ('pay_records', 'payment_groups', 'payment_group_links', 'balances')
+
+# step -> indexes its plans must use; settle reads the balances table by primary key
+EXPECTED = {
+    'ledger': ['idx_pay_ledger', 'idx_link_record'],
+    'undo': ['idx_group_recent', 'idx_link_group'],
+    'settle': [],
+    'settle_confirm': ['idx_pay_context_record', 'idx_link_record'],
+}
+
+CURRENCIES = ['SGD', 'USD', 'EUR', 'JPY']
+
+class StatementCapture:
+    """
+    Records (statement, parameters) of the SELECTs and DELETEs sent while active.
+    """
+    def __init__(self):
+        self.statements = None
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if self.statements is not None and not executemany:
+            if statement.lstrip().upper().startswith(('SELECT', 'WITH', 'DELETE')):
+                self.statements.append((statement, parameters))
+
+    async def run(self, fn):
+        self.statements = []
+        try:
+            await fn()
+            return self.statements
+        finally:
+            self.statements = None
+
+async def explain(session, statement, parameters):
+    connection = await session.connection()
+    if connection.dialect.name == 'sqlite':
+        rows = await connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return [row[-1] for row in rows]
+    # On test-sized tables scanning and hashing everything looks cheapest; with those plans priced
+    # out, the plan shows whether an index can serve each lookup, as it must once the tables are big
+    for setting in ('enable_seqscan', 'enable_hashjoin', 'enable_mergejoin'):
+        await connection.exec_driver_sql(f"SET LOCAL {setting} = off")
+    rows = await connection.exec_driver_sql(f"EXPLAIN {statement}", parameters)
+    return [row[0] for row in rows]
+
+def full_scans(plan):
+    scans = []
+    for line in plan:
+        words = line.replace('->', ' ').split()
+        for table in LEDGER_TABLES:
+            # SQLite: "SCAN pay_records [USING ... INDEX ...]"; PostgreSQL: "Seq Scan on pay_records"
+            if words[:2] == ['SCAN', table] or ' '.join(words[:4]) == f"Seq Scan on {table}":
+                scans.append(line.strip())
+    return scans
+
+async def check(step, statements):
+    """
+    EXPLAINs a step's statements. Returns {'check', 'statements', 'missing_indexes', 'full_scans', 'plans'}.
+    """
+    plans = []
+    async with get_session() as session:
+        for statement, parameters in statements:
+            plans.append(await explain(session, statement, parameters))
+        await session.rollback()
+
+    text = '\n'.join(line for plan in plans for line in plan)
+    return {
+        'check': step,
+        'statements': len(statements),
+        'missing_indexes': [index for index in EXPECTED[step] if index not in text],
+        'full_scans': [scan for plan in plans for scan in full_scans(plan)],
+        'plans': [(statement, plan) for (statement, _), plan in zip(statements, plans)],
+    }
+
+async def fill_chat(chat_id, records, rng, users=8):
+    """
+    Imports a synthetic ledger of groups of 1-6 records, a minute apart, into one chat.
+    """
+    user_ids = list(range(1, users + 1))
+    for user_id in user_ids:
+        await upsert_user(user_id, chat_id, None, f"user{user_id}")
+    start = datetime.utcnow() - timedelta(minutes=records)
+    rows = []
+    group_id = 0
+    while len(rows) < records:
+        group_id += 1
+        when = start + timedelta(minutes=group_id)
+        currency = rng.choice(CURRENCIES)
+        payer = rng.choice(user_ids)
+        for payee in rng.sample(user_ids, min(records - len(rows), rng.randint(1, 6))):
+            rows.append(LedgerRow(
+                group_id, f"expense {group_id}", when, None, when, payer, payee, currency,
+                Decimal(rng.randint(100, 20000)) / 100 if currency != 'JPY' else Decimal(rng.randint(1, 200))
+            ))
+    await import_ledger(chat_id, None, rows)
+
+def next_page_callback(markup):
+    for button in markup.inline_keyboard[0]:
+        if button.callback_data.startswith('list_n_'):
+            return button.callback_data
+    return None
+
+async def check_steps(chat_id, records):
+    """
+    Runs each step against a filled chat and returns its check() result, in step order.
+    """
+    capture = StatementCapture()
+    event.listen(database.engine.sync_engine, 'before_cursor_execute', capture)
+
+    # /list: first, middle and last pages, then a cursor step from the middle one
+    async def ledger():
+        total_pages = -(-records // ITEMS_PER_PAGE)
+        for page in (1, max(1, total_pages // 2), total_pages):
+            await generate_ledger_view(chat_id, None, page)
+        _, markup = await generate_ledger_view(chat_id, None, max(1, total_pages // 2))
+        callback = next_page_callback(markup)
+        if callback:
+            page, cursor = decode_page_callback(callback)
+            await generate_ledger_view(chat_id, None, page, cursor)
+
+    async def undo():
+        await delete_last_transaction(1, chat_id, None)
+
+    target = CURRENCIES[0]
+    rates = {f"{currency}_{target}": 1 for currency in CURRENCIES}
+
+    async def settle():
+        async with get_session() as session:
+            await get_balance_currencies(session, chat_id, None)
+            await load_settle_balances(session, chat_id, None, target, rates)
+            await get_last_record_id(session, chat_id, None)
+
+    async def settle_confirm():
+        async with get_session() as session:
+            through = await get_last_record_id(session, chat_id, None)
+        await confirm_settlement(chat_id, None, through, target, 1, archive=False)
+
+    await create_full_transaction(chat_id, None, 1, {'type': 'SPLIT_ALL'}, target, 10, 'check')
+    results = []
+    try:
+        for step, fn in (('ledger', ledger), ('undo', undo), ('settle', settle), ('settle_confirm', settle_confirm)):
+            results.append(await check(step, await capture.run(fn)))
+    finally:
+        event.remove(database.engine.sync_engine, 'before_cursor_execute', capture)
+    return results
+
+async def analyze():
+    if database.engine.dialect.name == 'postgresql':
+        async with database.engine.connect() as conn:
+            await (await conn.execution_options(isolation_level='AUTOCOMMIT')).exec_driver_sql('ANALYZE')
+    else:
+        async with database.engine.begin() as conn:
+            await conn.exec_driver_sql('ANALYZE')
+
+async def fill_and_check(chats, records, seed=1):
+    rng = random.Random(seed)
+    chat_ids = [-1000 - i for i in range(chats)]
+    for chat_id in chat_ids:
+        await fill_chat(chat_id, records, rng)
+    await analyze()
+    return await check_steps(chat_ids[len(chat_ids) // 2], records)
+
+@pytest.mark.parametrize('schema', ['fresh', 'upgraded'])
+def test_ledger_queries_use_indexes(run_db, schema):
+    results = run_db(
+        lambda: fill_and_check(chats=3, records=600),
+        setup=create_baseline if schema == 'upgraded' else None
+    )
+    assert [result['check'] for result in results] == list(EXPECTED)
+    for result in results:
+        assert result['statements'], result['check']
+        assert result['missing_indexes'] == [], (result['check'], result['plans'])
+        assert result['full_scans'] == [], (result['check'], result['plans'])
@@ -0,0 +1,38 @@
+import json
+import logging
+from decimal import Decimal
+
+import pytest
+
+from rates import load_snapshot
+
+def write(tmp_path, content):
+    path = tmp_path / 'rates_snapshot.json'
+    path.write_text(content if isinstance(content, str) else json.dumps(content))
+    return str(path)
+
+def test_loads_rates(tmp_path):
+    path = write(tmp_path, {'base': 'SGD', 'date': '2025-01-31', 'rates': {'USD': 0.74, 'MYR': 3.3, 'SGD': 1}})
+    assert load_snapshot(path) == {('SGD', 'USD'): Decimal('0.74'), ('SGD', 'MYR'): Decimal('3.3')}
+
+def test_missing_file_means_no_rates(tmp_path):
+    assert load_snapshot(str(tmp_path / 'missing.json')) == {}
+
+@pytest.mark.parametrize('content', [
+    {'rates': {'USD': 0.74}},
+    {'base': 'SGD'},
+    {'base': 'SGD', 'rates': [0.74]},
+    {'base': None, 'rates': {'USD': 0.74}},
+    [1, 2, 3],
+    '{"base": "SGD", "rates": ',
+])
+def test_malformed_snapshot_is_ignored(tmp_path, caplog, content):
+    with caplog.at_level(logging.WARNING):
+        assert load_snapshot(write(tmp_path, content)) == {}
+    assert 'snapshot' in caplog.text
+
+def test_invalid_rates_are_skipped(tmp_path, caplog):
+    path = write(tmp_path, '{"base": "SGD", "rates": {"USD": 0.74, "EUR": "x", "JPY": -1, "MYR": NaN, "GBP": null}}')
+    with caplog.at_level(logging.WARNING):
+        assert load_snapshot(path) == {('SGD', 'USD'): Decimal('0.74')}
+    assert 'Skipped 4 invalid rates' in caplog.text
@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+
+from sqlalchemy import update
+
+from database import upsert_user, create_full_transaction, get_session, Balance
+from list import rebuild_balances_command
+
+CHAT = -1001
+
+def test_rebuild_report_names_users(run_db):
+    replies = []
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    async def scenario():
+        for user_id, name in ((1, 'alice'), (2, 'bob')):
+            await upsert_user(user_id, CHAT, None, name)
+        await create_full_transaction(CHAT, None, 1, {'type': 'SPLIT_ALL'}, 'SGD', 10, 'dinner')
+        async with get_session() as session:
+            await session.execute(update(Balance).where(Balance.user_id == 2).values(value=0))
+            await session.commit()
+
+        message = SimpleNamespace(message_thread_id=None, reply_text=reply_text)
+        chat_update = SimpleNamespace(effective_chat=SimpleNamespace(id=CHAT), effective_message=message, message=message)
+        await rebuild_balances_command(chat_update, None)
+
+    run_db(scenario)
+    [report] = replies
+    assert 'Fixed 1 balance mismatch' in report
+    assert '• bob SGD:' in report
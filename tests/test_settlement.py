@@ -0,0 +1,42 @@
+import time
+from collections import defaultdict
+
+import pytest
+
+from settlement import plan_settlement, exact_transfers, ExactSolverTimeout, EXACT, AUTO, HEURISTIC
+
+def settles(balances, transfers):
+    paid = defaultdict(int)
+    for debtor, creditor, amount in transfers:
+        assert amount > 0
+        paid[debtor] += amount
+        paid[creditor] -= amount
+    return all(balances[uid] + paid[uid] == 0 for uid in balances)
+
+def dense_balances(n):
+    # 1, 2 and -3 units with no opposite pairs: the exact solver's worst case
+    values = [1] * 3 + [2] * 6 + [-3] * (n - 9)
+    values[-1] -= sum(values)
+    return dict(enumerate(values))
+
+def test_exact_finds_zero_sum_groups():
+    balances = {1: 500, 2: -500, 3: 300, 4: 200, 5: -500, 6: 700, 7: -400, 8: -300}
+    plan = plan_settlement(balances, EXACT)
+    assert plan.method == EXACT
+    assert settles(balances, plan.transfers)
+    # {1, 2}, {3, 4, 5}, {6, 7, 8}
+    assert len(plan.transfers) == 5
+
+def test_exact_solver_gives_up_at_its_deadline():
+    with pytest.raises(ExactSolverTimeout):
+        exact_transfers(dense_balances(20), time_budget=0.01)
+
+@pytest.mark.parametrize('mode', [AUTO, EXACT])
+def test_dense_balances_fall_back_to_heuristic(mode):
+    balances = dense_balances(20)
+    start = time.monotonic()
+    plan = plan_settlement(balances, mode)
+    assert time.monotonic() - start < 0.5
+    assert plan.method == HEURISTIC
+    assert settles(balances, plan.transfers)
+    assert len(plan.transfers) <= plan.greedy_count
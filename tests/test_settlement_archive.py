@@ -0,0 +1,66 @@
+from decimal import Decimal
+
+from database import (
+    upsert_user, create_full_transaction, confirm_settlement, delete_last_transaction, rebuild_balances,
+    get_session, get_balances, get_last_record_id, import_ledger, LedgerRow
+)
+from list import generate_ledger_view
+
+CHAT = -1001
+
+async def pay(payer_id, amount, description):
+    await create_full_transaction(CHAT, None, payer_id, {'type': 'SPLIT_ALL'}, 'SGD', amount, description)
+
+def test_payment_after_archived_settlement_is_live(run_db):
+    async def scenario():
+        for user_id, name in ((1, 'alice'), (2, 'bob')):
+            await upsert_user(user_id, CHAT, None, name)
+        await pay(1, 10, 'dinner')
+        await pay(2, 6, 'taxi')
+        async with get_session() as session:
+            through = await get_last_record_id(session, CHAT, None)
+        checkpoint, archived = await confirm_settlement(CHAT, None, through, 'SGD', 1, archive=True)
+        assert archived == 4
+
+        # Archiving freed the highest ids; the new payment must not reuse them
+        await pay(1, 10, 'lunch')
+        async with get_session() as session:
+            assert await get_last_record_id(session, CHAT, None) > checkpoint.last_pay_record_id
+            assert len(await get_balances(session, CHAT, None)) == 2
+
+        text, _ = await generate_ledger_view(CHAT, None, 1)
+        assert 'lunch' in text
+        assert await rebuild_balances(CHAT, None) == []
+
+        deleted = await delete_last_transaction(1, CHAT, None)
+        assert deleted is not None and deleted.name == 'lunch'
+        async with get_session() as session:
+            assert await get_balances(session, CHAT, None) == []
+
+    run_db(scenario)
+
+def test_import_after_archived_settlement_is_live(run_db):
+    async def scenario():
+        for user_id, name in ((1, 'alice'), (2, 'bob')):
+            await upsert_user(user_id, CHAT, None, name)
+        await pay(1, 10, 'dinner')
+        await pay(2, 6, 'taxi')
+        async with get_session() as session:
+            through = await get_last_record_id(session, CHAT, None)
+        checkpoint, _ = await confirm_settlement(CHAT, None, through, 'SGD', 1, archive=True)
+
+        rows = [
+            LedgerRow(7, 'imported', None, 1, None, 1, 2, 'SGD', Decimal('4.00')),
+            LedgerRow(7, 'imported', None, 2, None, 2, 1, 'SGD', Decimal('1.50')),
+        ]
+        assert await import_ledger(CHAT, None, iter(rows)) == 2
+        async with get_session() as session:
+            assert await get_last_record_id(session, CHAT, None) > checkpoint.last_pay_record_id
+
+        text, _ = await generate_ledger_view(CHAT, None, 1)
+        assert 'imported' in text
+        assert await rebuild_balances(CHAT, None) == []
+        deleted = await delete_last_transaction(1, CHAT, None)
+        assert deleted is not None and deleted.name == 'imported' and len(deleted.records) == 2
+
+    run_db(scenario)
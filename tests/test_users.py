@@ -0,0 +1,17 @@
+import asyncio
+
+import database
+from database import upsert_user, check_username_exists
+
+CHAT = -1001
+
+def test_username_check_does_not_wait_for_writes(run_db):
+    async def scenario():
+        await upsert_user(1, CHAT, None, 'Alice')
+        database.roster_cache.clear()
+        # A long write transaction holds the writer lock on SQLite; reads don't queue behind it
+        async with database.writer_lock:
+            assert await asyncio.wait_for(check_username_exists(CHAT, None, 'alice'), timeout=1)
+            assert not await asyncio.wait_for(check_username_exists(CHAT, None, 'bob'), timeout=1)
+
+    run_db(scenario)
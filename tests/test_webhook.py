@@ -0,0 +1,57 @@
+import json
+import asyncio
+from types import SimpleNamespace
+
+from processor import ChatOrderedUpdateProcessor
+from webhook import WebhookReceiver
+
+SECRET = 'secret'
+
+def update_body(update_id, chat_id):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': 'hi',
+            'chat': {'id': chat_id, 'type': 'group'},
+        },
+    }).encode()
+
+async def post(receiver, body, secret=SECRET):
+    return (await receiver.handle('POST', '/telegram', {'x-telegram-bot-api-secret-token': secret}, body))[0]
+
+def test_full_queue_returns_503():
+    async def run():
+        processor = ChatOrderedUpdateProcessor(2, max_pending_updates=4)
+        queue = processor.create_queue(4)
+        release = asyncio.Event()
+        tasks = []
+
+        async def fetch():
+            while True:
+                update = await queue.get()
+                tasks.append(asyncio.create_task(processor.process_update(update, release.wait())))
+
+        receiver = WebhookReceiver(SimpleNamespace(update_queue=queue, bot=None), '/telegram', SECRET, put_timeout=0.01)
+        fetcher = asyncio.create_task(fetch())
+        statuses = [await post(receiver, update_body(n, -n)) for n in range(1, 21)]
+        assert statuses.count(200) == 8
+        assert statuses.count(503) == 12
+        assert len(tasks) == 4
+
+        release.set()
+        await asyncio.sleep(0.05)
+        assert await post(receiver, update_body(21, -21)) == 200
+        fetcher.cancel()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+
+def test_wrong_secret_is_forbidden():
+    async def run():
+        queue = asyncio.Queue()
+        receiver = WebhookReceiver(SimpleNamespace(update_queue=queue, bot=None), '/telegram', SECRET)
+        assert await post(receiver, update_body(1, -1), secret='guess') == 403
+        assert await post(receiver, update_body(1, -1)) == 200
+        assert queue.qsize() == 1
+
+    asyncio.run(run())
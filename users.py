@@ -3,8 +3,10 @@ import logging
 from telegram import Update
 from telegram.ext import ContextTypes
 
+from querybudget import query_budget, per_chat_user
 from database import get_session, User, upsert_user, check_username_exists
 
+@query_budget(statements=4, rows=per_chat_user(2, 1))
 async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     provided_args = " ".join(context.args)
     user_full_name = f"{update.effective_user.first_name or ''} {update.effective_user.last_name or ''}".strip()
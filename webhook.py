@@ -0,0 +1,93 @@
+"""
+Webhook serving mode: Telegram POSTs updates to us instead of us long-polling for them.
+
+Recorded updates can be replayed locally against a running bot, e.g.
+
+    curl -X POST localhost:8443/telegram \
+         -H 'X-Telegram-Bot-Api-Secret-Token: <WEBHOOK_SECRET>' \
+         -H 'Content-Type: application/json' -d @update.json
+"""
+import hmac
+import json
+import signal
+import asyncio
+import logging
+from telegram import Update
+
+from httpserver import start_server
+
+class WebhookReceiver:
+    """
+    Validates incoming webhook requests and feeds them into the Application's update queue.
+    The queue is bounded, so a full queue makes requests wait and eventually get a 503,
+    which Telegram retries later.
+    """
+    def __init__(self, application, path, secret_token=None, put_timeout=5.0):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.put_timeout = put_timeout
+        self.draining = False
+
+    async def handle(self, method, path, headers, body):
+        if path != self.path:
+            return 404, b'', 'text/plain'
+        if method != 'POST':
+            return 405, b'', 'text/plain'
+
+        if self.secret_token:
+            received = headers.get('x-telegram-bot-api-secret-token', '')
+            if not hmac.compare_digest(received.encode(), self.secret_token.encode()):
+                return 403, b'', 'text/plain'
+
+        if self.draining:
+            return 503, b'', 'text/plain'
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logging.warning(f"Rejected malformed update: {e}")
+            return 400, b'', 'text/plain'
+
+        try:
+            await asyncio.wait_for(self.application.update_queue.put(update), timeout=self.put_timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Update queue full, asking Telegram to retry later.")
+            return 503, b'', 'text/plain'
+        return 200, b'', 'text/plain'
+
+async def run_webhook(application, listen, port, path, secret_token=None, webhook_url=None, put_timeout=5.0):
+    """
+    Runs the Application behind our own webhook server until SIGINT/SIGTERM, then drains:
+    stop accepting requests, let already-queued updates and in-flight handlers finish, shut down.
+    """
+    if not secret_token:
+        logging.warning("No webhook secret token set: the endpoint accepts updates from anyone who can reach it!")
+    receiver = WebhookReceiver(application, path, secret_token, put_timeout)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+
+        server = await start_server(receiver.handle, listen, port)
+        if webhook_url:
+            await application.bot.set_webhook(url=webhook_url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+        print(f"Webhook server listening on {listen}:{port}{path}")
+
+        await stop.wait()
+
+        print("Draining webhook server...")
+        receiver.draining = True
+        await server.shutdown()
+        # Application.stop() processes the updates still in the queue and awaits running handlers
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+
+    if application.post_shutdown:
+        await application.post_shutdown(application)